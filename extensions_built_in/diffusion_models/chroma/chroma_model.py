@@ -64,6 +64,7 @@ class FakeCLIP(torch.nn.Module):
 
 class ChromaModel(BaseModel):
     arch = "chroma"
+    supports_batched_generation = True
 
     def __init__(
             self,
@@ -306,8 +307,9 @@ class ChromaModel(BaseModel):
             latents=gen_config.latents,
             generator=generator,
             **extra
-        ).images[0]
-        return img
+        ).images
+        # a list of generators means a batch of prompts
+        return img if isinstance(generator, list) else img[0]
 
     def get_noise_prediction(
         self,
@@ -1,9 +1,7 @@
 from collections import OrderedDict
 import os
-import sqlite3
-import asyncio
-import concurrent.futures
 from extensions_built_in.sd_trainer.SDTrainer import SDTrainer
+from toolkit.job_status_worker import JobStatusWorker
 from typing import Literal, Optional
 import threading
 import time
@@ -26,12 +24,14 @@ class UITrainer(SDTrainer):
         if self.job_id is None:
             raise Exception("AITK_JOB_ID not set")
         self.is_stopping = False
-        # Create a thread pool for database operations
-        self.thread_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
-        # Track all async tasks
-        self._async_tasks = []
+        # writes status and polls for stop signals on its own thread so steps never wait on the database
+        self.status_worker = JobStatusWorker(
+            self.sqlite_db_path,
+            self.job_id,
+            write=self.accelerator.is_main_process,
+        )
         # Initialize the status
-        self._run_async_operation(self._update_status("running", "Starting"))
+        self.update_status("running", "Starting")
         self._stop_watcher_started = False
         # self.start_stop_watcher(interval_sec=2.0)
     
@@ -52,21 +52,10 @@ class UITrainer(SDTrainer):
         while True:
             try:
                 if self.should_stop():
-                    # Mark and update status (non-blocking; uses existing infra)
                     self.is_stopping = True
-                    self._run_async_operation(
-                        self._update_status("stopped", "Job stopped (remote)")
-                    )
-                    # Best-effort flush pending async ops
-                    try:
-                        asyncio.run(self.wait_for_all_async())
-                    except RuntimeError:
-                        pass
-                    # Try to stop DB thread pool quickly
-                    try:
-                        self.thread_pool.shutdown(wait=False, cancel_futures=True)
-                    except TypeError:
-                        self.thread_pool.shutdown(wait=False)
+                    self.update_status("stopped", "Job stopped (remote)")
+                    # Best-effort flush of pending status
+                    self.status_worker.close()
                     print("")
                     print("****************************************************")
                     print("    Stop signal received; terminating process.      ")
@@ -76,152 +65,43 @@ class UITrainer(SDTrainer):
             except Exception:
                 time.sleep(interval_sec)
 
-    def _run_async_operation(self, coro):
-        """Helper method to run an async coroutine and track the task."""
-        try:
-            loop = asyncio.get_event_loop()
-        except RuntimeError:
-            # No event loop exists, create a new one
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-
-        # Create a task and track it
-        if loop.is_running():
-            task = asyncio.run_coroutine_threadsafe(coro, loop)
-            self._async_tasks.append(asyncio.wrap_future(task))
-        else:
-            task = loop.create_task(coro)
-            self._async_tasks.append(task)
-            loop.run_until_complete(task)
-
-    async def _execute_db_operation(self, operation_func):
-        """Execute a database operation in a separate thread to avoid blocking."""
-        loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(self.thread_pool, operation_func)
-
-    def _db_connect(self):
-        """Create a new connection for each operation to avoid locking."""
-        conn = sqlite3.connect(self.sqlite_db_path, timeout=10.0)
-        conn.isolation_level = None  # Enable autocommit mode
-        return conn
-
     def should_stop(self):
-        def _check_stop():
-            with self._db_connect() as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    "SELECT stop FROM Job WHERE id = ?", (self.job_id,))
-                stop = cursor.fetchone()
-                return False if stop is None else stop[0] == 1
+        # set by the status worker, does not touch the database
+        return self.status_worker.stop_requested
 
-        return _check_stop()
-    
     def should_return_to_queue(self):
-        def _check_return_to_queue():
-            with self._db_connect() as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    "SELECT return_to_queue FROM Job WHERE id = ?", (self.job_id,))
-                return_to_queue = cursor.fetchone()
-                return False if return_to_queue is None else return_to_queue[0] == 1
-
-        return _check_return_to_queue()
+        return self.status_worker.return_to_queue_requested
 
     def maybe_stop(self):
         if self.should_stop():
-            self._run_async_operation(
-                self._update_status("stopped", "Job stopped"))
+            self.update_status("stopped", "Job stopped")
             self.is_stopping = True
             raise Exception("Job stopped")
         if self.should_return_to_queue():
-            self._run_async_operation(
-                self._update_status("queued", "Job queued"))
+            self.update_status("queued", "Job queued")
             self.is_stopping = True
             raise Exception("Job returning to queue")
 
-    async def _update_key(self, key, value):
-        if not self.accelerator.is_main_process:
-            return
-
-        def _do_update():
-            with self._db_connect() as conn:
-                cursor = conn.cursor()
-                cursor.execute("BEGIN IMMEDIATE")
-                try:
-                    # Convert the value to string if it's not already
-                    if isinstance(value, str):
-                        value_to_insert = value
-                    else:
-                        value_to_insert = str(value)
-
-                    # Use parameterized query for both the column name and value
-                    update_query = f"UPDATE Job SET {key} = ? WHERE id = ?"
-                    cursor.execute(
-                        update_query, (value_to_insert, self.job_id))
-                finally:
-                    cursor.execute("COMMIT")
-
-        await self._execute_db_operation(_do_update)
-
     def update_step(self):
-        """Non-blocking update of the step count."""
-        if self.accelerator.is_main_process:
-            self._run_async_operation(self._update_key("step", self.step_num))
+        """Queue an update of the step count."""
+        self.update_db_key("step", self.step_num)
 
     def update_db_key(self, key, value):
-        """Non-blocking update a key in the database."""
+        """Queue an update of a key in the database."""
         if self.accelerator.is_main_process:
-            self._run_async_operation(self._update_key(key, value))
-
-    async def _update_status(self, status: AITK_Status, info: Optional[str] = None):
-        if not self.accelerator.is_main_process:
-            return
-
-        def _do_update():
-            with self._db_connect() as conn:
-                cursor = conn.cursor()
-                cursor.execute("BEGIN IMMEDIATE")
-                try:
-                    if info is not None:
-                        cursor.execute(
-                            "UPDATE Job SET status = ?, info = ? WHERE id = ?",
-                            (status, info, self.job_id)
-                        )
-                    else:
-                        cursor.execute(
-                            "UPDATE Job SET status = ? WHERE id = ?",
-                            (status, self.job_id)
-                        )
-                finally:
-                    cursor.execute("COMMIT")
-
-        await self._execute_db_operation(_do_update)
+            self.status_worker.update(key, value)
 
     def update_status(self, status: AITK_Status, info: Optional[str] = None):
-        """Non-blocking update of status."""
+        """Queue an update of the status."""
         if self.accelerator.is_main_process:
-            self._run_async_operation(self._update_status(status, info))
-
-    async def wait_for_all_async(self):
-        """Wait for all tracked async operations to complete."""
-        if not self._async_tasks:
-            return
-
-        try:
-            await asyncio.gather(*self._async_tasks)
-        except Exception as e:
-            pass
-        finally:
-            # Clear the task list after completion
-            self._async_tasks.clear()
+            self.status_worker.update_status(status, info)
 
     def on_error(self, e: Exception):
         super(UITrainer, self).on_error(e)
         if self.accelerator.is_main_process and not self.is_stopping:
             self.update_status("error", str(e))
         self.update_db_key("step", self.last_save_step)
-        asyncio.run(self.wait_for_all_async())
-        self.thread_pool.shutdown(wait=True)
+        self.status_worker.close()
 
     def handle_timing_print_hook(self, timing_dict):
         if "train_loop" not in timing_dict:
@@ -239,9 +119,8 @@ class UITrainer(SDTrainer):
     def done_hook(self):
         super(UITrainer, self).done_hook()
         self.update_status("completed", "Training completed")
-        # Wait for all async operations to finish before shutting down
-        asyncio.run(self.wait_for_all_async())
-        self.thread_pool.shutdown(wait=True)
+        # write out anything still queued before shutting down
+        self.status_worker.close()
 
     def end_step_hook(self):
         super(UITrainer, self).end_step_hook()
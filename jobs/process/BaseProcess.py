@@ -20,8 +20,16 @@ class BaseProcess(object):
         self.raw_process_config = config
         self.name = self.get_conf('name', self.job.name)
         self.meta = copy.deepcopy(self.job.meta)
-        self.timer: Timer = Timer(f'{self.name} Timer')
         self.performance_log_every = self.get_conf('performance_log_every', 0)
+        # timers do nothing unless they are being reported
+        self.timer: Timer = Timer(
+            f'{self.name} Timer',
+            enabled=self.performance_log_every > 0,
+            sync_device=self.get_conf('performance_sync_device', False),
+        )
+        # optional files the timings are written to each time they are printed
+        self.performance_log_jsonl = self.get_conf('performance_log_jsonl', None)
+        self.performance_prometheus_path = self.get_conf('performance_prometheus_path', None)
 
         print(json.dumps(self.config, indent=4))
         
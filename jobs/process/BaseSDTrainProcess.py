@@ -24,6 +24,7 @@ from huggingface_hub.utils import HfFolder
 from toolkit.memory_management import MemoryManager
 
 from toolkit.basic import value_map
+from toolkit.batch_prefetcher import BatchPrefetcher, get_prefetch_overlap
 from toolkit.clip_vision_adapter import ClipVisionAdapter
 from toolkit.custom_adapter import CustomAdapter
 from toolkit.data_loader import get_dataloader_from_datasets, trigger_dataloader_setup_epoch
@@ -44,7 +45,10 @@ from toolkit.progress_bar import ToolkitProgressBar
 from toolkit.reference_adapter import ReferenceAdapter
 from toolkit.sampler import get_sampler
 from toolkit.saving import save_t2i_from_diffusers, load_t2i_model, save_ip_adapter_from_diffusers, \
-    load_ip_adapter_model, load_custom_adapter_model
+    load_ip_adapter_model, load_custom_adapter_model, snapshot_to_cpu
+from toolkit.cache_pipeline import AsyncCacheWriter
+from toolkit.optimizer_shards import OPTIMIZER_SHARD_DIR_NAME, has_optimizer_shards, load_optimizer_shards, \
+    save_optimizer_shards
 
 from toolkit.scheduler import get_lr_scheduler
 from toolkit.sd_device_states_presets import get_train_sd_device_state_preset
@@ -118,6 +122,13 @@ class BaseSDTrainProcess(BaseTrainProcess):
         self.model_config = ModelConfig(**model_config)
 
         self.save_config = SaveConfig(**self.get_conf('save', {}))
+        # one worker so checkpoint files, optimizer state and cleanup are written in order
+        self.checkpoint_writer: Union[AsyncCacheWriter, None] = None
+        if self.save_config.async_save:
+            self.checkpoint_writer = AsyncCacheWriter(num_workers=1, max_pending=16)
+        # batch prefetcher wait and background load seconds since the timers were last printed
+        self.prefetch_wait_time = 0.0
+        self.prefetch_fetch_time = 0.0
         self.sample_config = SampleConfig(**self.get_conf('sample', {}))
         first_sample_config = self.get_conf('first_sample', None)
         if first_sample_config is not None:
@@ -365,7 +376,13 @@ class BaseSDTrainProcess(BaseTrainProcess):
             self.adapter.is_sampling = True
         
         # send to be generated
-        self.sd.generate_images(gen_img_config_list, sampler=sample_config.sampler)
+        # samples finish writing in the background while the model goes back to training mode
+        self.sd.generate_images(
+            gen_img_config_list,
+            sampler=sample_config.sampler,
+            batch_size=sample_config.batch_size,
+            wait_for_writes=False,
+        )
 
         
         if self.adapter is not None and isinstance(self.adapter, CustomAdapter):
@@ -374,6 +391,9 @@ class BaseSDTrainProcess(BaseTrainProcess):
         if self.ema is not None:
             self.ema.train()
 
+        # every sample is on disk and logged before training resumes, write errors are raised here
+        self.sd.sample_writer.drain()
+
     def update_training_metadata(self):
         o_dict = OrderedDict({
             "training_info": self.get_training_info()
@@ -484,6 +504,51 @@ class BaseSDTrainProcess(BaseTrainProcess):
     def post_save_hook(self, save_path):
         # override in subclass
         pass
+
+    def submit_save(self, fn, *args, **kwargs):
+        # runs on the checkpoint writer, or right away when async saving is off
+        if self.checkpoint_writer is None:
+            return fn(*args, **kwargs)
+        return self.checkpoint_writer.submit(fn, *args, **kwargs)
+
+    def wait_for_saves(self):
+        if self.checkpoint_writer is None:
+            return
+        if self.checkpoint_writer.num_pending > 0:
+            print_acc("Waiting for checkpoint to finish saving")
+        self.checkpoint_writer.wait()
+
+    def save_optimizer_state(self, state_dict, file_path):
+        try:
+            if self.save_config.optimizer_state_format == 'sharded':
+                shard_dir = os.path.join(self.save_root, OPTIMIZER_SHARD_DIR_NAME)
+                num_written, num_shards = save_optimizer_shards(
+                    state_dict,
+                    shard_dir,
+                    shard_size_mb=self.save_config.optimizer_shard_size_mb
+                )
+                print_acc(f"Saved optimizer to {shard_dir}, {num_written}/{num_shards} shards changed")
+                # an optimizer.pt from before would be out of date now
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+            else:
+                torch.save(state_dict, file_path)
+                print_acc(f"Saved optimizer to {file_path}")
+                # shards from before would be out of date now, and they take priority on load
+                shard_dir = os.path.join(self.save_root, OPTIMIZER_SHARD_DIR_NAME)
+                if os.path.exists(shard_dir):
+                    shutil.rmtree(shard_dir)
+        except Exception as e:
+            print_acc(e)
+            print_acc("Could not save optimizer")
+
+    def on_error(self, e: Exception):
+        super().on_error(e)
+        # let a checkpoint that is still being written finish instead of leaving it half written
+        try:
+            self.wait_for_saves()
+        except Exception as save_error:
+            print_acc(f"Error saving checkpoint: {save_error}")
     
     def done_hook(self):
         pass
@@ -494,6 +559,8 @@ class BaseSDTrainProcess(BaseTrainProcess):
     def save(self, step=None):
         if not self.accelerator.is_main_process:
             return
+        # only one checkpoint is held in memory at a time
+        self.wait_for_saves()
         flush()
         if self.ema is not None:
             # always save params as ema
@@ -536,11 +603,16 @@ class BaseSDTrainProcess(BaseTrainProcess):
 
                 # if we are doing embedding training as well, add that
                 embedding_dict = self.embedding.state_dict() if self.embedding else None
-                self.network.save_weights(
+                # the cpu copy is made now, hashing and writing it happens on the checkpoint writer
+                network_state_dict = self.network.get_state_dict(
+                    extra_state_dict=embedding_dict,
+                    dtype=get_torch_dtype(self.save_config.dtype)
+                )
+                self.submit_save(
+                    self.network.save_state_dict,
+                    network_state_dict,
                     file_path,
-                    dtype=get_torch_dtype(self.save_config.dtype),
-                    metadata=save_meta,
-                    extra_state_dict=embedding_dict
+                    metadata=copy.copy(save_meta)
                 )
                 self.network.multiplier = prev_multiplier
                 # if we have an embedding as well, pair it with the network
@@ -565,10 +637,11 @@ class BaseSDTrainProcess(BaseTrainProcess):
                 for key, value in decorator_state_dict.items():
                     if isinstance(value, torch.Tensor):
                         decorator_state_dict[key] = value.clone().to('cpu', dtype=get_torch_dtype(self.save_config.dtype))
-                save_file(
+                self.submit_save(
+                    save_file,
                     decorator_state_dict,
                     dec_file_path,
-                    metadata=save_meta,
+                    metadata=copy.copy(save_meta),
                 )
 
             if self.adapter is not None and self.adapter_config.train:
@@ -674,14 +747,17 @@ class BaseSDTrainProcess(BaseTrainProcess):
                     state_dict = unwrap_model(self.optimizer).state_dict()
                 except Exception as e:
                     state_dict = self.optimizer.state_dict()
-                torch.save(state_dict, file_path)
-                print_acc(f"Saved optimizer to {file_path}")
+                if self.checkpoint_writer is not None:
+                    # the optimizer keeps updating its state while this is written
+                    state_dict = snapshot_to_cpu(state_dict)
+                self.submit_save(self.save_optimizer_state, state_dict, file_path)
             except Exception as e:
                 print_acc(e)
                 print_acc("Could not save optimizer")
 
-        self.clean_up_saves()
-        self.post_save_hook(file_path)
+        # old saves are removed once the new files are written
+        self.submit_save(self.clean_up_saves)
+        self.submit_save(self.post_save_hook, file_path)
 
         if self.ema is not None:
             self.ema.train()
@@ -767,6 +843,8 @@ class BaseSDTrainProcess(BaseTrainProcess):
                 decay=self.train_config.ema_config.ema_decay,
                 use_feedback=self.train_config.ema_config.use_feedback,
                 param_multiplier=self.train_config.ema_config.param_multiplier,
+                update_every=self.train_config.ema_config.update_every,
+                offload_to_cpu=self.train_config.ema_config.offload_to_cpu,
             )
 
     def before_dataset_load(self):
@@ -985,6 +1063,44 @@ class BaseSDTrainProcess(BaseTrainProcess):
 
         return noise
 
+    def prefetch_batches(self, iterator):
+        if self.train_config.prefetch_batches <= 0:
+            return iterator
+        return BatchPrefetcher(
+            iterator,
+            self.device_torch,
+            latents_dtype=get_torch_dtype(self.train_config.dtype),
+            depth=self.train_config.prefetch_batches
+        )
+
+    def close_prefetcher(self, iterator):
+        if isinstance(iterator, BatchPrefetcher):
+            iterator.close()
+
+    def next_batch(self, iterator, timer_name: str):
+        # with prefetching, the timer is only the time spent waiting on the batch
+        with self.timer(timer_name):
+            batch = next(iterator)
+        if isinstance(iterator, BatchPrefetcher):
+            # time the background thread spent loading it, mostly hidden behind the previous step
+            self.timer.record(f'{timer_name}:prefetch', iterator.last_fetch_time)
+            self.prefetch_wait_time += iterator.last_wait_time
+            self.prefetch_fetch_time += iterator.last_fetch_time
+        return batch
+
+    def print_prefetch_overlap(self):
+        if self.prefetch_fetch_time <= 0:
+            return
+        overlap = get_prefetch_overlap(self.prefetch_wait_time, self.prefetch_fetch_time)
+        print_acc(
+            f"Batch prefetch overlap: {overlap * 100:.1f}% of {self.prefetch_fetch_time:.2f}s loading hidden "
+            f"behind training, {self.prefetch_wait_time:.2f}s waited"
+        )
+        if self.accelerator.is_main_process and self.writer is not None:
+            self.writer.add_scalar('performance/prefetch_overlap', overlap, self.step_num)
+        self.prefetch_wait_time = 0.0
+        self.prefetch_fetch_time = 0.0
+
     def process_general_training_batch(self, batch: 'DataLoaderBatchDTO'):
         with torch.no_grad():
             with self.timer('prepare_prompt'):
@@ -1939,7 +2055,9 @@ class BaseSDTrainProcess(BaseTrainProcess):
         # check if it exists
         optimizer_state_filename = f'optimizer.pt'
         optimizer_state_file_path = os.path.join(self.save_root, optimizer_state_filename)
-        if os.path.exists(optimizer_state_file_path):
+        optimizer_shard_dir = os.path.join(self.save_root, OPTIMIZER_SHARD_DIR_NAME)
+        has_shards = has_optimizer_shards(optimizer_shard_dir)
+        if has_shards or os.path.exists(optimizer_state_file_path):
             # try to load
             # previous param groups
             # previous_params = copy.deepcopy(optimizer.param_groups)
@@ -1956,8 +2074,17 @@ class BaseSDTrainProcess(BaseTrainProcess):
 
             if load_optimizer:
                 try:
-                    print_acc(f"Loading optimizer state from {optimizer_state_file_path}")
-                    optimizer_state_dict = torch.load(optimizer_state_file_path, weights_only=True)
+                    if has_shards:
+                        print_acc(f"Loading optimizer state from {optimizer_shard_dir}")
+                        # straight onto the device of the params, the optimizer would move it there anyway
+                        param_device = next(
+                            (p.device for group in optimizer.param_groups for p in group['params']),
+                            torch.device('cpu')
+                        )
+                        optimizer_state_dict = load_optimizer_shards(optimizer_shard_dir, device=param_device)
+                    else:
+                        print_acc(f"Loading optimizer state from {optimizer_state_file_path}")
+                        optimizer_state_dict = torch.load(optimizer_state_file_path, weights_only=True)
                     optimizer.load_state_dict(optimizer_state_dict)
                     del optimizer_state_dict
                     flush()
@@ -2027,14 +2154,14 @@ class BaseSDTrainProcess(BaseTrainProcess):
 
         if self.data_loader is not None:
             dataloader = self.data_loader
-            dataloader_iterator = iter(dataloader)
+            dataloader_iterator = self.prefetch_batches(iter(dataloader))
         else:
             dataloader = None
             dataloader_iterator = None
 
         if self.data_loader_reg is not None:
             dataloader_reg = self.data_loader_reg
-            dataloader_iterator_reg = iter(dataloader_reg)
+            dataloader_iterator_reg = self.prefetch_batches(iter(dataloader_reg))
         else:
             dataloader_reg = None
             dataloader_iterator_reg = None
@@ -2097,39 +2224,41 @@ class BaseSDTrainProcess(BaseTrainProcess):
                     # don't do a reg step on sample or save steps as we dont want to normalize on those
                     if batch_step % 2 == 0 and dataloader_reg is not None and not is_save_step and not is_sample_step:
                         try:
-                            with self.timer('get_batch:reg'):
-                                batch = next(dataloader_iterator_reg)
+                            batch = self.next_batch(dataloader_iterator_reg, 'get_batch:reg')
                         except StopIteration:
                             with self.timer('reset_batch:reg'):
                                 # hit the end of an epoch, reset
                                 if self.progress_bar is not None:
                                     self.progress_bar.pause()
+                                self.close_prefetcher(dataloader_iterator_reg)
                                 dataloader_iterator_reg = iter(dataloader_reg)
                                 trigger_dataloader_setup_epoch(dataloader_reg)
+                                # only start fetching once the new epoch is set up
+                                dataloader_iterator_reg = self.prefetch_batches(dataloader_iterator_reg)
 
-                            with self.timer('get_batch:reg'):
-                                batch = next(dataloader_iterator_reg)
+                            batch = self.next_batch(dataloader_iterator_reg, 'get_batch:reg')
                             if self.progress_bar is not None:
                                 self.progress_bar.unpause()
                         is_reg_step = True
                     elif dataloader is not None:
                         try:
-                            with self.timer('get_batch'):
-                                batch = next(dataloader_iterator)
+                            batch = self.next_batch(dataloader_iterator, 'get_batch')
                         except StopIteration:
                             with self.timer('reset_batch'):
                                 # hit the end of an epoch, reset
                                 if self.progress_bar is not None:
                                     self.progress_bar.pause()
+                                self.close_prefetcher(dataloader_iterator)
                                 dataloader_iterator = iter(dataloader)
                                 trigger_dataloader_setup_epoch(dataloader)
+                                # only start fetching once the new epoch is set up
+                                dataloader_iterator = self.prefetch_batches(dataloader_iterator)
                                 self.epoch_num += 1
                                 if self.train_config.gradient_accumulation_steps == -1:
                                     # if we are accumulating for an entire epoch, trigger a step
                                     self.is_grad_accumulation_step = False
                                     self.grad_accumulation_step = 0
-                            with self.timer('get_batch'):
-                                batch = next(dataloader_iterator)
+                            batch = self.next_batch(dataloader_iterator, 'get_batch')
                             if self.progress_bar is not None:
                                 self.progress_bar.unpause()
                     else:
@@ -2237,7 +2366,8 @@ class BaseSDTrainProcess(BaseTrainProcess):
                         if self.progress_bar is not None:
                             self.progress_bar.pause()
                         print_acc(f"\nSaving at step {self.step_num}")
-                        self.save(self.step_num)
+                        with self.timer('save'):
+                            self.save(self.step_num)
                         self.ensure_params_requires_grad()
                         # clear any grads
                         optimizer.zero_grad()
@@ -2253,7 +2383,8 @@ class BaseSDTrainProcess(BaseTrainProcess):
                         # print above the progress bar
                         if self.train_config.free_u:
                             self.sd.pipeline.disable_freeu()
-                        self.sample(self.step_num)
+                        with self.timer('sample'):
+                            self.sample(self.step_num)
                         if self.train_config.unload_text_encoder:
                             # make sure the text encoder is unloaded
                             self.sd.text_encoder_to('cpu')
@@ -2302,6 +2433,14 @@ class BaseSDTrainProcess(BaseTrainProcess):
                             self.progress_bar.pause()
                         # print the timers and clear them
                         self.timer.print()
+                        self.print_prefetch_overlap()
+                        if self.accelerator.is_main_process:
+                            if self.performance_log_jsonl is not None:
+                                self.timer.write_jsonl(self.performance_log_jsonl, step=self.step_num)
+                            if self.performance_prometheus_path is not None:
+                                self.timer.write_prometheus(self.performance_prometheus_path)
+                            if self.writer is not None:
+                                self.timer.log_to_tensorboard(self.writer, self.step_num)
                         self.timer.reset()
                         if self.progress_bar is not None:
                             self.progress_bar.unpause()
@@ -2327,6 +2466,8 @@ class BaseSDTrainProcess(BaseTrainProcess):
         ###################################################################
         ##  END TRAIN LOOP
         ###################################################################
+        self.close_prefetcher(dataloader_iterator)
+        self.close_prefetcher(dataloader_iterator_reg)
         self.accelerator.wait_for_everyone()
         if self.progress_bar is not None:
             self.progress_bar.close()
@@ -2338,6 +2479,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
         print_acc("")
         if self.accelerator.is_main_process:
             self.save()
+            self.wait_for_saves()
             self.logger.finish()
         self.accelerator.end_training()
 
@@ -11,6 +11,8 @@ class Settings:
     dataset_root: str
     bind_host: str
     bind_port: int
+    sync_concurrency: int
+    max_concurrent_syncs: int
 
     def __init__(self) -> None:
         self.r2_endpoint = os.environ.get("R2_ENDPOINT", "").rstrip("/")
@@ -22,6 +24,10 @@ class Settings:
         )
         self.bind_host = os.environ.get("R2_SYNC_BIND_HOST", "0.0.0.0")
         self.bind_port = int(os.environ.get("R2_SYNC_BIND_PORT", "8080"))
+        # concurrent object downloads per dataset sync
+        self.sync_concurrency = int(os.environ.get("R2_SYNC_CONCURRENCY", "16"))
+        # datasets synced at the same time, more requests wait in the queue
+        self.max_concurrent_syncs = int(os.environ.get("R2_SYNC_MAX_JOBS", "2"))
 
         if not self.r2_endpoint:
             raise RuntimeError("R2_ENDPOINT is required for the sync worker")
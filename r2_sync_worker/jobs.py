@@ -0,0 +1,150 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from typing import Deque, Dict, List, Optional, Tuple
+
+from .config import get_settings
+from .sync import get_sync_progress, sync_dataset
+
+# finished jobs kept around for polling, the oldest are dropped first
+MAX_FINISHED_JOBS = 500
+
+ACTIVE_STATES = ("queued", "running")
+
+
+class SyncJob:
+    def __init__(self, dataset_id: str, bucket: str, prefix: str, overwrite: bool):
+        self.job_id = uuid.uuid4().hex
+        self.dataset_id = dataset_id
+        self.bucket = bucket
+        self.prefix = prefix
+        self.overwrite = overwrite
+        self.status = "queued"
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.result: Optional[dict] = None
+        self.error: Optional[str] = None
+        # resolved when the job finishes, a follow-up job has one before it is handed to the pool
+        self.future: Future = Future()
+
+    @property
+    def is_active(self) -> bool:
+        return self.status in ACTIVE_STATES
+
+    def matches(self, bucket: str, prefix: str, overwrite: bool) -> bool:
+        return self.bucket == bucket and self.prefix == prefix and self.overwrite == overwrite
+
+    def to_dict(self) -> dict:
+        progress = None
+        bytes_per_sec = None
+        if self.started_at is not None:
+            progress = get_sync_progress(self.dataset_id)
+            if progress is not None and progress.get("startedAt", 0) < self.started_at:
+                # left over from an earlier sync of the same dataset
+                progress = None
+            end = self.finished_at if self.finished_at is not None else time.time()
+            if progress is not None and end > self.started_at:
+                bytes_per_sec = progress.get("bytesWritten", 0) / (end - self.started_at)
+        return {
+            "jobId": self.job_id,
+            "datasetId": self.dataset_id,
+            "bucket": self.bucket,
+            "prefix": self.prefix,
+            "overwrite": self.overwrite,
+            "status": self.status,
+            "createdAt": self.created_at,
+            "startedAt": self.started_at,
+            "finishedAt": self.finished_at,
+            "progress": progress,
+            "bytesPerSec": bytes_per_sec,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class SyncJobManager:
+    """
+    Runs dataset syncs on a worker pool of max_concurrent_jobs threads, off the event loop.
+    Syncs of the same dataset run one after the other, so two syncs never write the same folder
+    at the same time. A request matching the last queued or running sync of its dataset, same
+    bucket, prefix and overwrite, gets that job back. Any other request is queued to run after it.
+    """
+
+    def __init__(self, max_concurrent_jobs: int):
+        self.executor = ThreadPoolExecutor(max_workers=max(1, max_concurrent_jobs), thread_name_prefix="sync_job")
+        self._lock = threading.Lock()
+        self._jobs: "OrderedDict[str, SyncJob]" = OrderedDict()
+        # queued and running jobs of every dataset in order, only the first one is on the pool
+        self._queues: Dict[str, Deque[SyncJob]] = {}
+
+    def submit(self, *, dataset_id: str, bucket: str, prefix: str, overwrite: bool = False) -> Tuple[SyncJob, bool]:
+        """Queues a sync, returns (job, deduplicated)."""
+        with self._lock:
+            queue = self._queues.setdefault(dataset_id, deque())
+            if len(queue) > 0 and queue[-1].matches(bucket, prefix, overwrite):
+                return queue[-1], True
+            job = SyncJob(dataset_id, bucket, prefix, overwrite)
+            self._jobs[job.job_id] = job
+            queue.append(job)
+            self._prune()
+            if len(queue) == 1:
+                self.executor.submit(self._run, job)
+            return job, False
+
+    def _run(self, job: SyncJob) -> None:
+        with self._lock:
+            job.status = "running"
+            job.started_at = time.time()
+        result = None
+        error = None
+        try:
+            result = sync_dataset(
+                dataset_id=job.dataset_id,
+                bucket=job.bucket,
+                prefix=job.prefix,
+                overwrite=job.overwrite,
+            )
+        except Exception as exc:
+            error = str(exc)
+        finally:
+            # finish and start the next job of the dataset together, so a new request never gets
+            # a finished job back
+            with self._lock:
+                job.result = result
+                job.error = error
+                job.status = "failed" if error is not None or result is None else "completed"
+                job.finished_at = time.time()
+                queue = self._queues[job.dataset_id]
+                queue.popleft()
+                if len(queue) > 0:
+                    self.executor.submit(self._run, queue[0])
+                else:
+                    del self._queues[job.dataset_id]
+            job.future.set_result(None)
+
+    def _prune(self) -> None:
+        finished = [job_id for job_id, job in self._jobs.items() if not job.is_active]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[job_id]
+
+    def get(self, job_id: str) -> Optional[SyncJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def get_active(self, dataset_id: str) -> Optional[SyncJob]:
+        with self._lock:
+            queue = self._queues.get(dataset_id)
+            return queue[0] if queue else None
+
+    def list_jobs(self, dataset_id: Optional[str] = None) -> List[SyncJob]:
+        with self._lock:
+            return [job for job in self._jobs.values() if dataset_id is None or job.dataset_id == dataset_id]
+
+
+@lru_cache
+def get_job_manager() -> SyncJobManager:
+    return SyncJobManager(get_settings().max_concurrent_syncs)
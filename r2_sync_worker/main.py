@@ -1,8 +1,17 @@
+import asyncio
+import json
+from typing import Optional
+
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
 
 from .config import get_settings
-from .sync import SyncError, dataset_status, sync_dataset
+from .jobs import get_job_manager
+from .sync import dataset_status, get_sync_progress
+
+# how often a streamed job sends an update
+STREAM_INTERVAL_SECONDS = 1.0
 
 
 class SyncDatasetBody(BaseModel):
@@ -10,6 +19,8 @@ class SyncDatasetBody(BaseModel):
     bucket: str
     prefix: str
     overwrite: bool = False
+    # wait for the sync and return its stats, otherwise return the queued job right away
+    wait: bool = True
 
     class Config:
         populate_by_name = True
@@ -30,24 +41,68 @@ async def healthcheck():
 @app.get("/dataset-status/{dataset_id}")
 async def get_dataset_status(dataset_id: str):
     local_path = dataset_status(dataset_id)
-    if not local_path:
+    progress = get_sync_progress(dataset_id)
+    if not local_path and progress is None:
         raise HTTPException(status_code=404, detail="Dataset not synced yet")
-    return {"ok": True, "datasetId": dataset_id, "localPath": local_path}
+    job = get_job_manager().get_active(dataset_id)
+    return {
+        "ok": True,
+        "datasetId": dataset_id,
+        "localPath": local_path,
+        "synced": local_path is not None,
+        "progress": progress,
+        "jobId": job.job_id if job is not None else None,
+    }
 
 
 @app.post("/sync-dataset")
 async def sync_dataset_endpoint(body: SyncDatasetBody):
-    try:
-        stats = sync_dataset(
-            dataset_id=body.dataset_id,
-            bucket=body.bucket,
-            prefix=body.prefix,
-            overwrite=body.overwrite,
-        )
-    except SyncError as exc:
-        raise HTTPException(status_code=500, detail=str(exc)) from exc
+    job, deduplicated = get_job_manager().submit(
+        dataset_id=body.dataset_id,
+        bucket=body.bucket,
+        prefix=body.prefix,
+        overwrite=body.overwrite,
+    )
+    if not body.wait:
+        return {"ok": True, "deduplicated": deduplicated, "job": job.to_dict()}
+
+    # the sync runs on the job pool, the event loop only waits for it
+    await asyncio.wrap_future(job.future)
+    if job.status == "failed":
+        raise HTTPException(status_code=500, detail=job.error)
+    return {"ok": True, "jobId": job.job_id, "deduplicated": deduplicated, **job.result}
+
 
-    return {"ok": True, **stats}
+@app.get("/jobs")
+async def list_jobs(dataset_id: Optional[str] = None):
+    jobs = get_job_manager().list_jobs(dataset_id)
+    return {"ok": True, "jobs": [job.to_dict() for job in jobs]}
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = get_job_manager().get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return {"ok": True, "job": job.to_dict()}
+
+
+@app.get("/jobs/{job_id}/stream")
+async def stream_job(job_id: str):
+    job = get_job_manager().get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    async def events():
+        # server sent events with the job state, the last one is sent once the job finished
+        while True:
+            is_active = job.is_active
+            yield f"data: {json.dumps(job.to_dict())}\n\n"
+            if not is_active:
+                return
+            await asyncio.sleep(STREAM_INTERVAL_SECONDS)
+
+    return StreamingResponse(events(), media_type="text/event-stream")
 
 
 def run():
@@ -64,4 +119,3 @@ def run():
 
 if __name__ == "__main__":
     run()
-
@@ -1,18 +1,42 @@
+import json
 import os
-import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
-from typing import Optional
+from typing import Dict, Optional
 
 import boto3
+from boto3.s3.transfer import TransferConfig
 from botocore.client import Config
 
 from .config import get_settings
 
+COMPLETE_MARKER = ".sync_complete"
+IN_PROGRESS_MARKER = ".sync_in_progress"
+# etag and size of every object written so far, lets an interrupted or repeated sync skip unchanged objects
+MANIFEST_FILE = ".sync_manifest.json"
+META_FILES = {COMPLETE_MARKER, IN_PROGRESS_MARKER, MANIFEST_FILE}
+# the manifest is rewritten after this many finished downloads so a killed sync loses little
+MANIFEST_SAVE_EVERY = 200
+# dataset files a sync from before the manifest may have written, see _find_unmanifested_files
+DATASET_FILE_EXTS = {
+    ".jpg", ".jpeg", ".png", ".webp", ".bmp", ".gif", ".tif", ".tiff",
+    ".mp4", ".mov", ".avi", ".webm", ".mkv",
+    ".txt", ".caption", ".json",
+}
+
 
 class SyncError(Exception):
     """Raised when the worker fails to mirror a dataset."""
 
 
+# progress of running and finished syncs by dataset id, read by /dataset-status
+_progress: Dict[str, dict] = {}
+_progress_lock = threading.Lock()
+
+
 def _build_s3_client():
     settings = get_settings()
     return boto3.client(
@@ -21,7 +45,11 @@ def _build_s3_client():
         region_name=settings.r2_region,
         aws_access_key_id=settings.r2_access_key_id,
         aws_secret_access_key=settings.r2_secret_access_key,
-        config=Config(signature_version="s3v4"),
+        # one connection per download worker, the default pool of 10 would throttle them
+        config=Config(
+            signature_version="s3v4",
+            max_pool_connections=max(10, settings.sync_concurrency),
+        ),
     )
 
 
@@ -32,18 +60,137 @@ def _normalize_prefix(prefix: str) -> str:
     return prefix
 
 
+def _update_progress(dataset_id: str, **values) -> None:
+    with _progress_lock:
+        _progress.setdefault(dataset_id, {}).update(values)
+
+
+def _add_progress(dataset_id: str, **values) -> None:
+    with _progress_lock:
+        progress = _progress.setdefault(dataset_id, {})
+        for key, value in values.items():
+            progress[key] = progress.get(key, 0) + value
+
+
+def get_sync_progress(dataset_id: str) -> Optional[dict]:
+    with _progress_lock:
+        progress = _progress.get(dataset_id)
+        return dict(progress) if progress is not None else None
+
+
+def _load_manifest(local_path: Path) -> Dict[str, dict]:
+    try:
+        with open(local_path / MANIFEST_FILE, "r") as f:
+            manifest = json.load(f)
+        return manifest.get("objects", {})
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_manifest(local_path: Path, objects: Dict[str, dict]) -> None:
+    # write to a temp file and rename so a killed sync never leaves a partial manifest behind
+    path = local_path / MANIFEST_FILE
+    tmp_path = local_path / f"{MANIFEST_FILE}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"objects": objects}, f)
+    os.replace(tmp_path, path)
+
+
+def _list_objects(client, bucket: str, prefix: str) -> Dict[str, dict]:
+    # relative path -> object info for every object under the prefix
+    remote = {}
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            key = obj["Key"]
+            if key.endswith("/"):
+                continue
+            rel_key = key[len(prefix):].lstrip("/")
+            if not rel_key or rel_key in META_FILES:
+                continue
+            remote[rel_key] = {
+                "key": key,
+                "etag": obj.get("ETag", "").strip('"'),
+                "size": obj.get("Size", 0),
+            }
+    return remote
+
+
+def _is_unchanged(local_path: Path, rel_key: str, obj: dict, manifest: Dict[str, dict]) -> bool:
+    entry = manifest.get(rel_key)
+    if entry is None or entry.get("etag") != obj["etag"] or entry.get("size") != obj["size"]:
+        return False
+    try:
+        return (local_path / rel_key).stat().st_size == obj["size"]
+    except OSError:
+        return False
+
+
+def _download_object(client, bucket: str, key: str, dest: Path, transfer_config: TransferConfig) -> None:
+    # download next to the destination and rename, so a file is either complete or not there
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = dest.with_name(f".{dest.name}.{uuid.uuid4().hex}.part")
+    try:
+        client.download_file(bucket, key, str(tmp_path), Config=transfer_config)
+        os.replace(tmp_path, dest)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink(missing_ok=True)
+
+
+def _find_unmanifested_files(local_path: Path, remote: Dict[str, dict]) -> list:
+    # a dataset synced before the manifest existed has no record of what the sync wrote. Images,
+    # videos and captions that are not in the bucket anymore are treated as stale, caches and other
+    # folders made locally start with _ or . and are left alone
+    stale = []
+    for root, dirs, files in os.walk(local_path):
+        dirs[:] = [d for d in dirs if not d.startswith(("_", "."))]
+        for file in files:
+            if file.startswith(".") or file in META_FILES:
+                continue
+            if os.path.splitext(file)[1].lower() not in DATASET_FILE_EXTS:
+                continue
+            rel_key = Path(root, file).relative_to(local_path).as_posix()
+            if rel_key not in remote:
+                stale.append(rel_key)
+    return stale
+
+
+def _remove_empty_dirs(local_path: Path, rel_key: str) -> None:
+    parent = (local_path / rel_key).parent
+    while parent != local_path:
+        try:
+            parent.rmdir()
+        except OSError:
+            return
+        parent = parent.parent
+
+
 def sync_dataset(
     *,
     dataset_id: str,
     bucket: str,
     prefix: str,
     overwrite: bool = False,
+    client=None,
+    concurrency: Optional[int] = None,
 ) -> dict:
+    """
+    Mirrors bucket/prefix into the dataset folder. Objects whose etag and size match the manifest
+    from an earlier or interrupted sync are skipped, the rest are downloaded concurrently. With
+    overwrite, a complete dataset is brought up to date the same way, and objects removed from the
+    bucket are deleted locally. Files the sync did not write, like latent caches, are never touched.
+    A dataset synced before the manifest existed is cleaned up once by _find_unmanifested_files.
+    """
     settings = get_settings()
-    client = _build_s3_client()
+    if client is None:
+        client = _build_s3_client()
+    if concurrency is None:
+        concurrency = settings.sync_concurrency
+    concurrency = max(1, concurrency)
     dataset_root = Path(settings.dataset_root)
     local_path = dataset_root / dataset_id
-    marker_file = local_path / ".sync_complete"
+    marker_file = local_path / COMPLETE_MARKER
     if marker_file.exists() and not overwrite:
         return {
             "datasetId": dataset_id,
@@ -51,37 +198,125 @@ def sync_dataset(
             "alreadySynced": True,
             "bytesWritten": 0,
             "objectCount": 0,
+            "objectsSkipped": 0,
+            "objectsDeleted": 0,
         }
 
-    if local_path.exists() and overwrite:
-        shutil.rmtree(local_path)
+    # before the manifest, overwrite cleared the folder. Those datasets are cleaned up once from the
+    # listing instead, after this sync the manifest tracks what was written
+    unmanifested = overwrite and local_path.exists() and not (local_path / MANIFEST_FILE).exists()
     local_path.mkdir(parents=True, exist_ok=True)
+    temp_marker = local_path / IN_PROGRESS_MARKER
+    temp_marker.write_text("syncing\n")
+    # the folder is changing, it is not a complete dataset until this sync finishes
+    marker_file.unlink(missing_ok=True)
 
     prefix = _normalize_prefix(prefix)
-    paginator = client.get_paginator("list_objects_v2")
-    bytes_written = 0
-    object_count = 0
+    start_time = time.time()
+    with _progress_lock:
+        _progress[dataset_id] = {
+            "state": "listing",
+            "startedAt": start_time,
+            "objectsTotal": 0,
+            "bytesTotal": 0,
+            "objectsDone": 0,
+            "objectsSkipped": 0,
+            "objectsDeleted": 0,
+            "bytesWritten": 0,
+            "error": None,
+        }
 
-    temp_marker = local_path / ".sync_in_progress"
-    temp_marker.write_text("syncing\n")
+    manifest = _load_manifest(local_path)
+    # tiny objects are fetched in one request, the pool supplies the concurrency
+    transfer_config = TransferConfig(use_threads=False)
 
     try:
-        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
-            for obj in page.get("Contents", []):
-                key = obj["Key"]
-                if key.endswith("/"):
-                    continue
-                rel_key = key[len(prefix) :].lstrip("/")
-                if not rel_key:
-                    continue
-                dest = local_path / rel_key
-                dest.parent.mkdir(parents=True, exist_ok=True)
-                client.download_file(bucket, key, str(dest))
-                bytes_written += obj.get("Size", 0)
-                object_count += 1
+        remote = _list_objects(client, bucket, prefix)
+        to_download = {}
+        skipped = 0
+        for rel_key, obj in remote.items():
+            if _is_unchanged(local_path, rel_key, obj, manifest):
+                skipped += 1
+            else:
+                to_download[rel_key] = obj
+        _update_progress(
+            dataset_id,
+            state="syncing",
+            objectsTotal=len(remote),
+            bytesTotal=sum(obj["size"] for obj in remote.values()),
+            objectsSkipped=skipped,
+        )
+
+        # only files an earlier sync wrote are removed, anything else in the folder was made locally
+        deleted = 0
+        for rel_key in list(manifest.keys()):
+            if rel_key in remote:
+                continue
+            (local_path / rel_key).unlink(missing_ok=True)
+            _remove_empty_dirs(local_path, rel_key)
+            del manifest[rel_key]
+            deleted += 1
+        if unmanifested:
+            for rel_key in _find_unmanifested_files(local_path, remote):
+                (local_path / rel_key).unlink(missing_ok=True)
+                _remove_empty_dirs(local_path, rel_key)
+                deleted += 1
+        if deleted > 0:
+            _save_manifest(local_path, manifest)
+            _update_progress(dataset_id, objectsDeleted=deleted)
 
+        bytes_written = 0
+        object_count = 0
+        since_save = 0
+        pending = {}
+        download_error = None
+        items = iter(to_download.items())
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="r2_sync") as executor:
+            # keep a bounded window of downloads in flight instead of queueing every object at once.
+            # After a failure nothing new is started, but the downloads in flight still finish and are
+            # recorded so the next sync does not fetch them again
+            while True:
+                while download_error is None and len(pending) < concurrency * 2:
+                    item = next(items, None)
+                    if item is None:
+                        break
+                    rel_key, obj = item
+                    future = executor.submit(
+                        _download_object, client, bucket, obj["key"], local_path / rel_key, transfer_config
+                    )
+                    pending[future] = (rel_key, obj)
+                if len(pending) == 0:
+                    break
+                done, _ = wait(list(pending.keys()), return_when=FIRST_COMPLETED)
+                for future in done:
+                    rel_key, obj = pending.pop(future)
+                    try:
+                        future.result()
+                    except Exception as exc:
+                        if download_error is None:
+                            download_error = exc
+                        continue
+                    manifest[rel_key] = {"etag": obj["etag"], "size": obj["size"]}
+                    bytes_written += obj["size"]
+                    object_count += 1
+                    since_save += 1
+                    _add_progress(dataset_id, objectsDone=1, bytesWritten=obj["size"])
+                if since_save >= MANIFEST_SAVE_EVERY:
+                    _save_manifest(local_path, manifest)
+                    since_save = 0
+        if download_error is not None:
+            raise download_error
+
+        _save_manifest(local_path, manifest)
         marker_file.write_text("complete\n")
+        _update_progress(dataset_id, state="complete", finishedAt=time.time())
     except Exception as exc:  # pragma: no cover - defensive logging
+        # keep what finished, the next sync resumes from it
+        try:
+            _save_manifest(local_path, manifest)
+        except OSError:
+            pass
+        _update_progress(dataset_id, state="failed", error=str(exc), finishedAt=time.time())
         raise SyncError(str(exc)) from exc
     finally:
         if temp_marker.exists():
@@ -93,14 +328,15 @@ def sync_dataset(
         "alreadySynced": False,
         "bytesWritten": bytes_written,
         "objectCount": object_count,
+        "objectsSkipped": skipped,
+        "objectsDeleted": deleted,
     }
 
 
 def dataset_status(dataset_id: str) -> Optional[str]:
     settings = get_settings()
     local_path = Path(settings.dataset_root) / dataset_id
-    marker = local_path / ".sync_complete"
+    marker = local_path / COMPLETE_MARKER
     if marker.exists():
         return str(local_path)
     return None
-
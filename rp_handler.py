@@ -2,6 +2,8 @@ import os
 import sys
 import tempfile
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Dict, List, Optional
 
 import runpod
@@ -177,44 +179,133 @@ def _sync_from_r2(dataset_id: str, bucket: str, prefix: str) -> str:
         raise RuntimeError(f"R2 sync failed: {e}") from e
 
 
-def _upload_to_r2(local_dir: str, bucket: str, r2_prefix: str) -> List[str]:
-    """
-    Upload all files from a local directory to R2.
-    Returns a list of R2 keys that were uploaded.
-    """
-    try:
-        from botocore.exceptions import ClientError
-    except ImportError:
-        raise RuntimeError("botocore is required for R2 upload but not installed")
+def _get_transfer_config():
+    """Multipart settings for uploads, large checkpoints are sent in concurrent parts."""
+    from boto3.s3.transfer import TransferConfig
 
-    if not os.path.exists(local_dir):
-        print_acc(f"Upload skipped: directory {local_dir} does not exist")
-        return []
+    part_size = int(os.environ.get("R2_UPLOAD_PART_MB", "64")) * 1024 * 1024
+    return TransferConfig(
+        multipart_threshold=part_size,
+        multipart_chunksize=part_size,
+        max_concurrency=int(os.environ.get("R2_UPLOAD_PART_CONCURRENCY", "8")),
+        use_threads=True,
+    )
 
-    s3_client = _get_r2_client()
-    uploaded_keys = []
 
-    print_acc(f"Uploading outputs from {local_dir} to R2 bucket {bucket}, prefix {r2_prefix}")
+class R2OutputUploader:
+    """
+    Uploads the files in a set of local directories to R2 while training runs.
 
-    try:
-        # Walk the directory tree and upload all files
-        for root, dirs, files in os.walk(local_dir):
-            for file in files:
-                local_file = os.path.join(root, file)
-                # Compute relative path from local_dir
-                rel_path = os.path.relpath(local_file, local_dir)
-                # Build R2 key
-                r2_key = f"{r2_prefix}/{rel_path}".replace("\\", "/")  # Normalize Windows paths
-
-                print_acc(f"  Uploading {rel_path} -> {r2_key}")
-                s3_client.upload_file(local_file, bucket, r2_key)
-                uploaded_keys.append(r2_key)
-
-        print_acc(f"Uploaded {len(uploaded_keys)} files to R2")
-        return uploaded_keys
+    A background thread scans the directories every poll_interval seconds. A file is uploaded once its
+    size and mtime did not change between two scans, so files that are still being written are left for
+    the next scan. Files are uploaded concurrently, large ones as multipart uploads, and a file is only
+    uploaded again if it changed since. finish() stops the scans and uploads everything that is left.
+    """
 
-    except ClientError as e:
-        raise RuntimeError(f"R2 upload failed: {e}") from e
+    def __init__(self, bucket: str, dirs: Dict[str, str], poll_interval: Optional[float] = None, max_workers: Optional[int] = None):
+        # dirs maps a local directory to the R2 prefix it is uploaded to
+        self.bucket = bucket
+        self.dirs = dirs
+        if poll_interval is None:
+            poll_interval = float(os.environ.get("R2_UPLOAD_POLL_SECONDS", "15"))
+        if max_workers is None:
+            max_workers = int(os.environ.get("R2_UPLOAD_CONCURRENCY", "4"))
+        self.poll_interval = poll_interval
+        self.s3_client = _get_r2_client()
+        self.transfer_config = _get_transfer_config()
+        self.executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="r2_upload")
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        # local file -> (size, mtime) seen on the last scan
+        self._last_seen: Dict[str, tuple] = {}
+        # local file -> (size, mtime) that was uploaded or is being uploaded
+        self._uploaded: Dict[str, tuple] = {}
+        self._keys: Dict[str, str] = {}
+        self._futures: List[Any] = []
+        self._errors: List[str] = []
+
+    def start(self) -> "R2OutputUploader":
+        self._thread = threading.Thread(target=self._watch, name="r2_upload_watch", daemon=True)
+        self._thread.start()
+        return self
+
+    def _watch(self) -> None:
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self._scan(require_stable=True)
+            except Exception as err:  # pragma: no cover - best effort, the final flush retries
+                print_acc(f"R2 upload scan failed: {err}")
+
+    def _scan(self, require_stable: bool) -> None:
+        for local_dir, r2_prefix in self.dirs.items():
+            if not os.path.exists(local_dir):
+                continue
+            for root, dirs, files in os.walk(local_dir):
+                for file in files:
+                    # temp files of in progress writes are renamed when they are done
+                    if file.endswith(".tmp") or file.endswith(".part"):
+                        continue
+                    local_file = os.path.join(root, file)
+                    try:
+                        stat = os.stat(local_file)
+                    except OSError:
+                        continue
+                    signature = (stat.st_size, stat.st_mtime_ns)
+                    previous = self._last_seen.get(local_file)
+                    self._last_seen[local_file] = signature
+                    if require_stable and previous != signature:
+                        continue
+                    with self._lock:
+                        if self._uploaded.get(local_file) == signature:
+                            continue
+                        self._uploaded[local_file] = signature
+                    rel_path = os.path.relpath(local_file, local_dir)
+                    # Normalize Windows paths
+                    r2_key = f"{r2_prefix}/{rel_path}".replace("\\", "/")
+                    self._futures.append(self.executor.submit(self._upload, local_file, r2_key, signature))
+
+    def _upload(self, local_file: str, r2_key: str, signature: tuple) -> None:
+        try:
+            print_acc(f"  Uploading {local_file} -> {r2_key}")
+            self.s3_client.upload_file(local_file, self.bucket, r2_key, Config=self.transfer_config)
+            with self._lock:
+                self._keys[local_file] = r2_key
+        except Exception as err:
+            with self._lock:
+                # let the next scan try again
+                if self._uploaded.get(local_file) == signature:
+                    del self._uploaded[local_file]
+                self._errors.append(f"{local_file}: {err}")
+
+    def finish(self) -> Dict[str, List[str]]:
+        """Stops watching, uploads what is left and returns the uploaded keys of every directory."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        # training is over, nothing is being written anymore
+        self._errors = []
+        self._scan(require_stable=False)
+        for future in self._futures:
+            future.result()
+        self.executor.shutdown(wait=True)
+        if len(self._errors) > 0:
+            raise RuntimeError(f"R2 upload failed: {'; '.join(self._errors)}")
+
+        # files removed during training, like rotated out checkpoints, are removed from R2 as well. Only
+        # objects this uploader wrote for files its scans saw are deleted, nothing else under the prefixes
+        keys: Dict[str, List[str]] = {local_dir: [] for local_dir in self.dirs}
+        for local_file, r2_key in sorted(self._keys.items()):
+            if not os.path.exists(local_file):
+                if local_file in self._last_seen:
+                    print_acc(f"  Deleting {r2_key}, {local_file} was removed")
+                    self.s3_client.delete_object(Bucket=self.bucket, Key=r2_key)
+                continue
+            for local_dir in self.dirs:
+                if os.path.commonpath([local_dir, local_file]) == local_dir:
+                    keys[local_dir].append(r2_key)
+        print_acc(f"Uploaded {sum(len(v) for v in keys.values())} files to R2")
+        return keys
 
 
 def run_jobs(
@@ -350,46 +441,52 @@ def handler(event: Dict[str, Any]) -> Dict[str, Any]:
                 json.dump(job_config, f, indent=2)
                 temp_config_path = f.name
             
+            # Checkpoints and samples are uploaded while the job runs, so a preempted pod keeps them
+            runpod_job_id = event.get("id", "unknown")
+            output_root = os.environ.get("OUTPUT_ROOT", "/workspace/output")
+            job_output_dir = os.path.join(output_root, job_name)
+            checkpoints_dir = os.path.join(job_output_dir, "checkpoints")
+            samples_dir = os.path.join(job_output_dir, "samples")
+
             # Run the job with the temp config
             name = input_payload.get("name")
             recover = bool(input_payload.get("recover", False))
             log_file = input_payload.get("log")
-            
-            response = run_jobs(
-                config_file_list=[temp_config_path],
-                name=name,
-                recover=recover,
-                log_file=log_file,
-                dry_run=False,
-            )
-            
-            # Clean up temp file
+
+            uploader = None
             try:
-                os.unlink(temp_config_path)
-            except:
-                pass
-            
-            # Upload outputs to R2 if job completed successfully
-            checkpoint_keys = []
-            sample_keys = []
-            
-            if response.get("jobs_completed", 0) > 0:
-                runpod_job_id = event.get("id", "unknown")
-                output_root = os.environ.get("OUTPUT_ROOT", "/workspace/output")
-                job_output_dir = os.path.join(output_root, job_name)
-                
-                # Upload checkpoints
-                checkpoints_dir = os.path.join(job_output_dir, "checkpoints")
-                if os.path.exists(checkpoints_dir):
-                    r2_checkpoints_prefix = f"models/{dataset_id}/{runpod_job_id}/checkpoints"
-                    checkpoint_keys = _upload_to_r2(checkpoints_dir, bucket, r2_checkpoints_prefix)
-                
-                # Upload samples
-                samples_dir = os.path.join(job_output_dir, "samples")
-                if os.path.exists(samples_dir):
-                    r2_samples_prefix = f"models/{dataset_id}/{runpod_job_id}/samples"
-                    sample_keys = _upload_to_r2(samples_dir, bucket, r2_samples_prefix)
-            
+                # started in here so the temp config is removed if the R2 client can not be made
+                uploader = R2OutputUploader(bucket, {
+                    checkpoints_dir: f"models/{dataset_id}/{runpod_job_id}/checkpoints",
+                    samples_dir: f"models/{dataset_id}/{runpod_job_id}/samples",
+                }).start()
+                response = run_jobs(
+                    config_file_list=[temp_config_path],
+                    name=name,
+                    recover=recover,
+                    log_file=log_file,
+                    dry_run=False,
+                )
+            except BaseException:
+                # still upload what the job wrote, but report the job's error, not an upload error
+                if uploader is not None:
+                    try:
+                        uploader.finish()
+                    except Exception as upload_err:
+                        print_acc(f"R2 upload after the failed job also failed: {upload_err}")
+                raise
+            finally:
+                # Clean up temp file
+                try:
+                    os.unlink(temp_config_path)
+                except:
+                    pass
+            # short final flush of whatever the last scan did not pick up
+            uploaded_keys = uploader.finish()
+
+            checkpoint_keys = uploaded_keys[checkpoints_dir]
+            sample_keys = uploaded_keys[samples_dir]
+
             response["request_id"] = event.get("id")
             response["dataset_synced"] = {
                 "datasetId": dataset_id,
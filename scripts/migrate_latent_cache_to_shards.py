@@ -0,0 +1,60 @@
+import argparse
+import json
+import os
+import sys
+
+from safetensors import safe_open
+from tqdm import tqdm
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from toolkit.latent_shards import LatentShardStore
+
+parser = argparse.ArgumentParser(description='Convert a per file latent cache (_latent_cache/*.safetensors) to packed shards.')
+parser.add_argument("input_folder", type=str, help="Path to the dataset folder. All _latent_cache folders inside it are converted")
+parser.add_argument("--shard_size_mb", type=int, default=1024, help="Max size of each shard file")
+parser.add_argument("--delete", action='store_true', help="Delete the per file latents after they are migrated")
+
+args = parser.parse_args()
+
+# find all latent cache folders
+cache_dirs = []
+for root, dirs, _ in os.walk(args.input_folder):
+    if os.path.basename(root) == '_latent_cache':
+        cache_dirs.append(root)
+print(f"Found {len(cache_dirs)} latent cache folders")
+
+num_migrated = 0
+num_skipped = 0
+for cache_dir in cache_dirs:
+    store = LatentShardStore(cache_dir, shard_size_mb=args.shard_size_mb)
+    files = sorted([f for f in os.listdir(cache_dir) if f.endswith('.safetensors')])
+    for file in tqdm(files, desc=f"Migrating {cache_dir}"):
+        key = os.path.splitext(file)[0]
+        file_path = os.path.join(cache_dir, file)
+        if key not in store:
+            try:
+                with safe_open(file_path, framework="pt", device="cpu") as f:
+                    latent = f.get_tensor('latent')
+                    metadata = f.metadata() or {}
+            except Exception as e:
+                print(f"Error reading {file_path}: {e}")
+                num_skipped += 1
+                continue
+            # undo the safetensors string encoding of the latent info dict
+            info = {}
+            for meta_key, value in metadata.items():
+                if meta_key in ['software', 'format']:
+                    continue
+                try:
+                    info[meta_key] = json.loads(value)
+                except (json.JSONDecodeError, TypeError):
+                    info[meta_key] = value
+            store.write(key, latent, metadata=info)
+            num_migrated += 1
+        else:
+            num_skipped += 1
+        if args.delete:
+            os.remove(file_path)
+    store.close()
+
+print(f"Migrated {num_migrated} latents, skipped {num_skipped}")
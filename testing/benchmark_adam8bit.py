@@ -0,0 +1,123 @@
+import argparse
+import math
+import os
+import sys
+import time
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from toolkit.optimizers.adam8bit import Adam8bit
+from toolkit.optimizers.optimizer_utils import Auto8bitTensor, copy_stochastic_bf16
+
+# times an Adam8bit step on a set of lora shaped params against the previous per param implementation,
+# and checks how far both drift from a plain fp32 AdamW run on the same gradients
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--num_modules', type=int, default=200, help='number of lora modules, 2 params each')
+parser.add_argument('--dim', type=int, default=1024)
+parser.add_argument('--rank', type=int, default=16)
+parser.add_argument('--steps', type=int, default=20)
+parser.add_argument('--dtype', type=str, default='float32', choices=['float32', 'bfloat16'])
+parser.add_argument('--device', type=str, default='cpu')
+args = parser.parse_args()
+
+dtype = getattr(torch, args.dtype)
+
+
+class LegacyAdam8bit(torch.optim.Optimizer):
+    # the per param step from before, with its rounding inlined so it also runs on cpu
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0, decouple=True):
+        super().__init__(params, dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay, decouple=decouple))
+
+    @torch.no_grad()
+    def step(self):
+        for group in self.param_groups:
+            beta1, beta2 = group['betas']
+            lr = group['lr']
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                grad = p.grad.data.to(torch.float32)
+                p_fp32 = p.clone().to(torch.float32)
+                state = self.state[p]
+                if len(state) == 0:
+                    state['step'] = 0
+                    state['exp_avg'] = Auto8bitTensor(torch.zeros_like(p_fp32.data).detach())
+                    state['exp_avg_sq'] = Auto8bitTensor(torch.zeros_like(p_fp32.data).detach())
+                exp_avg = state['exp_avg'].to(torch.float32)
+                exp_avg_sq = state['exp_avg_sq'].to(torch.float32)
+                state['step'] += 1
+                bias_correction1 = 1 - beta1 ** state['step']
+                bias_correction2 = 1 - beta2 ** state['step']
+                exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+                exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+                if group['weight_decay'] != 0 and group['decouple']:
+                    p_fp32.data.mul_(1 - lr * group['weight_decay'])
+                denom = (exp_avg_sq.sqrt() / math.sqrt(bias_correction2)).add_(group['eps'])
+                p_fp32.data.addcdiv_(exp_avg, denom, value=-lr / bias_correction1)
+                state['exp_avg'] = Auto8bitTensor(exp_avg)
+                state['exp_avg_sq'] = Auto8bitTensor(exp_avg_sq)
+                if p.dtype == torch.bfloat16:
+                    copy_stochastic_bf16(p.data, p_fp32.data)
+                else:
+                    p.data.copy_(p_fp32.data)
+
+
+def make_params():
+    torch.manual_seed(0)
+    params = []
+    for _ in range(args.num_modules):
+        params.append(torch.nn.Parameter((torch.randn(args.rank, args.dim) * 0.01).to(args.device, dtype)))
+        params.append(torch.nn.Parameter((torch.randn(args.dim, args.rank) * 0.01).to(args.device, dtype)))
+    return params
+
+
+grads = []
+torch.manual_seed(1)
+for _ in range(args.steps):
+    # gradients with very different magnitudes per row, where one scale for a whole tensor loses precision
+    row_scale = torch.logspace(-4, -1, args.dim)
+    grads.append([
+        (torch.randn(args.rank, args.dim) * row_scale).to(args.device) if i % 2 == 0 else
+        (torch.randn(args.dim, args.rank) * row_scale.view(-1, 1)).to(args.device)
+        for i in range(args.num_modules * 2)
+    ])
+
+
+def run(optimizer_class):
+    params = make_params()
+    optimizer = optimizer_class(params, lr=1e-3, eps=1e-6)
+    times = []
+    for step_grads in grads:
+        for p, g in zip(params, step_grads):
+            p.grad = g.to(dtype)
+        if args.device.startswith('cuda'):
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        optimizer.step()
+        if args.device.startswith('cuda'):
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    # skip the first step, it allocates the state
+    return params, sum(times[1:]) / max(1, len(times) - 1)
+
+
+reference, _ = run(lambda params, **kwargs: torch.optim.AdamW(params, weight_decay=0, **kwargs))
+
+
+def drift(params):
+    diffs = [(p.float() - r.float()).norm() ** 2 for p, r in zip(params, reference)]
+    norms = [r.float().norm() ** 2 for r in reference]
+    return math.sqrt(sum(diffs) / sum(norms))
+
+
+legacy_params, legacy_time = run(LegacyAdam8bit)
+flat_params, flat_time = run(Adam8bit)
+
+num_params = sum(p.numel() for p in reference)
+print(f"{len(reference)} params, {num_params / 1e6:.1f}M values, {args.dtype} on {args.device}")
+print(f"per param (legacy):  {legacy_time * 1000:8.2f} ms/step   drift from fp32 AdamW {drift(legacy_params):.2e}")
+print(f"flat blockwise:      {flat_time * 1000:8.2f} ms/step   drift from fp32 AdamW {drift(flat_params):.2e}")
+print(f"speedup: {legacy_time / flat_time:.1f}x")
@@ -0,0 +1,104 @@
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from toolkit.ema import ExponentialMovingAverage
+from toolkit.optimizers.optimizer_utils import copy_stochastic
+
+# times an ema update on transformer shaped params against the previous per param loop,
+# and reports the peak extra memory of an update on cuda
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--num_layers', type=int, default=24)
+parser.add_argument('--dim', type=int, default=1024)
+parser.add_argument('--steps', type=int, default=20)
+parser.add_argument('--dtype', type=str, default='float32', choices=['float32', 'bfloat16'])
+parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+parser.add_argument('--update_every', type=int, default=1)
+parser.add_argument('--offload_to_cpu', action='store_true')
+args = parser.parse_args()
+
+dtype = getattr(torch, args.dtype)
+is_cuda = args.device.startswith('cuda')
+if not is_cuda and dtype != torch.float32:
+    # copy_stochastic in the old loop only runs on gpu
+    raise ValueError('bfloat16 needs a cuda device')
+
+
+def legacy_update(shadow_params, parameters, one_minus_decay):
+    # the per param update from before
+    with torch.no_grad():
+        for s_param, param in zip(shadow_params, parameters):
+            s_param_float = s_param.float()
+            param_float = param
+            if param.dtype != torch.float32:
+                param_float = param_float.to(torch.float32)
+            tmp = (s_param_float - param_float)
+            tmp.mul_(one_minus_decay)
+            s_param_float.sub_(tmp)
+            if s_param.dtype != torch.float32:
+                copy_stochastic(s_param, s_param_float)
+
+
+def make_params():
+    torch.manual_seed(0)
+    params = []
+    for _ in range(args.num_layers):
+        for shape in [(args.dim * 3, args.dim), (args.dim, args.dim), (args.dim * 4, args.dim), (args.dim, args.dim * 4),
+                      (args.dim,), (args.dim,)]:
+            params.append(torch.nn.Parameter(torch.randn(shape, device=args.device).to(dtype)))
+    return params
+
+
+def sync():
+    if is_cuda:
+        torch.cuda.synchronize()
+
+
+def run(name, update_fn, params):
+    times = []
+    peak = None
+    for step in range(args.steps):
+        with torch.no_grad():
+            for p in params:
+                p.add_(0.01)
+        sync()
+        if is_cuda:
+            torch.cuda.reset_peak_memory_stats()
+            base = torch.cuda.memory_allocated()
+        start = time.perf_counter()
+        update_fn()
+        sync()
+        times.append(time.perf_counter() - start)
+        if is_cuda:
+            step_peak = torch.cuda.max_memory_allocated() - base
+            peak = step_peak if peak is None else max(peak, step_peak)
+    # skip the first step, it allocates
+    avg = sum(times[1:]) / max(1, len(times) - 1)
+    peak_str = f"{peak / 1024 ** 2:8.1f} MB" if peak is not None else "n/a (cuda only)"
+    print(f"{name:<20} {avg * 1000:8.2f} ms/update   peak extra memory {peak_str}")
+    return avg
+
+
+params = make_params()
+num_values = sum(p.numel() for p in params)
+print(f"{len(params)} params, {num_values / 1e6:.1f}M values, {args.dtype} on {args.device}")
+
+shadow = [p.clone().detach() for p in params]
+legacy_time = run('per param (legacy)', lambda: legacy_update(shadow, params, 0.001), params)
+del shadow
+
+ema = ExponentialMovingAverage(
+    params, decay=0.999, update_every=args.update_every, offload_to_cpu=args.offload_to_cpu
+)
+fused_time = run('fused', ema.update, params)
+# time spent waiting on the last offloaded update
+start = time.perf_counter()
+ema.state_dict()
+print(f"final wait {(time.perf_counter() - start) * 1000:.2f} ms")
+print(f"speedup: {legacy_time / fused_time:.1f}x")
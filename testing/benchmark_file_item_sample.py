@@ -0,0 +1,67 @@
+import argparse
+import copy
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from toolkit.config_modules import DatasetConfig
+from toolkit.data_loader import AiToolkitDataset
+
+# measures the per item overhead of making a sample from a dataset file item,
+# the old deepcopy against FileItemDTO.get_sample, and the full item fetch with each
+
+parser = argparse.ArgumentParser()
+parser.add_argument('dataset_folder', type=str)
+parser.add_argument('--resolution', type=int, default=512)
+parser.add_argument('--iterations', type=int, default=2000)
+args = parser.parse_args()
+
+
+## make fake sd
+class FakeSD:
+    def __init__(self):
+        self.adapter = None
+        self.use_raw_control_images = False
+
+    def encode_control_in_text_embeddings(self, *args, **kwargs):
+        return None
+
+    def get_bucket_divisibility(self):
+        return 32
+
+
+dataset_config = DatasetConfig(
+    dataset_path=args.dataset_folder,
+    resolution=args.resolution,
+    default_caption='default',
+    buckets=True,
+)
+dataset = AiToolkitDataset(dataset_config, batch_size=1, sd=FakeSD())
+file_items = dataset.file_list
+
+
+def time_per_item(fn, iterations):
+    start = time.perf_counter()
+    for i in range(iterations):
+        fn(file_items[i % len(file_items)])
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def load_item(file_item):
+    file_item.load_and_process_image(dataset.transform)
+    file_item.load_caption(dataset.caption_dict)
+    file_item.cleanup()
+
+
+deepcopy_us = time_per_item(copy.deepcopy, args.iterations)
+sample_us = time_per_item(lambda x: x.get_sample(), args.iterations)
+# loading decodes images, so use fewer iterations
+load_iterations = max(1, min(args.iterations, len(file_items) * 2))
+deepcopy_load_us = time_per_item(lambda x: load_item(copy.deepcopy(x)), load_iterations)
+sample_load_us = time_per_item(lambda x: load_item(x.get_sample()), load_iterations)
+
+print(f"{len(file_items)} file items")
+print(f"copy only:      deepcopy {deepcopy_us:10.1f} us   get_sample {sample_us:10.1f} us   ({deepcopy_us / sample_us:.0f}x)")
+print(f"copy and load:  deepcopy {deepcopy_load_us:10.1f} us   get_sample {sample_load_us:10.1f} us")
@@ -0,0 +1,93 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from toolkit.config_modules import ModelConfig, GenerateImageConfig
+from toolkit.sampler import get_sampler
+from toolkit.util.get_model import get_model_class
+
+# times generate_images on a set of prompts with batch_size 1 against batch_size N on a model loaded
+# the way training loads it, and reports how far the batched samples drift from the ones generated alone
+# python testing/benchmark_sampling.py --model black-forest-labs/FLUX.1-schnell --arch flux
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--model', type=str, default='stable-diffusion-v1-5/stable-diffusion-v1-5')
+parser.add_argument('--arch', type=str, default=None)
+parser.add_argument('--num_prompts', type=int, default=8)
+parser.add_argument('--batch_size', type=int, default=4)
+parser.add_argument('--steps', type=int, default=20)
+parser.add_argument('--guidance_scale', type=float, default=4.0)
+parser.add_argument('--size', type=int, default=512)
+parser.add_argument('--dtype', type=str, default='float16', choices=['float16', 'bfloat16', 'float32'])
+args = parser.parse_args()
+
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+model_config = ModelConfig(name_or_path=args.model, arch=args.arch, dtype=args.dtype)
+ModelClass = get_model_class(model_config)
+if hasattr(ModelClass, 'get_train_scheduler'):
+    sampler = ModelClass.get_train_scheduler()
+else:
+    sampler = get_sampler('ddpm', {"prediction_type": "v_prediction" if model_config.is_v_pred else "epsilon"})
+sd = ModelClass(device=device, model_config=model_config, dtype=args.dtype, noise_scheduler=sampler)
+sd.load_model()
+
+prompts = [f"a photo of a cat, style {i}" for i in range(args.num_prompts)]
+output_root = tempfile.mkdtemp(prefix='benchmark_sampling_')
+
+
+def sync():
+    if device == 'cuda':
+        torch.cuda.synchronize()
+
+
+def run(batch_size):
+    output_folder = os.path.join(output_root, f'batch_{batch_size}')
+    image_configs = [
+        GenerateImageConfig(
+            prompt=prompt,
+            width=args.size,
+            height=args.size,
+            num_inference_steps=args.steps,
+            guidance_scale=args.guidance_scale,
+            seed=i,
+            output_folder=output_folder,
+            output_ext='png',
+        ) for i, prompt in enumerate(prompts)
+    ]
+    sync()
+    start = time.perf_counter()
+    sd.generate_images(image_configs, batch_size=batch_size)
+    sync()
+    elapsed = time.perf_counter() - start
+    paths = [config.get_image_path(i) for i, config in enumerate(image_configs)]
+    return paths, elapsed
+
+
+# warmup
+run(1)
+
+single_paths, single_time = run(1)
+if device == 'cuda':
+    torch.cuda.reset_peak_memory_stats()
+batched_paths, batched_time = run(args.batch_size)
+
+print(f"batch size 1: {single_time:.2f}s, {single_time / len(prompts):.3f}s per image")
+print(f"batch size {args.batch_size}: {batched_time:.2f}s, {batched_time / len(prompts):.3f}s per image")
+print(f"speedup: {single_time / batched_time:.2f}x")
+if device == 'cuda':
+    print(f"peak memory at batch size {args.batch_size}: {torch.cuda.max_memory_allocated() / 1024 ** 3:.2f} GB")
+
+max_diff = max(
+    np.abs(np.asarray(Image.open(a), dtype=np.float32) - np.asarray(Image.open(b), dtype=np.float32)).max()
+    for a, b in zip(single_paths, batched_paths)
+)
+print(f"max pixel difference from batching: {max_diff:.0f} / 255")
+print(f"samples saved to {output_root}")
@@ -0,0 +1,177 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# runs sync_dataset against a mocked s3 bucket: python -m unittest testing.test_r2_sync
+try:
+    import boto3
+    from moto import mock_aws
+except ImportError:
+    boto3 = None
+    mock_aws = None
+
+BUCKET = 'datasets'
+PREFIX = 'my-dataset'
+DATASET_ID = 'dataset-1'
+OBJECTS = {f'img_{i}.jpg': f'image {i}'.encode() for i in range(6)}
+OBJECTS['sub/img_6.txt'] = b'a caption'
+
+
+class FailingClient:
+    # passes everything to the real client, but the download after fail_after ones raises
+    def __init__(self, client, fail_after: int):
+        self.client = client
+        self.fail_after = fail_after
+        self.num_downloads = 0
+
+    def download_file(self, *args, **kwargs):
+        if self.num_downloads >= self.fail_after:
+            raise ConnectionError('connection reset')
+        self.num_downloads += 1
+        return self.client.download_file(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+@unittest.skipIf(mock_aws is None, 'moto is not installed')
+class TestSyncDataset(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.env = {
+            'R2_ENDPOINT': 'https://example.r2.cloudflarestorage.com',
+            'R2_ACCESS_KEY_ID': 'testing',
+            'R2_SECRET_ACCESS_KEY': 'testing',
+            'AITK_R2_DATASETS_ROOT': self.temp_dir.name,
+        }
+        self.old_env = {key: os.environ.get(key) for key in self.env}
+        os.environ.update(self.env)
+        from r2_sync_worker.config import get_settings
+        get_settings.cache_clear()
+
+        self.mock = mock_aws()
+        self.mock.start()
+        self.client = boto3.client('s3', region_name='us-east-1')
+        self.client.create_bucket(Bucket=BUCKET)
+        for key, body in OBJECTS.items():
+            self.put(key, body)
+        self.local_path = os.path.join(self.temp_dir.name, DATASET_ID)
+
+    def tearDown(self):
+        self.mock.stop()
+        for key, value in self.old_env.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+        from r2_sync_worker.config import get_settings
+        get_settings.cache_clear()
+        self.temp_dir.cleanup()
+
+    def put(self, key, body):
+        self.client.put_object(Bucket=BUCKET, Key=f'{PREFIX}/{key}', Body=body)
+
+    def sync(self, overwrite=False, client=None):
+        from r2_sync_worker.sync import sync_dataset
+        return sync_dataset(
+            dataset_id=DATASET_ID,
+            bucket=BUCKET,
+            prefix=PREFIX,
+            overwrite=overwrite,
+            client=client if client is not None else self.client,
+            concurrency=2,
+        )
+
+    def read(self, key):
+        with open(os.path.join(self.local_path, key), 'rb') as f:
+            return f.read()
+
+    def test_first_sync(self):
+        result = self.sync()
+        self.assertFalse(result['alreadySynced'])
+        self.assertEqual(result['objectCount'], len(OBJECTS))
+        self.assertEqual(result['bytesWritten'], sum(len(body) for body in OBJECTS.values()))
+        for key, body in OBJECTS.items():
+            self.assertEqual(self.read(key), body)
+        self.assertTrue(os.path.exists(os.path.join(self.local_path, '.sync_complete')))
+        self.assertFalse(os.path.exists(os.path.join(self.local_path, '.sync_in_progress')))
+
+    def test_unchanged_rerun_skips_everything(self):
+        self.sync()
+        self.assertTrue(self.sync()['alreadySynced'])
+        result = self.sync(overwrite=True)
+        self.assertEqual(result['objectCount'], 0)
+        self.assertEqual(result['objectsSkipped'], len(OBJECTS))
+        self.assertEqual(result['bytesWritten'], 0)
+
+    def test_changed_etag_is_fetched_again(self):
+        self.sync()
+        self.put('img_0.jpg', b'a new image')
+        result = self.sync(overwrite=True)
+        self.assertEqual(result['objectCount'], 1)
+        self.assertEqual(result['objectsSkipped'], len(OBJECTS) - 1)
+        self.assertEqual(self.read('img_0.jpg'), b'a new image')
+
+    def test_removed_object_is_deleted(self):
+        self.sync()
+        # made locally, like a latent cache, the sync never wrote it
+        local_only = os.path.join(self.local_path, '_latent_cache', 'img_0.safetensors')
+        os.makedirs(os.path.dirname(local_only))
+        with open(local_only, 'wb') as f:
+            f.write(b'latents')
+        self.client.delete_object(Bucket=BUCKET, Key=f'{PREFIX}/sub/img_6.txt')
+        result = self.sync(overwrite=True)
+        self.assertEqual(result['objectsDeleted'], 1)
+        self.assertFalse(os.path.exists(os.path.join(self.local_path, 'sub', 'img_6.txt')))
+        self.assertFalse(os.path.exists(os.path.join(self.local_path, 'sub')))
+        self.assertTrue(os.path.exists(local_only))
+
+    def test_dataset_without_manifest_is_cleaned_up(self):
+        # a dataset synced before the manifest existed
+        self.sync()
+        os.remove(os.path.join(self.local_path, '.sync_manifest.json'))
+        local_only = os.path.join(self.local_path, '_latent_cache', 'img_0.safetensors')
+        os.makedirs(os.path.dirname(local_only))
+        with open(local_only, 'wb') as f:
+            f.write(b'latents')
+        self.client.delete_object(Bucket=BUCKET, Key=f'{PREFIX}/img_5.jpg')
+        self.client.delete_object(Bucket=BUCKET, Key=f'{PREFIX}/sub/img_6.txt')
+
+        result = self.sync(overwrite=True)
+        self.assertEqual(result['objectsDeleted'], 2)
+        self.assertEqual(result['objectCount'], len(OBJECTS) - 2)
+        self.assertFalse(os.path.exists(os.path.join(self.local_path, 'img_5.jpg')))
+        self.assertFalse(os.path.exists(os.path.join(self.local_path, 'sub')))
+        self.assertTrue(os.path.exists(local_only))
+        for i in range(5):
+            self.assertEqual(self.read(f'img_{i}.jpg'), OBJECTS[f'img_{i}.jpg'])
+
+        # the manifest is back, the next sync skips everything
+        result = self.sync(overwrite=True)
+        self.assertEqual(result['objectsDeleted'], 0)
+        self.assertEqual(result['objectsSkipped'], len(OBJECTS) - 2)
+
+    def test_resume_after_failure(self):
+        from r2_sync_worker.sync import SyncError
+        failing_client = FailingClient(self.client, fail_after=3)
+        with self.assertRaises(SyncError):
+            self.sync(client=failing_client)
+        self.assertFalse(os.path.exists(os.path.join(self.local_path, '.sync_complete')))
+        # no partial downloads are left behind
+        for root, _, files in os.walk(self.local_path):
+            self.assertFalse(any(file.endswith('.part') for file in files))
+
+        result = self.sync()
+        self.assertFalse(result['alreadySynced'])
+        self.assertEqual(result['objectsSkipped'], failing_client.num_downloads)
+        self.assertEqual(result['objectCount'], len(OBJECTS) - failing_client.num_downloads)
+        for key, body in OBJECTS.items():
+            self.assertEqual(self.read(key), body)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -14,6 +14,16 @@ def flush(garbage_collect=True):
         gc.collect()
 
 
+def is_out_of_memory_error(e: Exception):
+    # works for cuda, mps and cpu allocation failures
+    if isinstance(e, torch.cuda.OutOfMemoryError):
+        return True
+    if isinstance(e, RuntimeError):
+        message = str(e)
+        return "out of memory" in message or "can't allocate memory" in message
+    return False
+
+
 def get_mean_std(tensor):
     if len(tensor.shape) == 3:
         tensor = tensor.unsqueeze(0)
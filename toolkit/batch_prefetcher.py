@@ -0,0 +1,191 @@
+import queue
+import threading
+import time
+from typing import TYPE_CHECKING, Iterator, List, Union
+
+import torch
+
+from toolkit.prompt_utils import PromptEmbeds
+
+if TYPE_CHECKING:
+    from toolkit.data_transfer_object.data_loader import DataLoaderBatchDTO
+
+# batch tensors the training step moves to the device. latents are also cast to the train dtype there
+DEVICE_TENSOR_ATTRIBUTES = [
+    'tensor',
+    'control_tensor',
+    'clip_image_tensor',
+    'mask_tensor',
+    'unaugmented_tensor',
+    'unconditional_tensor',
+    'unconditional_latents',
+    'inpaint_tensor',
+]
+
+_END_OF_EPOCH = object()
+
+
+def get_prefetch_overlap(wait_time: float, fetch_time: float) -> float:
+    # share of the background loading that was hidden behind training steps
+    if fetch_time <= 0:
+        return 0.0
+    return min(1.0, max(0.0, 1.0 - wait_time / fetch_time))
+
+
+class BatchPrefetcher:
+    """
+    Wraps one epoch of a dataloader iterator. A background thread pulls the next batches and copies their
+    tensors to the training device while the current step runs, so the step only waits when the
+    dataloader is slower than training.
+
+    On cuda, tensors are pinned and copied on a separate stream, and the training stream waits on that copy
+    before the batch is handed out. On other devices the copy is a plain .to, which is a no-op on cpu.
+    Prompt conditioning and noise still happen in the training step since they depend on the model state.
+
+    Raises StopIteration at the end of the epoch like the iterator it wraps. Errors from the dataloader
+    are raised on the training thread.
+    """
+
+    def __init__(
+            self,
+            iterator: Iterator['DataLoaderBatchDTO'],
+            device: Union[str, torch.device],
+            latents_dtype: Union[torch.dtype, None] = None,
+            depth: int = 2
+    ):
+        self.iterator = iterator
+        self.device = torch.device(device)
+        self.latents_dtype = latents_dtype
+        self.use_cuda_stream = self.device.type == 'cuda' and torch.cuda.is_available()
+        self.stream = torch.cuda.Stream(device=self.device) if self.use_cuda_stream else None
+        self._queue: queue.Queue = queue.Queue(maxsize=max(1, depth))
+        self._stop = threading.Event()
+        self._finished = False
+        # seconds the background thread spent getting and moving the last batch, the training thread spent
+        # waiting for it, and the totals
+        self.last_fetch_time = 0.0
+        self.last_wait_time = 0.0
+        self.total_fetch_time = 0.0
+        self.total_wait_time = 0.0
+        self._thread = threading.Thread(target=self._worker, name='batch_prefetcher', daemon=True)
+        self._thread.start()
+
+    def _put(self, item) -> bool:
+        # waits for room in the queue, but gives up if we are closed
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _worker(self):
+        while not self._stop.is_set():
+            start = time.perf_counter()
+            try:
+                batch = next(self.iterator)
+            except StopIteration:
+                self._put(_END_OF_EPOCH)
+                return
+            except BaseException as e:
+                self._put(e)
+                return
+            try:
+                event = self._move_batch(batch)
+            except BaseException as e:
+                self._put(e)
+                return
+            if not self._put((batch, event, time.perf_counter() - start)):
+                return
+
+    def _move(self, tensor: torch.Tensor, dtype=None) -> torch.Tensor:
+        if self.use_cuda_stream and tensor.device.type == 'cpu':
+            tensor = tensor.pin_memory()
+            return tensor.to(self.device, dtype=dtype, non_blocking=True)
+        return tensor.to(self.device, dtype=dtype)
+
+    def _move_batch(self, batch: 'DataLoaderBatchDTO'):
+        if batch is None:
+            return None
+        if self.use_cuda_stream:
+            with torch.cuda.stream(self.stream):
+                self._move_batch_tensors(batch)
+                event = torch.cuda.Event()
+                event.record(self.stream)
+            return event
+        self._move_batch_tensors(batch)
+        return None
+
+    def _move_batch_tensors(self, batch: 'DataLoaderBatchDTO'):
+        if getattr(batch, 'latents', None) is not None:
+            batch.latents = self._move(batch.latents, dtype=self.latents_dtype)
+        for attr in DEVICE_TENSOR_ATTRIBUTES:
+            value = getattr(batch, attr, None)
+            if isinstance(value, torch.Tensor):
+                setattr(batch, attr, self._move(value))
+        prompt_embeds = getattr(batch, 'prompt_embeds', None)
+        if isinstance(prompt_embeds, PromptEmbeds):
+            if isinstance(prompt_embeds.text_embeds, (list, tuple)):
+                prompt_embeds.text_embeds = [self._move(t) for t in prompt_embeds.text_embeds]
+            else:
+                prompt_embeds.text_embeds = self._move(prompt_embeds.text_embeds)
+            if prompt_embeds.pooled_embeds is not None:
+                prompt_embeds.pooled_embeds = self._move(prompt_embeds.pooled_embeds)
+            if isinstance(prompt_embeds.attention_mask, (list, tuple)):
+                prompt_embeds.attention_mask = [self._move(t) for t in prompt_embeds.attention_mask]
+            elif prompt_embeds.attention_mask is not None:
+                prompt_embeds.attention_mask = self._move(prompt_embeds.attention_mask)
+
+    def _get_device_tensors(self, batch: 'DataLoaderBatchDTO') -> List[torch.Tensor]:
+        tensors = [getattr(batch, attr, None) for attr in ['latents'] + DEVICE_TENSOR_ATTRIBUTES]
+        prompt_embeds = getattr(batch, 'prompt_embeds', None)
+        if isinstance(prompt_embeds, PromptEmbeds):
+            for value in [prompt_embeds.text_embeds, prompt_embeds.pooled_embeds, prompt_embeds.attention_mask]:
+                if isinstance(value, (list, tuple)):
+                    tensors.extend(value)
+                else:
+                    tensors.append(value)
+        return [t for t in tensors if isinstance(t, torch.Tensor) and t.device.type == 'cuda']
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> 'DataLoaderBatchDTO':
+        if self._finished:
+            raise StopIteration
+        start = time.perf_counter()
+        item = self._queue.get()
+        self.last_wait_time = time.perf_counter() - start
+        self.total_wait_time += self.last_wait_time
+        if item is _END_OF_EPOCH:
+            self._finished = True
+            raise StopIteration
+        if isinstance(item, BaseException):
+            self._finished = True
+            raise item
+        batch, event, fetch_time = item
+        self.last_fetch_time = fetch_time
+        self.total_fetch_time += fetch_time
+        if event is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_event(event)
+            # the tensors were made on the copy stream, keep the allocator from reusing them early
+            for tensor in self._get_device_tensors(batch):
+                tensor.record_stream(current_stream)
+        return batch
+
+    @property
+    def overlap(self) -> float:
+        return get_prefetch_overlap(self.total_wait_time, self.total_fetch_time)
+
+    def close(self):
+        self._stop.set()
+        self._finished = True
+        # drop anything queued so the thread is not stuck waiting on a full queue
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        self._thread.join(timeout=5)
@@ -126,4 +126,25 @@ def get_bucket_for_image_size(
     if closest_bucket is None:
         raise ValueError("No suitable bucket found")
 
-    return closest_bucket
\ No newline at end of file
+    return closest_bucket
+
+def get_batch_size_for_pixel_budget(
+        width: int,
+        height: int,
+        pixel_budget: int,
+        num_frames: int = 1,
+        max_batch_size: Union[int, None] = None
+) -> int:
+    # largest batch of this bucket size that fits in the pixel budget, always at least 1
+    batch_size = max(1, pixel_budget // max(1, width * height * num_frames))
+    if max_batch_size is not None:
+        batch_size = min(batch_size, max(1, max_batch_size))
+    return batch_size
+
+
+def split_into_even_batches(items: list, batch_size: int) -> List[list]:
+    # same number of batches as fixed chunks, but sizes differ by at most 1 so there is no tiny last batch
+    if len(items) == 0:
+        return []
+    num_batches = -(-len(items) // max(1, batch_size))
+    return [items[i * len(items) // num_batches:(i + 1) * len(items) // num_batches] for i in range(num_batches)]
@@ -0,0 +1,126 @@
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+from typing import Callable, Iterable, Iterator, List, Tuple, TypeVar, Union
+
+from safetensors.torch import save_file
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+
+def prefetch_map(
+        fn: Callable[[T], R],
+        items: Iterable[T],
+        executor: ThreadPoolExecutor,
+        lookahead: int = 8
+) -> Iterator[Tuple[T, R]]:
+    """
+    Runs fn on the executor for each item and yields (item, result) in the original order.
+    At most lookahead items are in flight at once so decoded images do not pile up in memory
+    while the consumer (the encoder) is busy. Errors raised by fn are re-raised here.
+    """
+    pending: deque = deque()
+    item_iter = iter(items)
+    exhausted = False
+    while True:
+        while not exhausted and len(pending) < max(1, lookahead):
+            try:
+                item = next(item_iter)
+            except StopIteration:
+                exhausted = True
+                break
+            pending.append((item, executor.submit(fn, item)))
+        if len(pending) == 0:
+            return
+        item, future = pending.popleft()
+        yield item, future.result()
+
+
+def save_cache_file(state_dict: dict, path: str, metadata: Union[dict, None] = None):
+    # write to a temp file and rename so a killed process never leaves a partial cache file behind
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        save_file(state_dict, tmp_path, metadata=metadata)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class AsyncCacheWriter:
+    """
+    Writes cache files on background threads so disk io overlaps with encoding.
+    submit blocks once max_pending writes are queued, which keeps the memory held by
+    tensors waiting to be written bounded. Write errors are raised on the next submit,
+    on wait, or when the writer is closed.
+    """
+
+    def __init__(self, num_workers: int = 2, max_pending: int = 32):
+        self.executor = ThreadPoolExecutor(max_workers=max(1, num_workers), thread_name_prefix='cache_writer')
+        self._slots = threading.BoundedSemaphore(max(1, max_pending))
+        self._lock = threading.Lock()
+        self._futures: List[Future] = []
+        self._error: Union[BaseException, None] = None
+        self.num_written = 0
+
+    def _on_done(self, future: Future):
+        self._slots.release()
+        error = future.exception()
+        with self._lock:
+            if error is not None:
+                if self._error is None:
+                    self._error = error
+            else:
+                self.num_written += 1
+
+    def raise_if_failed(self):
+        with self._lock:
+            error = self._error
+            self._error = None
+        if error is not None:
+            raise error
+
+    def submit(self, fn: Callable, *args, **kwargs):
+        self.raise_if_failed()
+        self._slots.acquire()
+        future = self.executor.submit(fn, *args, **kwargs)
+        with self._lock:
+            # drop finished futures so the list does not grow with the dataset
+            self._futures = [f for f in self._futures if not f.done()]
+            self._futures.append(future)
+        future.add_done_callback(self._on_done)
+        return future
+
+    @property
+    def num_pending(self) -> int:
+        with self._lock:
+            return len([f for f in self._futures if not f.done()])
+
+    def save_file(self, state_dict: dict, path: str, metadata: Union[dict, None] = None):
+        return self.submit(save_cache_file, state_dict, path, metadata)
+
+    def wait(self):
+        with self._lock:
+            futures = list(self._futures)
+            self._futures = []
+        wait(futures)
+        self.raise_if_failed()
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # finish what is queued but do not hide the original error
+            self.executor.shutdown(wait=True)
@@ -23,6 +23,13 @@ class SaveConfig:
         self.save_every: int = kwargs.get('save_every', 1000)
         self.dtype: str = kwargs.get('dtype', 'float16')
         self.max_step_saves_to_keep: int = kwargs.get('max_step_saves_to_keep', 5)
+        # copy the weights and optimizer state to cpu, then write files and remove old saves in the background
+        self.async_save: bool = kwargs.get('async_save', True)
+        # sharded: optimizer state as safetensors shards that are only rewritten when they change, pt: one optimizer.pt
+        self.optimizer_state_format: str = kwargs.get('optimizer_state_format', 'sharded')
+        if self.optimizer_state_format not in ['sharded', 'pt']:
+            raise ValueError(f"optimizer_state_format must be sharded or pt, got {self.optimizer_state_format}")
+        self.optimizer_shard_size_mb: int = kwargs.get('optimizer_shard_size_mb', 1024)
         self.save_format: SaveFormat = kwargs.get('save_format', 'safetensors')
         if self.save_format not in ['safetensors', 'diffusers']:
             raise ValueError(f"save_format must be safetensors or diffusers, got {self.save_format}")
@@ -93,6 +100,8 @@ class SampleConfig:
         self.extra_values = kwargs.get('extra_values', [])
         self.num_frames = kwargs.get('num_frames', 1)
         self.fps: int = kwargs.get('fps', 16)
+        # samples with matching settings generated per pipeline call, raise it if there is vram to spare
+        self.batch_size: int = kwargs.get('batch_size', 1)
         if self.num_frames > 1 and self.ext not in ['webp']:
             print("Changing sample extention to animated webp")
             self.ext = 'webp'
@@ -361,6 +370,8 @@ class TrainConfig:
         self.max_denoising_steps: int = kwargs.get('max_denoising_steps', 999)
         self.batch_size: int = kwargs.get('batch_size', 1)
         self.orig_batch_size: int = self.batch_size
+        # number of batches to load and move to the device in a background thread while a step runs. 0 to disable
+        self.prefetch_batches: int = kwargs.get('prefetch_batches', 2)
         self.dtype: str = kwargs.get('dtype', 'fp32')
         self.xformers = kwargs.get('xformers', False)
         self.sdp = kwargs.get('sdp', False)
@@ -741,6 +752,11 @@ class EMAConfig:
         # similar to a decay in an optimizer but the opposite
         self.param_multiplier: float = kwargs.get('param_multiplier', 1.0)
 
+        # only update the ema every n steps, the decay is adjusted to cover the skipped steps
+        self.update_every: int = int(kwargs.get('update_every', 1))
+        # keep the ema weights in cpu memory and update them on a background thread
+        self.offload_to_cpu: bool = kwargs.get('offload_to_cpu', False)
+
 
 class ReferenceDatasetConfig:
     def __init__(self, **kwargs):
@@ -850,6 +866,12 @@ class DatasetConfig:
         self.scale: float = kwargs.get('scale', 1.0)
         self.buckets: bool = kwargs.get('buckets', True)
         self.bucket_tolerance: int = kwargs.get('bucket_tolerance', 64)
+        # when set, bucketed batches are packed up to this many pixels (width * height * frames) instead of
+        # using a fixed batch size, so lower resolution buckets get bigger batches. batch_size * resolution ** 2
+        # gives the same memory use as batch_size at full resolution
+        self.batch_pixel_budget: Union[int, None] = kwargs.get('batch_pixel_budget', None)
+        # max batch size for any bucket when batch_pixel_budget is set
+        self.bucket_max_batch_size: Union[int, None] = kwargs.get('bucket_max_batch_size', None)
         self.is_reg: bool = kwargs.get('is_reg', False)
         self.prior_reg: bool = kwargs.get('prior_reg', False)
         self.network_weight: float = float(kwargs.get('network_weight', 1.0))
@@ -901,8 +923,32 @@ class DatasetConfig:
         self.cache_latents: bool = kwargs.get('cache_latents', False)
         # cache latents to disk will store them on disk. If both are true, it will save to disk, but keep in memory
         self.cache_latents_to_disk: bool = kwargs.get('cache_latents_to_disk', False)
+        # number of images sent through the vae at once when caching latents. Images are grouped by bucket
+        # so every batch is the same size. It will automatically be reduced if we run out of memory
+        self.cache_latents_batch_size: int = kwargs.get('cache_latents_batch_size', 4)
+        # number of threads used to load images and captions while caching latents, text embeddings and clip vision
+        self.cache_latents_num_workers: int = kwargs.get('cache_latents_num_workers', 4)
+        # number of threads writing cache files to disk in the background while encoding continues
+        self.cache_write_workers: int = kwargs.get('cache_write_workers', 2)
+        # how latents are stored on disk. 'files' is one safetensors file per image. 'shards' packs them into a few
+        # large files with an index, which is much faster on network storage. Use scripts/migrate_latent_cache_to_shards.py
+        # to convert an existing cache
+        self.latent_cache_format: str = kwargs.get('latent_cache_format', 'files')
+        if self.latent_cache_format not in ['files', 'shards']:
+            raise ValueError(f"Invalid latent_cache_format: {self.latent_cache_format}. Must be 'files' or 'shards'")
+        # max size of each latent cache shard file
+        self.latent_cache_shard_size_mb: int = kwargs.get('latent_cache_shard_size_mb', 1024)
+        # latents cached in memory are packed into shared memory buffers of this size. Dataloader workers
+        # read them in place, so memory does not grow with num_workers
+        self.latent_memory_chunk_size_mb: int = kwargs.get('latent_memory_chunk_size_mb', 256)
         self.cache_clip_vision_to_disk: bool = kwargs.get('cache_clip_vision_to_disk', False)
         self.cache_text_embeddings: bool = kwargs.get('cache_text_embeddings', False)
+        # number of captions encoded at once when caching text embeddings. Captions are sorted by token length
+        # so batches need little padding. It will automatically be reduced if we run out of memory
+        self.cache_text_embeddings_batch_size: int = kwargs.get('cache_text_embeddings_batch_size', 8)
+        # number of token dropout / shuffle variants of each caption to cache when cache_text_embeddings is on.
+        # One is picked at random per sample. Caption dropout uses a cached empty prompt and needs no variants
+        self.cache_text_embeddings_variants: int = kwargs.get('cache_text_embeddings_variants', 0)
 
         self.standardize_images: bool = kwargs.get('standardize_images', False)
 
@@ -964,8 +1010,11 @@ class DatasetConfig:
         # remove empty strings
         self.controls = [control for control in self.controls if control.strip() != '']
         
-        # if true, will use a fask method to get image sizes. This can result in errors. Do not use unless you know what you are doing
-        self.fast_image_size: bool = kwargs.get('fast_image_size', False)
+        # read image sizes and exif orientation from the file header instead of decoding every image.
+        # formats the header reader does not know fall back to PIL. Set to false to always decode with PIL
+        self.fast_image_size: bool = kwargs.get('fast_image_size', True)
+        # number of threads used to scan files and read image sizes when the dataset is loaded
+        self.index_num_workers: int = kwargs.get('index_num_workers', 8)
         
         self.do_i2v: bool = kwargs.get('do_i2v', True)  # do image to video on models that are both t2i and i2v capable
 
@@ -2,7 +2,10 @@ import copy
 import json
 import os
 import random
+import time
 import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache
 from typing import List, TYPE_CHECKING
 
@@ -22,6 +25,7 @@ from toolkit.config_modules import DatasetConfig, preprocess_dataset_raw_config
 from toolkit.dataloader_mixins import CaptionMixin, BucketsMixin, LatentCachingMixin, Augments, CLIPCachingMixin, ControlCachingMixin, TextEmbeddingCachingMixin
 from toolkit.data_transfer_object.data_loader import FileItemDTO, DataLoaderBatchDTO
 from toolkit.print import print_acc
+from toolkit.size_database import SizeDatabase
 from toolkit.accelerator import get_accelerator
 
 import platform
@@ -102,7 +106,7 @@ class ImageDataset(Dataset, CaptionMixin):
         bad_count = 0
         for file in tqdm(self.file_list):
             try:
-                w, h = image_utils.get_image_size(file)
+                w, h = image_utils.get_oriented_image_size(file)
             except image_utils.UnknownImageFormat:
                 img = exif_transpose(Image.open(file))
                 w, h = img.size
@@ -418,6 +422,9 @@ class AiToolkitDataset(LatentCachingMixin, ControlCachingMixin, CLIPCachingMixin
         self.resolution = dataset_config.resolution
         self.caption_dict = None
         self.file_list: List['FileItemDTO'] = []
+        # seconds spent in each startup phase
+        self.index_timings: OrderedDict = OrderedDict()
+        phase_start = time.perf_counter()
 
         # check if dataset_path is a folder or json
         if os.path.isdir(self.dataset_path):
@@ -439,6 +446,7 @@ class AiToolkitDataset(LatentCachingMixin, ControlCachingMixin, CLIPCachingMixin
         if self.dataset_config.num_repeats > 1:
             # repeat the list
             file_list = file_list * self.dataset_config.num_repeats
+        self.index_timings['list files'] = time.perf_counter() - phase_start
 
         if self.dataset_config.standardize_images:
             if self.sd.is_xl or self.sd.is_vega or self.sd.is_ssd:
@@ -467,30 +475,15 @@ class AiToolkitDataset(LatentCachingMixin, ControlCachingMixin, CLIPCachingMixin
         if not os.path.isdir(self.dataset_path):
             dataset_folder = os.path.dirname(dataset_folder)
         
-        dataset_size_file = os.path.join(dataset_folder, '.aitk_size.json')
-        dataloader_version = "0.1.2"
-        if os.path.exists(dataset_size_file):
-            try:
-                with open(dataset_size_file, 'r') as f:
-                    self.size_database = json.load(f)
-                
-                if "__version__" not in self.size_database or self.size_database["__version__"] != dataloader_version:
-                    print_acc("Upgrading size database to new version")
-                    # old version, delete and recreate
-                    self.size_database = {}
-            except Exception as e:
-                print_acc(f"Error loading size database: {dataset_size_file}")
-                print_acc(e)
-                self.size_database = {}
-        else:
-            self.size_database = {}
-        
-        self.size_database["__version__"] = dataloader_version
+        phase_start = time.perf_counter()
+        dataloader_version = "0.1.3"
+        size_db = SizeDatabase(dataset_folder, dataloader_version)
+        self.size_database = size_db.load()
+        self.index_timings['load size db'] = time.perf_counter() - phase_start
 
-        bad_count = 0
-        for file in tqdm(file_list):
+        def make_file_item(file):
             try:
-                file_item = FileItemDTO(
+                return FileItemDTO(
                     sd=self.sd,
                     path=file,
                     dataset_config=dataset_config,
@@ -499,7 +492,6 @@ class AiToolkitDataset(LatentCachingMixin, ControlCachingMixin, CLIPCachingMixin
                     dataset_root=dataset_folder,
                     encode_control_in_text_embeddings=self.sd.encode_control_in_text_embeddings if self.sd else False,
                 )
-                self.file_list.append(file_item)
             except Exception as e:
                 print_acc(traceback.format_exc())
                 if self.is_video:
@@ -507,12 +499,27 @@ class AiToolkitDataset(LatentCachingMixin, ControlCachingMixin, CLIPCachingMixin
                 else:
                     print_acc(f"Error processing image: {file}")
                 print_acc(e)
-                bad_count += 1
+                return None
+
+        # file items mostly wait on stat calls, sidecar lookups and image headers, so threads scale well here
+        phase_start = time.perf_counter()
+        bad_count = 0
+        num_workers = max(1, dataset_config.index_num_workers)
+        with ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='dataset_index') as executor:
+            for file_item in tqdm(executor.map(make_file_item, file_list), total=len(file_list)):
+                if file_item is None:
+                    bad_count += 1
+                else:
+                    self.file_list.append(file_item)
+        self.index_timings['scan files'] = time.perf_counter() - phase_start
+
+        # save the size database, only changed entries are written
+        phase_start = time.perf_counter()
+        num_updated = size_db.save(self.size_database)
+        self.index_timings['save size db'] = time.perf_counter() - phase_start
+        if num_updated > 0:
+            print_acc(f"  -  Updated {num_updated} entries in size database")
 
-        # save the size database
-        with open(dataset_size_file, 'w') as f:
-            json.dump(self.size_database, f)
-        
         if self.is_video:
             print_acc(f"  -  Found {len(self.file_list)} videos")
             assert len(self.file_list) > 0, f"no videos found in {self.dataset_path}"
@@ -520,6 +527,11 @@ class AiToolkitDataset(LatentCachingMixin, ControlCachingMixin, CLIPCachingMixin
             print_acc(f"  -  Found {len(self.file_list)} images")
             assert len(self.file_list) > 0, f"no images found in {self.dataset_path}"
 
+        phase_start = time.perf_counter()
+        self.load_caption_index()
+        self.index_timings['captions'] = time.perf_counter() - phase_start
+
+        phase_start = time.perf_counter()
         # handle x axis flips
         if self.dataset_config.flip_x:
             print_acc("  -  adding x axis flips")
@@ -545,8 +557,14 @@ class AiToolkitDataset(LatentCachingMixin, ControlCachingMixin, CLIPCachingMixin
                 print_acc(f"  -  Found {len(self.file_list)} videos after adding flips")
             else:
                 print_acc(f"  -  Found {len(self.file_list)} images after adding flips")
+        self.index_timings['flips'] = time.perf_counter() - phase_start
 
+        phase_start = time.perf_counter()
         self.setup_epoch()
+        self.index_timings['buckets and caching'] = time.perf_counter() - phase_start
+
+        timing_str = ', '.join([f"{name} {seconds:.2f}s" for name, seconds in self.index_timings.items()])
+        print_acc(f"  -  Dataset startup: {timing_str}")
 
     def setup_epoch(self):
         if self.epoch_num == 0:
@@ -565,19 +583,31 @@ class AiToolkitDataset(LatentCachingMixin, ControlCachingMixin, CLIPCachingMixin
                 # always do this last
                 self.setup_controls()
         else:
+            # pick up captions edited since the last epoch
+            num_reloaded = self.load_caption_index()
+            if num_reloaded > 0:
+                print_acc(f"  -  Reloaded {num_reloaded} changed captions")
             if self.dataset_config.poi is not None:
                 # handle cropping to a specific point of interest
                 # setup buckets every epoch
                 self.setup_buckets(quiet=True)
         self.epoch_num += 1
 
+    def load_caption_index(self) -> int:
+        # read all raw captions into the file items on a thread pool so samples do no caption io.
+        # After the first call, only captions whose file mtime changed are read again
+        num_workers = max(1, self.dataset_config.index_num_workers)
+        with ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='caption_index') as executor:
+            reloaded = list(executor.map(lambda x: x.refresh_raw_caption(self.caption_dict), self.file_list))
+        return sum(reloaded)
+
     def __len__(self):
         if self.dataset_config.buckets:
             return len(self.batch_indices)
         return len(self.file_list)
 
     def _get_single_item(self, index) -> 'FileItemDTO':
-        file_item: 'FileItemDTO' = copy.deepcopy(self.file_list[index])
+        file_item: 'FileItemDTO' = self.file_list[index].get_sample()
         file_item.load_and_process_image(self.transform)
         file_item.load_caption(self.caption_dict)
         return file_item
@@ -70,29 +70,32 @@ class FileItemDTO(
         if use_db_entry:
             w, h, _ = size_database[file_key]
         elif self.is_video:
-            # Open the video file
-            video = cv2.VideoCapture(self.path)
-            
-            # Check if video opened successfully
-            if not video.isOpened():
-                raise Exception(f"Error: Could not open video file {self.path}")
-            
-            # Get width and height
-            width = int(video.get(cv2.CAP_PROP_FRAME_WIDTH))
-            height = int(video.get(cv2.CAP_PROP_FRAME_HEIGHT))
-            w, h = width, height
-            
-            # Release the video capture object immediately
-            video.release()
-            size_database[file_key] = (width, height, file_signature)
+            try:
+                # read the size from the container header, much faster than opening a decoder
+                w, h = image_utils.get_video_size(self.path)
+            except image_utils.UnknownImageFormat:
+                # Open the video file
+                video = cv2.VideoCapture(self.path)
+
+                # Check if video opened successfully
+                if not video.isOpened():
+                    raise Exception(f"Error: Could not open video file {self.path}")
+
+                # Get width and height
+                w = int(video.get(cv2.CAP_PROP_FRAME_WIDTH))
+                h = int(video.get(cv2.CAP_PROP_FRAME_HEIGHT))
+
+                # Release the video capture object immediately
+                video.release()
+            size_database[file_key] = (w, h, file_signature)
         else:
             if self.dataset_config.fast_image_size:
-            # original method is significantly faster, but some images are read sideways. Not sure why. Do slow method by default.
+                # reads the size and exif orientation from the header without decoding the image
                 try:
-                    w, h = image_utils.get_image_size(self.path)
+                    w, h = image_utils.get_oriented_image_size(self.path)
                 except image_utils.UnknownImageFormat:
                     print_once(f'Warning: Some images in the dataset cannot be fast read. ' + \
-                            f'This process is faster for png, jpeg')
+                            f'This process is faster for jpeg, png, webp and avif')
                     img = exif_transpose(Image.open(self.path))
                     w, h = img.size
             else:
@@ -124,6 +127,15 @@ class FileItemDTO(
         self.prior_reg = self.dataset_config.prior_reg
         self.tensor: Union[torch.Tensor, None] = None
 
+    def get_sample(self) -> 'FileItemDTO':
+        # per sample view of this file item. The config, transforms, paths and cached data are shared by
+        # reference, only attributes set while loading (tensors, caption, embeddings) belong to the sample.
+        # Loading only ever assigns attributes, so the file item in the dataset is never changed.
+        # This is much cheaper than a deepcopy, which also copied the dataset config and transforms.
+        sample = object.__new__(type(self))
+        sample.__dict__.update(self.__dict__)
+        return sample
+
     def cleanup(self):
         self.tensor = None
         self.cleanup_latent()
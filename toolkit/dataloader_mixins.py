@@ -5,8 +5,10 @@ import json
 import math
 import os
 import random
+import time
 from collections import OrderedDict
-from typing import TYPE_CHECKING, List, Dict, Union
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, List, Dict, Optional, Tuple, Union
 import traceback
 
 import cv2
@@ -16,8 +18,12 @@ from safetensors.torch import load_file, save_file
 from tqdm import tqdm
 from transformers import CLIPImageProcessor, CLIPVisionModelWithProjection, SiglipImageProcessor
 
-from toolkit.basic import flush, value_map
-from toolkit.buckets import get_bucket_for_image_size, get_resolution
+from toolkit.basic import flush, value_map, is_out_of_memory_error
+from toolkit.buckets import get_bucket_for_image_size, get_resolution, get_batch_size_for_pixel_budget, \
+    split_into_even_batches
+from toolkit.cache_pipeline import AsyncCacheWriter, prefetch_map
+from toolkit.latent_arena import LatentMemoryArena, LatentRef
+from toolkit.latent_shards import LatentShardStore, get_latent_shard_store
 from toolkit.config_modules import ControlTypes
 from toolkit.control_generator import ControlGenerator
 from toolkit.metadata import get_meta_for_safetensors
@@ -29,7 +35,8 @@ from PIL.ImageOps import exif_transpose
 import albumentations as A
 from toolkit.print import print_acc
 from toolkit.accelerator import get_accelerator
-from toolkit.prompt_utils import PromptEmbeds
+from toolkit.prompt_utils import PromptEmbeds, split_prompt_embeds, get_prompt_embeds_valid_length, \
+    trim_prompt_embeds_padding
 from torchvision.transforms import functional as TF
 
 from toolkit.train_tools import get_torch_dtype
@@ -175,6 +182,8 @@ class Bucket:
         self.width = width
         self.height = height
         self.file_list_idx: List[int] = []
+        # set by build_batch_indices
+        self.batch_size: int = 1
 
 
 class BucketsMixin:
@@ -184,11 +193,43 @@ class BucketsMixin:
 
     def build_batch_indices(self: 'AiToolkitDataset'):
         self.batch_indices = []
+        pixel_budget = self.dataset_config.batch_pixel_budget
         for key, bucket in self.buckets.items():
-            for start_idx in range(0, len(bucket.file_list_idx), self.batch_size):
-                end_idx = min(start_idx + self.batch_size, len(bucket.file_list_idx))
-                batch = bucket.file_list_idx[start_idx:end_idx]
-                self.batch_indices.append(batch)
+            if pixel_budget is None:
+                bucket.batch_size = self.batch_size
+                for start_idx in range(0, len(bucket.file_list_idx), self.batch_size):
+                    end_idx = min(start_idx + self.batch_size, len(bucket.file_list_idx))
+                    batch = bucket.file_list_idx[start_idx:end_idx]
+                    self.batch_indices.append(batch)
+            else:
+                bucket.batch_size = get_batch_size_for_pixel_budget(
+                    bucket.width,
+                    bucket.height,
+                    pixel_budget,
+                    num_frames=self.dataset_config.num_frames,
+                    max_batch_size=self.dataset_config.bucket_max_batch_size
+                )
+                self.batch_indices.extend(split_into_even_batches(bucket.file_list_idx, bucket.batch_size))
+
+    def get_batch_plan_stats(self: 'AiToolkitDataset') -> Dict[str, float]:
+        # how well the batches fill the pixel budget. Budget is batch_size full resolution images when not set
+        pixel_budget = self.dataset_config.batch_pixel_budget
+        if pixel_budget is None:
+            pixel_budget = self.batch_size * self.dataset_config.resolution ** 2 * self.dataset_config.num_frames
+        num_items = 0
+        used_pixels = 0
+        for bucket in self.buckets.values():
+            num_items += len(bucket.file_list_idx)
+            used_pixels += len(bucket.file_list_idx) * bucket.width * bucket.height * self.dataset_config.num_frames
+        num_batches = len(self.batch_indices)
+        utilization = used_pixels / max(1, num_batches * pixel_budget)
+        return {
+            'steps_per_epoch': num_batches,
+            'mean_batch_size': num_items / max(1, num_batches),
+            'pixel_budget': pixel_budget,
+            'utilization': utilization,
+            'waste': max(0.0, 1.0 - utilization),
+        }
 
     def shuffle_buckets(self: 'AiToolkitDataset'):
         for key, bucket in self.buckets.items():
@@ -286,8 +327,17 @@ class BucketsMixin:
         if not quiet:
             print_acc(f'Bucket sizes for {self.dataset_path}:')
             for key, bucket in self.buckets.items():
-                print_acc(f'{key}: {len(bucket.file_list_idx)} files')
+                if self.dataset_config.batch_pixel_budget is not None:
+                    print_acc(f'{key}: {len(bucket.file_list_idx)} files, batch size {bucket.batch_size}')
+                else:
+                    print_acc(f'{key}: {len(bucket.file_list_idx)} files')
             print_acc(f'{len(self.buckets)} buckets made')
+            stats = self.get_batch_plan_stats()
+            print_acc(
+                f"{stats['steps_per_epoch']} steps per epoch, mean batch size {stats['mean_batch_size']:.2f}, "
+                f"{stats['utilization'] * 100:.1f}% of the {stats['pixel_budget']} pixel budget used "
+                f"({stats['waste'] * 100:.1f}% wasted)"
+            )
 
 
 class CaptionProcessingDTOMixin:
@@ -298,6 +348,8 @@ class CaptionProcessingDTOMixin:
             self.raw_caption_short: str = None
             self.caption: str = None
             self.caption_short: str = None
+            # mtime of the caption file when raw_caption was read, None if there is no file
+            self.caption_mtime: Union[float, None] = None
 
             dataset_config: DatasetConfig = kwargs.get('dataset_config', None)
             self.extra_values: List[float] = dataset_config.extra_values
@@ -305,10 +357,39 @@ class CaptionProcessingDTOMixin:
 
     # todo allow for loading from sd-scripts style dict
     def load_caption(self: 'FileItemDTO', caption_dict: Union[dict, None]=None):
-        if self.raw_caption is not None:
-            # we already loaded it
-            pass
-        elif caption_dict is not None and self.path in caption_dict and "caption" in caption_dict[self.path]:
+        if self.raw_caption is None:
+            self.load_raw_caption(caption_dict)
+
+        self.caption = self.get_caption()
+        if self.raw_caption_short is not None:
+            self.caption_short = self.get_caption(short_caption=True)
+
+    def get_caption_path(self: 'FileItemDTO'):
+        path_no_ext = os.path.splitext(self.path)[0]
+        return path_no_ext + self.dataset_config.caption_ext
+
+    def get_caption_mtime(self: 'FileItemDTO') -> Union[float, None]:
+        try:
+            return os.path.getmtime(self.get_caption_path())
+        except OSError:
+            return None
+
+    def refresh_raw_caption(self: 'FileItemDTO', caption_dict: Union[dict, None] = None) -> bool:
+        # the dataset reads every caption up front and calls this each epoch, so samples never read caption files.
+        # Only reads the file again if its mtime changed. Returns True if the caption was (re)loaded
+        if caption_dict is not None and self.path in caption_dict and "caption" in caption_dict[self.path]:
+            if self.raw_caption is not None:
+                return False
+            self.load_raw_caption(caption_dict)
+            return True
+        mtime = self.get_caption_mtime()
+        if self.raw_caption is not None and mtime == self.caption_mtime:
+            return False
+        self.load_raw_caption(caption_dict)
+        return True
+
+    def load_raw_caption(self: 'FileItemDTO', caption_dict: Union[dict, None] = None):
+        if caption_dict is not None and self.path in caption_dict and "caption" in caption_dict[self.path]:
             self.raw_caption = caption_dict[self.path]["caption"]
             if 'caption_short' in caption_dict[self.path]:
                 self.raw_caption_short = caption_dict[self.path]["caption_short"]
@@ -316,12 +397,11 @@ class CaptionProcessingDTOMixin:
                     self.raw_caption = caption_dict[self.path]["caption_short"]
         else:
             # see if prompt file exists
-            path_no_ext = os.path.splitext(self.path)[0]
-            prompt_ext = self.dataset_config.caption_ext
-            prompt_path = path_no_ext + prompt_ext
+            prompt_path = self.get_caption_path()
             short_caption = None
+            mtime = self.get_caption_mtime()
 
-            if os.path.exists(prompt_path):
+            if mtime is not None:
                 with open(prompt_path, 'r', encoding='utf-8') as f:
                     prompt = f.read()
                     short_caption = None
@@ -356,18 +436,28 @@ class CaptionProcessingDTOMixin:
                 short_caption = self.dataset_config.default_caption
             self.raw_caption = prompt
             self.raw_caption_short = short_caption
+            self.caption_mtime = mtime
 
-        self.caption = self.get_caption()
-        if self.raw_caption_short is not None:
-            self.caption_short = self.get_caption(short_caption=True)
+    def get_caption_variants(self: 'FileItemDTO', num_variants: int) -> List[str]:
+        # token dropout / shuffle variants for the text embedding cache. Each uses its own rng seeded from
+        # the caption, so the same variants, and cache files, are made every run no matter what the loader
+        # threads do with the global one
+        return [
+            self.get_caption(cached_variant=True, rng=random.Random(f'{self.raw_caption}|{i}'))
+            for i in range(num_variants)
+        ]
 
     def get_caption(
             self: 'FileItemDTO',
             trigger=None,
             to_replace_list=None,
             add_if_not_present=False,
-            short_caption=False
+            short_caption=False,
+            cached_variant=False,
+            rng: Optional[random.Random] = None
     ):
+        if rng is None:
+            rng = random
         if trigger is None and self.trigger_word is not None:
             trigger = self.trigger_word
         
@@ -384,7 +474,7 @@ class CaptionProcessingDTOMixin:
         # handle dropout
         if self.dataset_config.caption_dropout_rate > 0 and not short_caption and not self.dataset_config.cache_text_embeddings:
             # get a random float form 0 to 1
-            rand = random.random()
+            rand = rng.random()
             if rand < self.dataset_config.caption_dropout_rate:
                 # drop the caption
                 return ''
@@ -397,7 +487,8 @@ class CaptionProcessingDTOMixin:
         token_list = [x for x in token_list if x]
 
         # handle token dropout
-        if self.dataset_config.token_dropout_rate > 0 and not short_caption and not self.dataset_config.cache_text_embeddings:
+        # with cached text embeddings, token dropout only happens when making the cached variants
+        if self.dataset_config.token_dropout_rate > 0 and not short_caption and (not self.dataset_config.cache_text_embeddings or cached_variant):
             new_token_list = []
             keep_tokens: int = self.dataset_config.keep_tokens
             for idx, token in enumerate(token_list):
@@ -408,14 +499,14 @@ class CaptionProcessingDTOMixin:
                     pass
                 else:
                     # get a random float form 0 to 1
-                    rand = random.random()
+                    rand = rng.random()
                     if rand > self.dataset_config.token_dropout_rate:
                         # keep the token
                         new_token_list.append(token)
             token_list = new_token_list
 
         if self.dataset_config.shuffle_tokens:
-            random.shuffle(token_list)
+            rng.shuffle(token_list)
 
         # join back together
         caption = ', '.join(token_list)
@@ -424,10 +515,10 @@ class CaptionProcessingDTOMixin:
         if self.dataset_config.random_triggers:
             num_triggers = self.dataset_config.random_triggers_max
             if num_triggers > 1:
-                num_triggers = random.randint(0, num_triggers)
+                num_triggers = rng.randint(0, num_triggers)
 
             if num_triggers > 0:
-                triggers = random.sample(self.dataset_config.random_triggers, num_triggers)
+                triggers = rng.sample(self.dataset_config.random_triggers, num_triggers)
                 caption = caption + ', ' + ', '.join(triggers)
                 # add random triggers
                 # for i in range(num_triggers):
@@ -442,7 +533,7 @@ class CaptionProcessingDTOMixin:
             token_list = [x.strip() for x in token_list]
             # remove empty strings
             token_list = [x for x in token_list if x]
-            random.shuffle(token_list)
+            rng.shuffle(token_list)
             caption = ', '.join(token_list)
         if caption == '':
             pass
@@ -1640,6 +1731,11 @@ class LatentCachingFileItemDTOMixin:
         self.is_caching_to_disk = False
         self.is_caching_to_memory = False
         self.latent_load_device = 'cpu'
+        # set when the dataset uses the packed shard cache format instead of one file per latent
+        self.latent_shard_store: Union['LatentShardStore', None] = None
+        # in memory latents live in a shared arena owned by the dataset, we only keep where ours is
+        self.latent_memory_arena: Union['LatentMemoryArena', None] = None
+        self._latent_ref: Union['LatentRef', None] = None
         # sd1 or sdxl or others
         self.latent_space_version = 'sd1'
         # todo, increment this if we change the latent format to invalidate cache
@@ -1683,9 +1779,28 @@ class LatentCachingFileItemDTOMixin:
 
         return self._latent_path
 
+    def get_latent_cache_key(self: 'FileItemDTO'):
+        # key in the shard index, same as the per file cache name so they can be migrated
+        return os.path.splitext(os.path.basename(self.get_latent_path()))[0]
+
+    def is_latent_saved(self: 'FileItemDTO'):
+        if self.latent_shard_store is not None:
+            return self.get_latent_cache_key() in self.latent_shard_store
+        return os.path.exists(self.get_latent_path())
+
+    def read_saved_latent(self: 'FileItemDTO') -> torch.Tensor:
+        if self.latent_shard_store is not None:
+            return self.latent_shard_store.load(self.get_latent_cache_key())
+        state_dict = load_file(
+            self.get_latent_path(),
+            # device=device if device is not None else self.latent_load_device
+            device='cpu'
+        )
+        return state_dict['latent']
+
     def cleanup_latent(self):
         if self._encoded_latent is not None:
-            if not self.is_caching_to_memory:
+            if not self.is_caching_to_memory or self._latent_ref is not None:
                 # we are caching on disk, don't save in memory
                 self._encoded_latent = None
             else:
@@ -1695,14 +1810,11 @@ class LatentCachingFileItemDTOMixin:
     def get_latent(self, device=None):
         if not self.is_latent_cached:
             return None
+        if self._latent_ref is not None:
+            return self.latent_memory_arena.get(self._latent_ref)
         if self._encoded_latent is None:
             # load it from disk
-            state_dict = load_file(
-                self.get_latent_path(),
-                # device=device if device is not None else self.latent_load_device
-                device='cpu'
-            )
-            self._encoded_latent = state_dict['latent']
+            self._encoded_latent = self.read_saved_latent()
         return self._encoded_latent
 
 
@@ -1712,6 +1824,29 @@ class LatentCachingMixin:
         if hasattr(super(), '__init__'):
             super().__init__(**kwargs)
         self.latent_cache = {}
+        self.latent_memory_arena: Union[LatentMemoryArena, None] = None
+
+    def get_latent_space_version(self: 'AiToolkitDataset'):
+        if self.sd.model_config.latent_space_version is not None:
+            return self.sd.model_config.latent_space_version
+        elif self.sd.is_xl:
+            return 'sdxl'
+        elif self.sd.is_v3:
+            return 'sd3'
+        elif self.sd.is_auraflow:
+            return 'sdxl'
+        elif self.sd.is_flux:
+            return 'flux1'
+        elif self.sd.model_config.is_pixart_sigma:
+            return 'sdxl'
+        else:
+            return self.sd.model_config.arch
+
+    def get_latent_batch_key(self: 'AiToolkitDataset', file_item: 'FileItemDTO'):
+        # items with the same key produce image tensors of the same size and can be stacked
+        if self.dataset_config.buckets:
+            return f'{file_item.crop_width}x{file_item.crop_height}'
+        return f'{self.dataset_config.resolution}x{self.dataset_config.resolution}'
 
     def cache_latents_all_latents(self: 'AiToolkitDataset'):
         if self.dataset_config.num_frames > 1:
@@ -1729,76 +1864,173 @@ class LatentCachingMixin:
             # move sd items to cpu except for vae
             self.sd.set_device_state_preset('cache_latents')
 
-            # use tqdm to show progress
-            i = 0
-            for file_item in tqdm(self.file_list, desc=f'Caching latents{" to disk" if to_disk else ""}'):
-                # set latent space version
-                if self.sd.model_config.latent_space_version is not None:
-                    file_item.latent_space_version = self.sd.model_config.latent_space_version
-                elif self.sd.is_xl:
-                    file_item.latent_space_version = 'sdxl'
-                elif self.sd.is_v3:
-                    file_item.latent_space_version = 'sd3'
-                elif self.sd.is_auraflow:
-                    file_item.latent_space_version = 'sdxl'
-                elif self.sd.is_flux:
-                    file_item.latent_space_version = 'flux1'
-                elif self.sd.model_config.is_pixart_sigma:
-                    file_item.latent_space_version = 'sdxl'
-                else:
-                    file_item.latent_space_version = self.sd.model_config.arch
+            latent_space_version = self.get_latent_space_version()
+            use_shards = to_disk and self.dataset_config.latent_cache_format == 'shards'
+            if use_shards:
+                print_acc(" - Using packed latent cache shards")
+            if to_memory:
+                self.latent_memory_arena = LatentMemoryArena(
+                    chunk_size_mb=self.dataset_config.latent_memory_chunk_size_mb,
+                    expected_items=len(self.file_list)
+                )
+
+            # find what we already have and group the rest by bucket so they can be batched
+            uncached_groups: Dict[str, List['FileItemDTO']] = OrderedDict()
+            num_uncached = 0
+            for file_item in tqdm(self.file_list, desc='Checking latent cache'):
+                file_item.latent_space_version = latent_space_version
                 file_item.is_caching_to_disk = to_disk
                 file_item.is_caching_to_memory = to_memory
                 file_item.latent_load_device = self.sd.device
+                file_item.latent_memory_arena = self.latent_memory_arena
 
                 latent_path = file_item.get_latent_path(recalculate=True)
+                if use_shards:
+                    file_item.latent_shard_store = get_latent_shard_store(
+                        os.path.dirname(latent_path),
+                        shard_size_mb=self.dataset_config.latent_cache_shard_size_mb
+                    )
                 # check if it is saved to disk already
-                if os.path.exists(latent_path):
+                if file_item.is_latent_saved():
                     if to_memory:
                         # load it into memory
-                        state_dict = load_file(latent_path, device='cpu')
-                        file_item._encoded_latent = state_dict['latent'].to('cpu', dtype=self.sd.torch_dtype)
+                        file_item._latent_ref = self.latent_memory_arena.put(
+                            file_item.read_saved_latent().to('cpu', dtype=self.sd.torch_dtype)
+                        )
+                    file_item.is_latent_cached = True
                 else:
-                    # not saved to disk, calculate
-                    # load the image first
-                    file_item.load_and_process_image(self.transform, only_load_latents=True)
-                    dtype = self.sd.torch_dtype
-                    device = self.sd.device_torch
-                    # add batch dimension
-                    try:
-                        imgs = file_item.tensor.unsqueeze(0).to(device, dtype=dtype)
-                        latent = self.sd.encode_images(imgs).squeeze(0)
-                    except Exception as e:
-                        print_acc(f"Error processing image: {file_item.path}")
-                        print_acc(f"Error: {str(e)}")
-                        raise e
-                    # save_latent
-                    if to_disk:
-                        state_dict = OrderedDict([
-                            ('latent', latent.clone().detach().cpu()),
-                        ])
-                        # metadata
-                        meta = get_meta_for_safetensors(file_item.get_latent_info_dict())
-                        os.makedirs(os.path.dirname(latent_path), exist_ok=True)
-                        save_file(state_dict, latent_path, metadata=meta)
+                    batch_key = self.get_latent_batch_key(file_item)
+                    if batch_key not in uncached_groups:
+                        uncached_groups[batch_key] = []
+                    uncached_groups[batch_key].append(file_item)
+                    num_uncached += 1
+
+            if num_uncached > 0:
+                self.encode_uncached_latents(uncached_groups, num_uncached, to_disk, to_memory)
+
+            if self.latent_memory_arena is not None:
+                arena = self.latent_memory_arena
+                print_acc(
+                    f" - {arena.num_items} latents in memory, {arena.num_bytes / (1024 * 1024):.1f} MB "
+                    f"in {len(arena.chunks)} shared buffers"
+                )
 
-                    if to_memory:
-                        # keep it in memory
-                        file_item._encoded_latent = latent.to('cpu', dtype=self.sd.torch_dtype)
+            # restore device state
+            self.sd.restore_device_state()
 
-                    del imgs
-                    del latent
-                    del file_item.tensor
+    def encode_uncached_latents(
+            self: 'AiToolkitDataset',
+            uncached_groups: Dict[str, List['FileItemDTO']],
+            num_uncached: int,
+            to_disk: bool,
+            to_memory: bool
+    ):
+        batch_size = max(1, self.dataset_config.cache_latents_batch_size)
+        num_workers = max(1, self.dataset_config.cache_latents_num_workers)
+
+        def load_image(file_item: 'FileItemDTO'):
+            file_item.load_and_process_image(self.transform, only_load_latents=True)
+
+        start_time = time.perf_counter()
+        num_encoded = 0
+        # images are loaded on the executor, encoded here and written on the writer threads
+        with ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='latent_loader') as executor, \
+                AsyncCacheWriter(num_workers=self.dataset_config.cache_write_workers) as writer:
+            progress_bar = tqdm(total=num_uncached, desc=f'Caching latents{" to disk" if to_disk else ""}')
+            for batch_key, file_items in uncached_groups.items():
+                # keep the workers loading the next batches while the current one is encoded
+                loaded = prefetch_map(load_image, file_items, executor, lookahead=batch_size * 2)
+                batch_items = []
+                for file_item, _ in loaded:
+                    batch_items.append(file_item)
+                    if len(batch_items) < batch_size:
+                        continue
+                    batch_size = self.encode_latent_batch_with_backoff(
+                        batch_items, batch_size, to_disk, to_memory, writer
+                    )
+                    num_encoded += len(batch_items)
+                    progress_bar.update(len(batch_items))
+                    batch_items = []
+                if len(batch_items) > 0:
+                    batch_size = self.encode_latent_batch_with_backoff(
+                        batch_items, batch_size, to_disk, to_memory, writer
+                    )
+                    num_encoded += len(batch_items)
+                    progress_bar.update(len(batch_items))
+            progress_bar.close()
+
+        elapsed = time.perf_counter() - start_time
+        print_acc(
+            f" - Encoded {num_encoded} latents in {elapsed:.1f}s "
+            f"({num_encoded / max(elapsed, 1e-6):.2f} images/s, final batch size {batch_size})"
+        )
 
-                    # flush(garbage_collect=False)
-                file_item.is_latent_cached = True
-                i += 1
-                # flush every 100
-                # if i % 100 == 0:
-                #     flush()
+    def encode_latent_batch_with_backoff(
+            self: 'AiToolkitDataset',
+            file_items: List['FileItemDTO'],
+            batch_size: int,
+            to_disk: bool,
+            to_memory: bool,
+            writer: AsyncCacheWriter
+    ) -> int:
+        # encodes the items in chunks of batch_size. Halves the batch size on out of memory errors
+        # and returns the batch size that worked so the next batch starts there
+        start_idx = 0
+        while start_idx < len(file_items):
+            chunk = file_items[start_idx:start_idx + batch_size]
+            try:
+                self.encode_latent_batch(chunk, to_disk, to_memory, writer)
+                start_idx += len(chunk)
+            except Exception as e:
+                if is_out_of_memory_error(e) and batch_size > 1:
+                    batch_size = max(1, batch_size // 2)
+                    flush()
+                    print_acc(f" - Out of memory while caching latents, reducing batch size to {batch_size}")
+                    continue
+                for file_item in chunk:
+                    print_acc(f"Error processing image: {file_item.path}")
+                print_acc(f"Error: {str(e)}")
+                raise e
+        return batch_size
+
+    def encode_latent_batch(
+            self: 'AiToolkitDataset',
+            file_items: List['FileItemDTO'],
+            to_disk: bool,
+            to_memory: bool,
+            writer: AsyncCacheWriter
+    ):
+        dtype = self.sd.torch_dtype
+        device = self.sd.device_torch
+        imgs = [file_item.tensor.to(device, dtype=dtype) for file_item in file_items]
+        latents = self.sd.encode_images(imgs)
+        for file_item, latent in zip(file_items, latents):
+            # save_latent
+            if to_disk and file_item.latent_shard_store is not None:
+                writer.submit(
+                    file_item.latent_shard_store.write,
+                    file_item.get_latent_cache_key(),
+                    latent.clone().detach().cpu(),
+                    metadata=file_item.get_latent_info_dict()
+                )
+            elif to_disk:
+                latent_path = file_item.get_latent_path()
+                state_dict = OrderedDict([
+                    ('latent', latent.clone().detach().cpu()),
+                ])
+                # metadata
+                meta = get_meta_for_safetensors(file_item.get_latent_info_dict())
+                writer.save_file(state_dict, latent_path, metadata=meta)
 
-            # restore device state
-            self.sd.restore_device_state()
+            if to_memory:
+                # keep it in memory
+                file_item._latent_ref = self.latent_memory_arena.put(latent.detach().to('cpu', dtype=self.sd.torch_dtype))
+
+            file_item.tensor = None
+            file_item.is_latent_cached = True
+
+        del imgs
+        del latents
 
 
 class TextEmbeddingFileItemDTOMixin:
@@ -1812,14 +2044,20 @@ class TextEmbeddingFileItemDTOMixin:
         self.text_embedding_load_device = 'cpu'
         self.text_embedding_space_version = 'sd1'
         self.text_embedding_version = 1
-
-    def get_text_embedding_info_dict(self: 'FileItemDTO'):
-        # make sure the caption is loaded here
-        # TODO: we need a way to cache all the other features like trigger words, DOP, etc. For now, we need to throw an error if not compatible.
-        if self.caption is None:
-            self.load_caption()
+        # cached embeddings of token dropout / shuffle variants of the caption, one is picked per sample
+        self.text_embedding_variant_paths: List[str] = []
+        # cached embedding of the empty prompt, used for caption dropout
+        self.text_embedding_empty_path: Union[str, None] = None
+
+    def get_text_embedding_info_dict(self: 'FileItemDTO', caption: Union[str, None] = None):
+        if caption is None:
+            # make sure the caption is loaded here
+            # TODO: we need a way to cache all the other features like trigger words, DOP, etc. For now, we need to throw an error if not compatible.
+            if self.caption is None:
+                self.load_caption()
+            caption = self.caption
         item = OrderedDict([
-            ("caption", self.caption),
+            ("caption", caption),
             ("text_embedding_space_version", self.text_embedding_space_version),
             ("text_embedding_version", self.text_embedding_version),
         ])
@@ -1832,19 +2070,22 @@ class TextEmbeddingFileItemDTOMixin:
         if self._text_embedding_path is not None and not recalculate:
             return self._text_embedding_path
         else:
-            # we store text embeddings in a folder in same path as image called _text_embedding_cache
-            img_dir = os.path.dirname(self.path)
-            te_dir = os.path.join(img_dir, '_t_e_cache')
-            hash_dict = self.get_text_embedding_info_dict()
-            filename_no_ext = os.path.splitext(os.path.basename(self.path))[0]
-            # get base64 hash of md5 checksum of hash_dict
-            hash_input = json.dumps(hash_dict, sort_keys=True).encode('utf-8')
-            hash_str = base64.urlsafe_b64encode(hashlib.md5(hash_input).digest()).decode('ascii')
-            hash_str = hash_str.replace('=', '')
-            self._text_embedding_path = os.path.join(te_dir, f'{filename_no_ext}_{hash_str}.safetensors')
+            self._text_embedding_path = self.get_text_embedding_path_for_caption()
 
         return self._text_embedding_path
 
+    def get_text_embedding_path_for_caption(self: 'FileItemDTO', caption: Union[str, None] = None):
+        # we store text embeddings in a folder in same path as image called _text_embedding_cache
+        img_dir = os.path.dirname(self.path)
+        te_dir = os.path.join(img_dir, '_t_e_cache')
+        hash_dict = self.get_text_embedding_info_dict(caption)
+        # get base64 hash of md5 checksum of hash_dict
+        hash_input = json.dumps(hash_dict, sort_keys=True).encode('utf-8')
+        hash_str = base64.urlsafe_b64encode(hashlib.md5(hash_input).digest()).decode('ascii')
+        hash_str = hash_str.replace('=', '')
+        # named only by the content hash, so every item with the same caption and encoder shares one file
+        return os.path.join(te_dir, f'{hash_str}.safetensors')
+
     def cleanup_text_embedding(self):
         if self.prompt_embeds is not None:
             # we are caching on disk, don't save in memory
@@ -1854,8 +2095,14 @@ class TextEmbeddingFileItemDTOMixin:
         if not self.is_text_embedding_cached:
             return
         if self.prompt_embeds is None:
+            text_embedding_path = self.get_text_embedding_path()
+            if self.text_embedding_empty_path is not None and random.random() < self.dataset_config.caption_dropout_rate:
+                text_embedding_path = self.text_embedding_empty_path
+            elif len(self.text_embedding_variant_paths) > 0:
+                # the unmodified caption is one of the choices too
+                text_embedding_path = random.choice([text_embedding_path] + self.text_embedding_variant_paths)
             # load it from disk
-            self.prompt_embeds = PromptEmbeds.load(self.get_text_embedding_path())
+            self.prompt_embeds = PromptEmbeds.load(text_embedding_path)
 
 class TextEmbeddingCachingMixin:
     def __init__(self: 'AiToolkitDataset', **kwargs):
@@ -1863,6 +2110,26 @@ class TextEmbeddingCachingMixin:
         if hasattr(super(), '__init__'):
             super().__init__(**kwargs)
         self.is_caching_text_embeddings = self.dataset_config.cache_text_embeddings
+        # whether the text encoder pads a batch to its longest prompt, found on first use
+        self._text_embeds_pad_to_longest: Union[bool, None] = None
+
+    def load_text_embedding_control_images(self: 'AiToolkitDataset', file_item: 'FileItemDTO') -> List[torch.Tensor]:
+        if file_item.control_path is None:
+            raise Exception(f"Could not find a control image for {file_item.path} which is needed for this model")
+        ctrl_img_list = []
+        control_path_list = file_item.control_path
+        if not isinstance(file_item.control_path, list):
+            control_path_list = [control_path_list]
+        for control_path in control_path_list:
+            try:
+                img = Image.open(control_path).convert("RGB")
+                img = exif_transpose(img)
+                # convert to 0 to 1 tensor
+                ctrl_img_list.append(TF.to_tensor(img).unsqueeze(0))
+            except Exception as e:
+                print_acc(f"Error: {e}")
+                print_acc(f"Error loading control image: {control_path}")
+        return ctrl_img_list
 
     def cache_text_embeddings(self: 'AiToolkitDataset'):
         with accelerator.main_process_first():
@@ -1870,61 +2137,176 @@ class TextEmbeddingCachingMixin:
             print_acc(" - Saving text embeddings to disk")
             
             did_move = False
+            num_workers = max(1, self.dataset_config.cache_latents_num_workers)
 
-            # use tqdm to show progress
-            i = 0
-            for file_item in tqdm(self.file_list, desc='Caching text embeddings to disk'):
+            for file_item in self.file_list:
                 file_item.text_embedding_space_version = self.sd.model_config.arch
                 file_item.latent_load_device = self.sd.device
 
-                text_embedding_path = file_item.get_text_embedding_path(recalculate=True)
-                # only process if not saved to disk
-                if not os.path.exists(text_embedding_path):
+            def get_path(file_item: 'FileItemDTO'):
+                # loads the caption, so run it on the loader threads
+                return file_item.get_text_embedding_path(recalculate=True)
+
+            def load_control_images(file_item: 'FileItemDTO'):
+                if file_item.encode_control_in_text_embeddings:
+                    return self.load_text_embedding_control_images(file_item)
+                return None
+
+            num_variants = self.dataset_config.cache_text_embeddings_variants
+            cache_empty = self.dataset_config.caption_dropout_rate > 0
+            if num_variants > 0:
+                print_acc(f" - Caching {num_variants} token dropout / shuffle variants per caption")
+
+            with ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='text_embedding_loader') as executor, \
+                    AsyncCacheWriter(num_workers=self.dataset_config.cache_write_workers) as writer:
+                # the cache is content addressed, so items with the same caption are only encoded once.
+                # captions without control images are collected as path -> caption so they can be batched
+                captions: Dict[str, str] = OrderedDict()
+                control_items: Dict[str, 'FileItemDTO'] = OrderedDict()
+                paths = prefetch_map(get_path, self.file_list, executor, lookahead=num_workers * 4)
+                for file_item, text_embedding_path in tqdm(paths, total=len(self.file_list), desc='Checking text embedding cache'):
+                    if file_item.encode_control_in_text_embeddings:
+                        control_items[text_embedding_path] = file_item
+                        continue
+                    captions[text_embedding_path] = file_item.caption
+                    if num_variants > 0:
+                        variants = file_item.get_caption_variants(num_variants)
+                        file_item.text_embedding_variant_paths = []
+                        for caption in variants:
+                            variant_path = file_item.get_text_embedding_path_for_caption(caption)
+                            captions[variant_path] = caption
+                            file_item.text_embedding_variant_paths.append(variant_path)
+                    if cache_empty:
+                        file_item.text_embedding_empty_path = file_item.get_text_embedding_path_for_caption('')
+                        captions[file_item.text_embedding_empty_path] = ''
+
+                if len(control_items) > 0 and (num_variants > 0 or cache_empty):
+                    # their embeddings depend on the control images, only the caption as written is cached
+                    print_acc(
+                        f"Warning: {len(control_items)} items encode control images in their text embeddings, "
+                        f"caption dropout and token dropout / shuffle variants are not cached for them"
+                    )
+
+                is_cached = dict(zip(captions.keys(), executor.map(os.path.exists, captions.keys())))
+                uncached_captions = [(c, p) for p, c in captions.items() if not is_cached[p]]
+                uncached_control = [x for p, x in control_items.items() if not os.path.exists(p)]
+                num_unique = len(captions) + len(control_items)
+                num_uncached = len(uncached_captions) + len(uncached_control)
+                print_acc(f" - {len(self.file_list)} items, {num_unique} unique embeddings, {num_uncached} to encode")
+
+                progress_bar = tqdm(total=num_uncached, desc='Caching text embeddings to disk')
+                # captions without control images are encoded in batches of similar token length
+                if len(uncached_captions) > 0:
+                    self.sd.set_device_state_preset('cache_text_encoder')
+                    did_move = True
+                    self.encode_text_embeddings_batched(uncached_captions, writer, progress_bar)
+
+                prepared = prefetch_map(load_control_images, uncached_control, executor, lookahead=num_workers * 4)
+                for file_item, ctrl_img_list in prepared:
                     # load if not loaded
                     if not did_move:
                         self.sd.set_device_state_preset('cache_text_encoder')
                         did_move = True
-                        
-                    if file_item.encode_control_in_text_embeddings:
-                        if file_item.control_path is None:
-                            raise Exception(f"Could not find a control image for {file_item.path} which is needed for this model")
-                        ctrl_img_list = []
-                        control_path_list = file_item.control_path
-                        if not isinstance(file_item.control_path, list):
-                            control_path_list = [control_path_list]
-                        for i in range(len(control_path_list)):
-                            try:
-                                img = Image.open(control_path_list[i]).convert("RGB")
-                                img = exif_transpose(img)
-                                # convert to 0 to 1 tensor
-                                img = (
-                                    TF.to_tensor(img)
-                                    .unsqueeze(0)
-                                    .to(self.sd.device_torch, dtype=self.sd.torch_dtype)
-                                )
-                                ctrl_img_list.append(img)
-                            except Exception as e:
-                                print_acc(f"Error: {e}")
-                                print_acc(f"Error loading control image: {control_path_list[i]}")
-                        
-                        if len(ctrl_img_list) == 0:
-                            ctrl_img = None
-                        elif not self.sd.has_multiple_control_images:
-                            ctrl_img = ctrl_img_list[0]
-                        else:
-                            ctrl_img = ctrl_img_list
-                        prompt_embeds: PromptEmbeds = self.sd.encode_prompt(file_item.caption, control_images=ctrl_img)
+
+                    ctrl_img_list = [
+                        img.to(self.sd.device_torch, dtype=self.sd.torch_dtype) for img in ctrl_img_list
+                    ]
+                    if len(ctrl_img_list) == 0:
+                        ctrl_img = None
+                    elif not self.sd.has_multiple_control_images:
+                        ctrl_img = ctrl_img_list[0]
                     else:
-                        prompt_embeds: PromptEmbeds = self.sd.encode_prompt(file_item.caption)
+                        ctrl_img = ctrl_img_list
+                    prompt_embeds: PromptEmbeds = self.sd.encode_prompt(file_item.caption, control_images=ctrl_img)
                     # save it
-                    prompt_embeds.save(text_embedding_path)
+                    prompt_embeds = prompt_embeds.detach().to('cpu')
+                    writer.submit(prompt_embeds.save, file_item.get_text_embedding_path())
                     del prompt_embeds
+                    progress_bar.update(1)
+                progress_bar.close()
+
+            for file_item in self.file_list:
                 file_item.is_text_embedding_cached = True
-                i += 1
             # restore device state
             # if did_move:
             #     self.sd.restore_device_state()
 
+    def get_caption_token_length(self: 'AiToolkitDataset', caption: str) -> int:
+        # the last tokenizer is the largest text encoder on multi encoder models. Fall back to words
+        tokenizer = getattr(self.sd, 'tokenizer', None)
+        if isinstance(tokenizer, (list, tuple)):
+            tokenizer = tokenizer[-1] if len(tokenizer) > 0 else None
+        if tokenizer is not None:
+            try:
+                # not verbose, so captions over the max length do not warn, only their length is needed
+                return len(tokenizer(caption, truncation=False, verbose=False)['input_ids'])
+            except Exception:
+                pass
+        return len(caption.split())
+
+    def encode_text_embeddings_batched(
+            self: 'AiToolkitDataset',
+            caption_paths: List[Tuple[str, str]],
+            writer: AsyncCacheWriter,
+            progress_bar: tqdm
+    ):
+        # caption_paths is a list of (caption, cache path)
+        batch_size = max(1, self.dataset_config.cache_text_embeddings_batch_size)
+        # sorting by length keeps padding inside each batch small
+        caption_paths = sorted(caption_paths, key=lambda x: self.get_caption_token_length(x[0]))
+        start_time = time.perf_counter()
+        start_idx = 0
+        while start_idx < len(caption_paths):
+            chunk = caption_paths[start_idx:start_idx + batch_size]
+            try:
+                prompt_embeds_list = self.encode_text_embedding_batch([caption for caption, _ in chunk])
+            except Exception as e:
+                if is_out_of_memory_error(e) and batch_size > 1:
+                    batch_size = max(1, batch_size // 2)
+                    flush()
+                    print_acc(f" - Out of memory while caching text embeddings, reducing batch size to {batch_size}")
+                    continue
+                raise e
+            for (_, text_embedding_path), prompt_embeds in zip(chunk, prompt_embeds_list):
+                writer.submit(prompt_embeds.save, text_embedding_path)
+            start_idx += len(chunk)
+            progress_bar.update(len(chunk))
+        elapsed = time.perf_counter() - start_time
+        print_acc(
+            f" - Encoded {len(caption_paths)} captions in {elapsed:.1f}s "
+            f"({len(caption_paths) / max(elapsed, 1e-6):.2f} captions/s, final batch size {batch_size})"
+        )
+
+    def encode_text_embedding_batch(self: 'AiToolkitDataset', captions: List[str]) -> List[PromptEmbeds]:
+        prompt_embeds: PromptEmbeds = self.sd.encode_prompt(captions)
+        prompt_embeds = prompt_embeds.detach().to('cpu')
+        text_embeds = prompt_embeds.text_embeds
+        if isinstance(text_embeds, (list, tuple)):
+            text_embeds = text_embeds[0]
+        if len(captions) > 1 and text_embeds.shape[0] != len(captions):
+            # this model does not batch prompts, encode them one at a time
+            return [self.sd.encode_prompt(caption).detach().to('cpu') for caption in captions]
+        prompt_embeds_list = split_prompt_embeds(prompt_embeds, len(captions))
+        if len(captions) > 1:
+            valid_lengths = [get_prompt_embeds_valid_length(pe) for pe in prompt_embeds_list]
+            # only trim when the model pads to the longest prompt. Models that pad to a fixed length
+            # return that length for a single prompt too
+            if None not in valid_lengths and self.text_encoder_pads_to_longest():
+                prompt_embeds_list = [
+                    trim_prompt_embeds_padding(pe, length) for pe, length in zip(prompt_embeds_list, valid_lengths)
+                ]
+        return prompt_embeds_list
+
+    def text_encoder_pads_to_longest(self: 'AiToolkitDataset') -> bool:
+        # a short prompt encoded by itself is only longer than its valid length when the model pads
+        # to a fixed length. Decided once per model, never from the contents of a batch
+        if self._text_embeds_pad_to_longest is None:
+            prompt_embeds = self.sd.encode_prompt(['a']).detach().to('cpu')
+            valid_length = get_prompt_embeds_valid_length(prompt_embeds)
+            self._text_embeds_pad_to_longest = valid_length is not None and \
+                valid_length == prompt_embeds.text_embeds.shape[1]
+        return self._text_embeds_pad_to_longest
+
 
 class CLIPCachingMixin:
     def __init__(self: 'AiToolkitDataset', **kwargs):
@@ -2042,9 +2424,8 @@ class CLIPCachingMixin:
 
             self.clip_vision_unconditional_cache = unconditional_paths
 
-            # use tqdm to show progress
-            i = 0
-            for file_item in tqdm(self.file_list, desc=f'Caching clip vision to disk'):
+            num_workers = max(1, self.dataset_config.cache_latents_num_workers)
+            for file_item in self.file_list:
                 file_item.is_caching_clip_vision_to_disk = True
                 file_item.clip_vision_load_device = self.sd.device
                 file_item.clip_vision_is_quad = is_quad
@@ -2053,47 +2434,51 @@ class CLIPCachingMixin:
                 if file_item.has_clip_augmentations:
                     raise Exception("Error: clip vision caching is not supported with clip augmentations")
 
+            def prepare(file_item: 'FileItemDTO'):
                 embedding_path = file_item.get_clip_vision_embeddings_path(recalculate=True)
                 # check if it is saved to disk already
-                if not os.path.exists(embedding_path):
-                    # load the image first
-                    file_item.load_clip_image()
-                    # add batch dimension
-                    clip_image = file_item.clip_image_tensor.unsqueeze(0).to(device, dtype=dtype)
-
-                    if is_quad:
-                        # split the 4x4 grid and stack on batch
-                        ci1, ci2 = clip_image.chunk(2, dim=2)
-                        ci1, ci3 = ci1.chunk(2, dim=3)
-                        ci2, ci4 = ci2.chunk(2, dim=3)
-                        clip_image = torch.cat([ci1, ci2, ci3, ci4], dim=0).detach()
-
-                    clip_output = vision_encoder(
-                        clip_image.to(device, dtype=dtype),
-                        output_hidden_states=True
-                    )
+                if os.path.exists(embedding_path):
+                    return True
+                # load the image on the loader threads
+                file_item.load_clip_image()
+                return False
+
+            # images are loaded on the executor, encoded here and written on the writer threads
+            with ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='clip_vision_loader') as executor, \
+                    AsyncCacheWriter(num_workers=self.dataset_config.cache_write_workers) as writer:
+                prepared = prefetch_map(prepare, self.file_list, executor, lookahead=num_workers * 4)
+                for file_item, is_cached in tqdm(prepared, total=len(self.file_list), desc=f'Caching clip vision to disk'):
+                    if not is_cached:
+                        # add batch dimension
+                        clip_image = file_item.clip_image_tensor.unsqueeze(0).to(device, dtype=dtype)
+
+                        if is_quad:
+                            # split the 4x4 grid and stack on batch
+                            ci1, ci2 = clip_image.chunk(2, dim=2)
+                            ci1, ci3 = ci1.chunk(2, dim=3)
+                            ci2, ci4 = ci2.chunk(2, dim=3)
+                            clip_image = torch.cat([ci1, ci2, ci3, ci4], dim=0).detach()
+
+                        clip_output = vision_encoder(
+                            clip_image.to(device, dtype=dtype),
+                            output_hidden_states=True
+                        )
+
+                        # make state_dict ['last_hidden_state', 'image_embeds', 'penultimate_hidden_states']
+                        state_dict = OrderedDict([
+                            ('image_embeds', clip_output.image_embeds.clone().detach().cpu()),
+                            ('last_hidden_state', clip_output.hidden_states[-1].clone().detach().cpu()),
+                            ('penultimate_hidden_states', clip_output.hidden_states[-2].clone().detach().cpu()),
+                        ])
+                        # metadata
+                        meta = get_meta_for_safetensors(file_item.get_clip_vision_info_dict())
+                        writer.save_file(state_dict, file_item.get_clip_vision_embeddings_path(), metadata=meta)
+
+                        del clip_image
+                        del clip_output
+                        file_item.clip_image_tensor = None
 
-                    # make state_dict ['last_hidden_state', 'image_embeds', 'penultimate_hidden_states']
-                    state_dict = OrderedDict([
-                        ('image_embeds', clip_output.image_embeds.clone().detach().cpu()),
-                        ('last_hidden_state', clip_output.hidden_states[-1].clone().detach().cpu()),
-                        ('penultimate_hidden_states', clip_output.hidden_states[-2].clone().detach().cpu()),
-                    ])
-                    # metadata
-                    meta = get_meta_for_safetensors(file_item.get_clip_vision_info_dict())
-                    os.makedirs(os.path.dirname(embedding_path), exist_ok=True)
-                    save_file(state_dict, embedding_path, metadata=meta)
-
-                    del clip_image
-                    del clip_output
-                    del file_item.clip_image_tensor
-
-                    # flush(garbage_collect=False)
-                file_item.is_vision_clip_cached = True
-                i += 1
-            # flush every 100
-            # if i % 100 == 0:
-            #     flush()
+                    file_item.is_vision_clip_cached = True
 
         # restore device state
         self.sd.restore_device_state()
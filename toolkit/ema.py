@@ -1,14 +1,28 @@
 from __future__ import division
 from __future__ import unicode_literals
 
-from typing import Iterable, Optional
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Iterable, List, Optional
 import weakref
 import copy
 import contextlib
-from toolkit.optimizers.optimizer_utils import copy_stochastic
+from toolkit.optimizers.optimizer_utils import copy_stochastic, copy_stochastic_bf16
 
 import torch
 
+# shadow params are kept in flat buffers of up to this many elements, this bounds the fp32 temporaries of an update
+EMA_BUCKET_MAX_NUMEL = 2 ** 26
+
+
+def _copy_rounded(target: torch.Tensor, source: torch.Tensor):
+    # copy_stochastic only runs on gpu, cpu shadows use the bf16 rounding directly
+    if target.device.type != 'cpu':
+        copy_stochastic(target, source)
+    elif target.dtype == torch.bfloat16:
+        copy_stochastic_bf16(target, source)
+    else:
+        target.copy_(source)
+
 
 # Partially based on:
 # https://github.com/tensorflow/tensorflow/blob/r1.13/tensorflow/python/training/moving_averages.py
@@ -38,6 +52,18 @@ class ExponentialMovingAverage:
 
         use_num_updates: Whether to use number of updates when computing
             averages.
+
+        update_every: Only update the averages every this many calls to
+            `update`. The decay is raised to this power so the average
+            covers about the same number of steps.
+
+        offload_to_cpu: Keep the shadow params in cpu memory. The live
+            params are copied to a pinned staging buffer and the averages
+            are updated on a background thread while training goes on.
+
+    The shadow params are views into flat buffers grouped by device and
+    dtype, so an update is a few fused ops per buffer instead of several
+    per parameter.
     """
 
     def __init__(
@@ -47,21 +73,37 @@ class ExponentialMovingAverage:
             use_num_updates: bool = False,
             # feeds back the decat to the parameter
             use_feedback: bool = False,
-            param_multiplier: float = 1.0
+            param_multiplier: float = 1.0,
+            update_every: int = 1,
+            offload_to_cpu: bool = False,
     ):
         if parameters is None:
             raise ValueError("parameters must be provided")
         if decay < 0.0 or decay > 1.0:
             raise ValueError('Decay must be between 0 and 1')
+        if update_every < 1:
+            raise ValueError('update_every must be at least 1')
+        if offload_to_cpu and use_feedback:
+            raise ValueError('use_feedback needs the shadow params on the same device, it cannot be used with offload_to_cpu')
         self.decay = decay
         self.num_updates = 0 if use_num_updates else None
         self.use_feedback = use_feedback
         self.param_multiplier = param_multiplier
+        self.update_every = update_every
+        self.offload_to_cpu = offload_to_cpu
+        self._num_update_calls = 0
+        # one worker so offloaded updates are applied in order
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pending_update: Optional[Future] = None
+        if offload_to_cpu:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ema_update')
         parameters = list(parameters)
         self.shadow_params = [
-            p.clone().detach()
+            p.detach().to('cpu', copy=True) if offload_to_cpu else p.clone().detach()
             for p in parameters
         ]
+        self._buckets = []
+        self._build_buckets()
         self.collected_params = None
         self._is_train_mode = True
         # By maintaining only a weakref to each parameter,
@@ -114,6 +156,9 @@ class ExponentialMovingAverage:
                 initialized will be used.
         """
         parameters = self._get_parameters(parameters)
+        self._num_update_calls += 1
+        if self._num_update_calls % self.update_every != 0:
+            return
         decay = self.decay
         if self.num_updates is not None:
             self.num_updates += 1
@@ -121,36 +166,131 @@ class ExponentialMovingAverage:
                 decay,
                 (1 + self.num_updates) / (10 + self.num_updates)
             )
-        one_minus_decay = 1.0 - decay
+        # the steps in between were skipped, the current params stand in for them
+        one_minus_decay = 1.0 - decay ** self.update_every
         with torch.no_grad():
-            for s_param, param in zip(self.shadow_params, parameters):
-                s_param_float = s_param.float()
-                if s_param.dtype != torch.float32:
-                    s_param_float = s_param_float.to(torch.float32)
-                param_float = param
-                if param.dtype != torch.float32:
-                    param_float = param_float.to(torch.float32)
-                tmp = (s_param_float - param_float)
-                # tmp will be a new tensor so we can do in-place
-                tmp.mul_(one_minus_decay)
-                s_param_float.sub_(tmp)
-                
-                update_param = False
-                if self.use_feedback:
-                    # make feedback 10x decay
-                    param_float.add_(tmp * 10)
-                    update_param = True
-                
+            if self.offload_to_cpu:
+                self._update_offloaded(parameters, one_minus_decay)
                 if self.param_multiplier != 1.0:
-                    param_float.mul_(self.param_multiplier)
-                    update_param = True
-                
-                if s_param.dtype !=  torch.float32:
-                    copy_stochastic(s_param, s_param_float)
-                
-                if update_param and param.dtype != torch.float32:
-                    copy_stochastic(param, param_float)
-                
+                    for bucket in self._buckets:
+                        params = [parameters[i] for i in bucket['indices']]
+                        param_float = self._flatten_params_fp32(params)
+                        param_float.mul_(self.param_multiplier)
+                        self._write_params(params, param_float)
+                return
+            for bucket in self._buckets:
+                self._update_bucket(bucket, [parameters[i] for i in bucket['indices']], one_minus_decay)
+
+    def _build_buckets(self) -> None:
+        # moves the shadow params into flat buffers, shadow_params become views into them
+        groups = {}
+        chunk_numel = {}
+        for i, s_param in enumerate(self.shadow_params):
+            key = (s_param.device, s_param.dtype)
+            chunks = groups.setdefault(key, [[]])
+            if len(chunks[-1]) > 0 and chunk_numel[key] + s_param.numel() > EMA_BUCKET_MAX_NUMEL:
+                chunks.append([])
+                chunk_numel[key] = 0
+            chunks[-1].append(i)
+            chunk_numel[key] = chunk_numel.get(key, 0) + s_param.numel()
+
+        self._buckets = []
+        for (device, dtype), chunks in groups.items():
+            pin_memory = self.offload_to_cpu and device.type == 'cpu' and torch.cuda.is_available()
+            for indices in chunks:
+                numel = sum(self.shadow_params[i].numel() for i in indices)
+                flat = torch.empty(numel, dtype=dtype, device=device, pin_memory=pin_memory)
+                offset = 0
+                for i in indices:
+                    s_param = self.shadow_params[i]
+                    view = flat[offset:offset + s_param.numel()].view(s_param.shape)
+                    view.copy_(s_param)
+                    self.shadow_params[i] = view
+                    offset += s_param.numel()
+                self._buckets.append({'indices': indices, 'flat': flat, 'staging': None})
+
+    @staticmethod
+    def _flatten_params_fp32(params: List[torch.Tensor]) -> torch.Tensor:
+        return torch.cat([param.reshape(-1).to(torch.float32) for param in params])
+
+    @staticmethod
+    def _write_params(params: List[torch.Tensor], param_float: torch.Tensor) -> None:
+        pieces = [piece.view(param.shape) for param, piece in zip(params, torch.split(param_float, [param.numel() for param in params]))]
+        if all(param.dtype == torch.float32 for param in params):
+            torch._foreach_copy_(params, pieces)
+            return
+        for param, piece in zip(params, pieces):
+            copy_stochastic(param, piece)
+
+    def _update_bucket(self, bucket: dict, params: List[torch.Tensor], one_minus_decay: float) -> None:
+        flat = bucket['flat']
+        shadows = [self.shadow_params[i] for i in bucket['indices']]
+        update_param = self.use_feedback or self.param_multiplier != 1.0
+        if flat.dtype == torch.float32 and not update_param and all(p.dtype == torch.float32 for p in params):
+            # nothing to cast, one fused in place lerp over the bucket
+            torch._foreach_lerp_(shadows, params, one_minus_decay)
+            return
+
+        param_float = self._flatten_params_fp32(params)
+        s_param_float = flat if flat.dtype == torch.float32 else flat.to(torch.float32)
+        if self.use_feedback:
+            tmp = (s_param_float - param_float)
+            tmp.mul_(one_minus_decay)
+            s_param_float.sub_(tmp)
+            # make feedback 10x decay
+            param_float.add_(tmp, alpha=10)
+            del tmp
+        else:
+            s_param_float.lerp_(param_float, one_minus_decay)
+
+        if self.param_multiplier != 1.0:
+            param_float.mul_(self.param_multiplier)
+
+        if flat.dtype != torch.float32:
+            _copy_rounded(flat, s_param_float)
+        if update_param:
+            self._write_params(params, param_float)
+
+    def _update_offloaded(self, parameters: List[torch.Tensor], one_minus_decay: float) -> None:
+        # the staging buffers are reused, so the previous update has to be applied first
+        self._wait_for_update()
+        for bucket in self._buckets:
+            params = [parameters[i] for i in bucket['indices']]
+            staging = bucket['staging']
+            if staging is None:
+                dtypes = set(p.dtype for p in params)
+                staging_dtype = dtypes.pop() if len(dtypes) == 1 else torch.float32
+                staging = torch.empty(
+                    bucket['flat'].numel(), dtype=staging_dtype, device='cpu', pin_memory=torch.cuda.is_available()
+                )
+                bucket['staging'] = staging
+            offset = 0
+            for param in params:
+                staging[offset:offset + param.numel()].view(param.shape).copy_(param, non_blocking=True)
+                offset += param.numel()
+        event = None
+        if any(p.device.type == 'cuda' for p in parameters):
+            event = torch.cuda.Event()
+            event.record()
+        self._pending_update = self._executor.submit(self._apply_offloaded_update, event, one_minus_decay)
+
+    def _apply_offloaded_update(self, event, one_minus_decay: float) -> None:
+        if event is not None:
+            event.synchronize()
+        with torch.no_grad():
+            for bucket in self._buckets:
+                flat = bucket['flat']
+                s_param_float = flat if flat.dtype == torch.float32 else flat.to(torch.float32)
+                s_param_float.lerp_(bucket['staging'].to(torch.float32), one_minus_decay)
+                if flat.dtype != torch.float32:
+                    _copy_rounded(flat, s_param_float)
+
+    def _wait_for_update(self) -> None:
+        # raises any error from an offloaded update
+        if self._pending_update is not None:
+            pending = self._pending_update
+            self._pending_update = None
+            pending.result()
 
     def copy_to(
             self,
@@ -165,6 +305,7 @@ class ExponentialMovingAverage:
                 parameters with which this `ExponentialMovingAverage` was
                 initialized will be used.
         """
+        self._wait_for_update()
         parameters = self._get_parameters(parameters)
         for s_param, param in zip(self.shadow_params, parameters):
             param.data.copy_(s_param.data)
@@ -250,6 +391,7 @@ class ExponentialMovingAverage:
         Args:
             device: like `device` argument to `torch.Tensor.to`
         """
+        self._wait_for_update()
         # .to() on the tensors handles None correctly
         self.shadow_params = [
             p.to(device=device, dtype=dtype)
@@ -264,6 +406,7 @@ class ExponentialMovingAverage:
                 else p.to(device=device)
                 for p in self.collected_params
             ]
+        self._build_buckets()
         return
 
     def state_dict(self) -> dict:
@@ -271,6 +414,7 @@ class ExponentialMovingAverage:
         # Following PyTorch conventions, references to tensors are returned:
         # "returns a reference to the state and not its copy!" -
         # https://pytorch.org/tutorials/beginner/saving_loading_models.html#what-is-a-state-dict
+        self._wait_for_update()
         return {
             "decay": self.decay,
             "num_updates": self.num_updates,
@@ -285,6 +429,7 @@ class ExponentialMovingAverage:
             state_dict (dict): EMA state. Should be an object returned
                 from a call to :meth:`state_dict`.
         """
+        self._wait_for_update()
         # deepcopy, to be consistent with module API
         state_dict = copy.deepcopy(state_dict)
         self.decay = state_dict["decay"]
@@ -321,7 +466,7 @@ class ExponentialMovingAverage:
                 # ^ parameter references are still good
                 for i, p in enumerate(params):
                     self.shadow_params[i] = self.shadow_params[i].to(
-                        device=p.device, dtype=p.dtype
+                        device='cpu' if self.offload_to_cpu else p.device, dtype=p.dtype
                     )
                     if self.collected_params is not None:
                         self.collected_params[i] = self.collected_params[i].to(
@@ -332,6 +477,7 @@ class ExponentialMovingAverage:
                 "Tried to `load_state_dict()` with the wrong number of "
                 "parameters in the saved state."
             )
+        self._build_buckets()
 
     def eval(self):
         if self._is_train_mode:
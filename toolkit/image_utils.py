@@ -266,6 +266,432 @@ def get_image_metadata_from_bytesio(input, size, file_path=None):
                  height=height)
 
 
+# exif orientations that rotate the image by 90 degrees. exif_transpose swaps width and height for these
+EXIF_SWAP_ORIENTATIONS = (5, 6, 7, 8)
+# jpeg start of frame markers. 0xC4, 0xC8 and 0xCC use the same range but are not frames
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+HEIF_BRANDS = {b'avif', b'avis', b'heic', b'heix', b'heim', b'heis', b'hevc', b'hevx', b'mif1', b'msf1'}
+# max bytes of a jpeg exif segment we read before deciding we need the rest of it
+JPEG_EXIF_READ_SIZE = 8192
+
+
+def get_exif_orientation_from_tiff(data: bytes):
+    """
+    Reads the orientation tag from IFD0 of a tiff / exif block.
+    Returns None if data is too short to contain it, 1 if there is no orientation.
+    """
+    if len(data) < 8:
+        return None
+    if data[:2] == b'II':
+        bo = '<'
+    elif data[:2] == b'MM':
+        bo = '>'
+    else:
+        return 1
+    ifd_offset = struct.unpack(bo + 'I', data[4:8])[0]
+    if ifd_offset + 2 > len(data):
+        return None
+    num_entries = struct.unpack(bo + 'H', data[ifd_offset:ifd_offset + 2])[0]
+    for i in range(num_entries):
+        entry = ifd_offset + 2 + i * 12
+        if entry + 12 > len(data):
+            return None
+        tag = struct.unpack(bo + 'H', data[entry:entry + 2])[0]
+        if tag == 0x0112:
+            value_type = struct.unpack(bo + 'H', data[entry + 2:entry + 4])[0]
+            if value_type == 3:
+                value = struct.unpack(bo + 'H', data[entry + 8:entry + 10])[0]
+            elif value_type == 4:
+                value = struct.unpack(bo + 'I', data[entry + 8:entry + 12])[0]
+            else:
+                return 1
+            return value if 1 <= value <= 8 else 1
+    return 1
+
+
+def _strip_exif_header(data: bytes):
+    if data.startswith(b'Exif\x00\x00'):
+        return data[6:]
+    return data
+
+
+def _probe_jpeg(f):
+    f.seek(2)
+    orientation = 1
+    while True:
+        b = f.read(1)
+        while b and b != b'\xff':
+            b = f.read(1)
+        while b == b'\xff':
+            b = f.read(1)
+        if not b:
+            raise UnknownImageFormat("Reached end of JPEG without finding a frame")
+        marker = b[0]
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            # markers without a length
+            continue
+        if marker in (0xD9, 0xDA):
+            raise UnknownImageFormat("Reached image data in JPEG without finding a frame")
+        length = struct.unpack('>H', f.read(2))[0]
+        if marker == 0xE1:
+            segment_start = f.tell()
+            data = f.read(min(length - 2, JPEG_EXIF_READ_SIZE))
+            if data.startswith(b'Exif\x00\x00'):
+                exif_orientation = get_exif_orientation_from_tiff(data[6:])
+                if exif_orientation is None and length - 2 > len(data):
+                    # ifd0 is further in, read the whole segment
+                    f.seek(segment_start)
+                    data = f.read(length - 2)
+                    exif_orientation = get_exif_orientation_from_tiff(data[6:])
+                orientation = exif_orientation if exif_orientation is not None else 1
+            f.seek(segment_start + length - 2)
+        elif marker in JPEG_SOF_MARKERS:
+            data = f.read(5)
+            height, width = struct.unpack('>HH', data[1:5])
+            return width, height, orientation
+        else:
+            f.seek(length - 2, 1)
+
+
+def _probe_png(f):
+    f.seek(8)
+    width = height = None
+    orientation = 1
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            break
+        length, chunk_type = struct.unpack('>I4s', header)
+        if chunk_type == b'IHDR':
+            width, height = struct.unpack('>II', f.read(8))
+            f.seek(length - 8 + 4, 1)
+        elif chunk_type == b'eXIf':
+            orientation = get_exif_orientation_from_tiff(_strip_exif_header(f.read(length))) or 1
+            f.seek(4, 1)
+        elif chunk_type in (b'IDAT', b'IEND'):
+            # exif has to come before the image data
+            break
+        else:
+            f.seek(length + 4, 1)
+    if width is None:
+        raise UnknownImageFormat("PNG without IHDR chunk")
+    return width, height, orientation
+
+
+def _probe_webp(f):
+    f.seek(12)
+    width = height = None
+    has_exif = False
+    is_extended = False
+    orientation = 1
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            break
+        chunk_type = header[:4]
+        chunk_size = struct.unpack('<I', header[4:8])[0]
+        chunk_end = f.tell() + chunk_size + (chunk_size & 1)
+        if chunk_type == b'VP8X':
+            data = f.read(10)
+            is_extended = True
+            has_exif = bool(data[0] & 0x08)
+            width = 1 + int.from_bytes(data[4:7], 'little')
+            height = 1 + int.from_bytes(data[7:10], 'little')
+        elif chunk_type == b'VP8 ' and width is None:
+            data = f.read(10)
+            if data[3:6] != b'\x9d\x01\x2a':
+                raise UnknownImageFormat("Invalid VP8 frame header")
+            width = struct.unpack('<H', data[6:8])[0] & 0x3fff
+            height = struct.unpack('<H', data[8:10])[0] & 0x3fff
+        elif chunk_type == b'VP8L' and width is None:
+            data = f.read(5)
+            if data[0] != 0x2f:
+                raise UnknownImageFormat("Invalid VP8L signature")
+            bits = struct.unpack('<I', data[1:5])[0]
+            width = (bits & 0x3fff) + 1
+            height = ((bits >> 14) & 0x3fff) + 1
+        elif chunk_type == b'EXIF':
+            orientation = get_exif_orientation_from_tiff(_strip_exif_header(f.read(chunk_size))) or 1
+            break
+        if width is not None and (not is_extended or not has_exif):
+            break
+        # exif is usually after the image data, skip over it without reading it
+        f.seek(chunk_end)
+    if width is None:
+        raise UnknownImageFormat("WebP without image data")
+    return width, height, orientation
+
+
+def _iter_boxes(f, start, end):
+    # iso base media file format boxes (mp4, mov, heif, avif)
+    pos = start
+    while pos + 8 <= end:
+        f.seek(pos)
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        size, box_type = struct.unpack('>I4s', header)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack('>Q', f.read(8))[0]
+            header_size = 16
+        elif size == 0:
+            size = end - pos
+        if size < header_size:
+            return
+        yield box_type, pos + header_size, min(pos + size, end)
+        pos += size
+
+
+def _find_box(f, start, end, box_type):
+    for child_type, child_start, child_end in _iter_boxes(f, start, end):
+        if child_type == box_type:
+            return child_start, child_end
+    return None
+
+
+def _probe_heif(f, file_size):
+    meta = _find_box(f, 0, file_size, b'meta')
+    if meta is None:
+        raise UnknownImageFormat("HEIF without meta box")
+    # meta is a full box, skip version and flags
+    meta_start, meta_end = meta[0] + 4, meta[1]
+    primary_id = None
+    properties = []
+    associations = {}
+    for box_type, start, end in _iter_boxes(f, meta_start, meta_end):
+        if box_type == b'pitm':
+            f.seek(start)
+            version = f.read(4)[0]
+            primary_id = struct.unpack('>I' if version > 0 else '>H', f.read(4 if version > 0 else 2))[0]
+        elif box_type == b'iprp':
+            for prop_type, prop_start, prop_end in _iter_boxes(f, start, end):
+                if prop_type == b'ipco':
+                    properties = list(_iter_boxes(f, prop_start, prop_end))
+                elif prop_type == b'ipma':
+                    f.seek(prop_start)
+                    data = f.read(prop_end - prop_start)
+                    version = data[0]
+                    flags = int.from_bytes(data[1:4], 'big')
+                    pos = 4
+                    entry_count = struct.unpack('>I', data[pos:pos + 4])[0]
+                    pos += 4
+                    for _ in range(entry_count):
+                        if version < 1:
+                            item_id = struct.unpack('>H', data[pos:pos + 2])[0]
+                            pos += 2
+                        else:
+                            item_id = struct.unpack('>I', data[pos:pos + 4])[0]
+                            pos += 4
+                        count = data[pos]
+                        pos += 1
+                        indexes = []
+                        for _ in range(count):
+                            if flags & 1:
+                                indexes.append(struct.unpack('>H', data[pos:pos + 2])[0] & 0x7fff)
+                                pos += 2
+                            else:
+                                indexes.append(data[pos] & 0x7f)
+                                pos += 1
+                        associations[item_id] = indexes
+
+    if primary_id is not None and primary_id in associations:
+        # property indexes are 1 based, 0 means none
+        item_properties = [properties[i - 1] for i in associations[primary_id] if 0 < i <= len(properties)]
+    else:
+        item_properties = properties
+
+    width = height = None
+    rotation = 0
+    for box_type, start, end in item_properties:
+        if box_type == b'ispe' and width is None:
+            f.seek(start + 4)
+            width, height = struct.unpack('>II', f.read(8))
+        elif box_type == b'irot':
+            f.seek(start)
+            rotation = f.read(1)[0] & 0x3
+    if width is None:
+        raise UnknownImageFormat("HEIF without image size")
+    if rotation in (1, 3):
+        width, height = height, width
+    return width, height
+
+
+def _probe_mp4(f, file_size):
+    moov = _find_box(f, 0, file_size, b'moov')
+    if moov is None:
+        raise UnknownImageFormat("Video without moov box")
+    for box_type, trak_start, trak_end in _iter_boxes(f, moov[0], moov[1]):
+        if box_type != b'trak':
+            continue
+        size = None
+        is_video = False
+        for child_type, start, end in _iter_boxes(f, trak_start, trak_end):
+            if child_type == b'tkhd':
+                f.seek(start)
+                version = f.read(1)[0]
+                # skip flags, times, track id and duration, then reserved, layer, group and volume
+                f.seek(start + (36 if version == 1 else 24) + 16)
+                matrix = struct.unpack('>9i', f.read(36))
+                width, height = struct.unpack('>II', f.read(8))
+                width, height = width >> 16, height >> 16
+                if matrix[0] == 0 and matrix[4] == 0:
+                    # rotated 90 or 270 degrees, decoders apply this
+                    width, height = height, width
+                size = (width, height)
+            elif child_type == b'mdia':
+                hdlr = _find_box(f, start, end, b'hdlr')
+                if hdlr is not None:
+                    f.seek(hdlr[0] + 8)
+                    is_video = f.read(4) == b'vide'
+        if is_video and size is not None and size[0] > 0 and size[1] > 0:
+            return size
+    raise UnknownImageFormat("Video without a video track")
+
+
+def _read_ebml_vint(f, keep_marker=False):
+    first = f.read(1)
+    if not first:
+        raise UnknownImageFormat("Unexpected end of EBML data")
+    first = first[0]
+    length = 1
+    mask = 0x80
+    while length <= 8 and not (first & mask):
+        mask >>= 1
+        length += 1
+    if length > 8:
+        raise UnknownImageFormat("Invalid EBML variable integer")
+    value = first if keep_marker else first & (mask - 1)
+    all_ones = (first & (mask - 1)) == mask - 1
+    for b in f.read(length - 1):
+        value = (value << 8) | b
+        all_ones = all_ones and b == 0xFF
+    return value, (None if all_ones and not keep_marker else value)
+
+
+def _read_ebml_uint(f, size):
+    return int.from_bytes(f.read(size), 'big')
+
+
+def _iter_ebml(f, start, end):
+    pos = start
+    while pos < end:
+        f.seek(pos)
+        element_id, _ = _read_ebml_vint(f, keep_marker=True)
+        _, size = _read_ebml_vint(f)
+        data_start = f.tell()
+        data_end = end if size is None else data_start + size
+        yield element_id, data_start, data_end
+        if size is None:
+            return
+        pos = data_end
+
+
+def _probe_matroska(f, file_size):
+    segment = None
+    for element_id, start, end in _iter_ebml(f, 0, file_size):
+        if element_id == 0x18538067:
+            segment = (start, end)
+            break
+    if segment is None:
+        raise UnknownImageFormat("Matroska without segment")
+    for element_id, start, end in _iter_ebml(f, segment[0], segment[1]):
+        if element_id == 0x1F43B675:
+            # cluster, tracks come before the media data
+            break
+        if element_id != 0x1654AE6B:
+            continue
+        for entry_id, entry_start, entry_end in _iter_ebml(f, start, end):
+            if entry_id != 0xAE:
+                continue
+            track_type = None
+            width = height = None
+            for child_id, child_start, child_end in _iter_ebml(f, entry_start, entry_end):
+                if child_id == 0x83:
+                    f.seek(child_start)
+                    track_type = _read_ebml_uint(f, child_end - child_start)
+                elif child_id == 0xE0:
+                    for video_id, video_start, video_end in _iter_ebml(f, child_start, child_end):
+                        f.seek(video_start)
+                        if video_id == 0xB0:
+                            width = _read_ebml_uint(f, video_end - video_start)
+                        elif video_id == 0xBA:
+                            height = _read_ebml_uint(f, video_end - video_start)
+            if track_type == 1 and width and height:
+                return width, height
+    raise UnknownImageFormat("Matroska without a video track")
+
+
+def _probe_avi(f):
+    f.seek(0)
+    data = f.read(72)
+    if len(data) < 72 or data[12:16] != b'LIST' or data[20:24] != b'hdrl' or data[24:28] != b'avih':
+        raise UnknownImageFormat("AVI without main header")
+    width, height = struct.unpack('<II', data[64:72])
+    return width, height
+
+
+def _read_oriented_image_size(f, file_size, file_path):
+    head = f.read(32)
+    if head.startswith(b'\xff\xd8'):
+        width, height, orientation = _probe_jpeg(f)
+    elif head.startswith(b'\211PNG\r\n\032\n'):
+        width, height, orientation = _probe_png(f)
+    elif head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        width, height, orientation = _probe_webp(f)
+    elif head[4:8] == b'ftyp' and head[8:12] in HEIF_BRANDS:
+        return _probe_heif(f, file_size)
+    elif head[:6] in (b'GIF87a', b'GIF89a') or head.startswith(b'BM'):
+        # no orientation in these formats
+        f.seek(0)
+        img = get_image_metadata_from_bytesio(f, file_size, file_path)
+        return img.width, img.height
+    else:
+        raise UnknownImageFormat(FILE_UNKNOWN)
+    if orientation in EXIF_SWAP_ORIENTATIONS:
+        width, height = height, width
+    return width, height
+
+
+def _read_video_size(f, file_size):
+    head = f.read(16)
+    if head[4:8] == b'ftyp':
+        return _probe_mp4(f, file_size)
+    elif head[:4] == b'\x1a\x45\xdf\xa3':
+        return _probe_matroska(f, file_size)
+    elif head[:4] == b'RIFF' and head[8:12] == b'AVI ':
+        return _probe_avi(f)
+    raise UnknownImageFormat(FILE_UNKNOWN)
+
+
+def get_oriented_image_size(file_path):
+    """
+    Return (width, height) of an image as it will be after exif_transpose, reading only the headers.
+    Supports JPEG (APP1 exif), PNG (eXIf), WebP (EXIF chunk), AVIF / HEIF (irot) plus GIF and BMP.
+    Raises UnknownImageFormat for anything else, or a malformed header, so the caller can fall back to PIL.
+    """
+    file_size = os.path.getsize(file_path)
+    with io.open(file_path, "rb") as f:
+        try:
+            return _read_oriented_image_size(f, file_size, file_path)
+        except (struct.error, IndexError, ValueError) as e:
+            raise UnknownImageFormat(f"Malformed image header in {file_path}: {e}")
+
+
+def get_video_size(file_path):
+    """
+    Return (width, height) of the first video track, reading only the container headers.
+    Supports MP4 / MOV / M4V (rotation applied), MKV / WebM and AVI.
+    Raises UnknownImageFormat for anything else, or a malformed header, so the caller can fall back to OpenCV.
+    """
+    file_size = os.path.getsize(file_path)
+    with io.open(file_path, "rb") as f:
+        try:
+            return _read_video_size(f, file_size)
+        except (struct.error, IndexError, ValueError) as e:
+            raise UnknownImageFormat(f"Malformed video header in {file_path}: {e}")
+
+
 import unittest
 
 
@@ -332,6 +758,119 @@ class Test_get_image_size(unittest.TestCase):
         pass
 
 
+def _test_exif(orientation):
+    # little endian tiff with a single orientation entry in ifd0
+    entry = struct.pack('<HHIHH', 0x0112, 3, 1, orientation, 0)
+    return b'Exif\x00\x00' + b'II*\x00' + struct.pack('<I', 8) + struct.pack('<H', 1) + entry + b'\x00' * 4
+
+
+def _test_png_chunk(chunk_type, data):
+    return struct.pack('>I', len(data)) + chunk_type + data + b'\x00' * 4
+
+
+def _test_riff_chunk(chunk_type, data):
+    return chunk_type + struct.pack('<I', len(data)) + data + (b'\x00' if len(data) & 1 else b'')
+
+
+def _test_box(box_type, data):
+    return struct.pack('>I', len(data) + 8) + box_type + data
+
+
+def _test_full_box(box_type, version, data):
+    return _test_box(box_type, bytes([version, 0, 0, 0]) + data)
+
+
+class Test_header_probes(unittest.TestCase):
+
+    def oriented_size(self, data):
+        return _read_oriented_image_size(io.BytesIO(data), len(data), None)
+
+    def video_size(self, data):
+        return _read_video_size(io.BytesIO(data), len(data))
+
+    def png(self, width, height, orientation=None):
+        data = b'\211PNG\r\n\032\n'
+        data += _test_png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+        if orientation is not None:
+            data += _test_png_chunk(b'eXIf', _test_exif(orientation)[6:])
+        data += _test_png_chunk(b'IDAT', b'\x00' * 16)
+        return data + _test_png_chunk(b'IEND', b'')
+
+    def webp(self, chunks):
+        body = b'WEBP' + b''.join(chunks)
+        return b'RIFF' + struct.pack('<I', len(body)) + body
+
+    def heif(self, width, height, rotation=None):
+        properties = [_test_full_box(b'ispe', 0, struct.pack('>II', width, height))]
+        if rotation is not None:
+            properties.append(_test_box(b'irot', bytes([rotation])))
+        indexes = bytes(i + 1 for i in range(len(properties)))
+        ipma = _test_full_box(b'ipma', 0, struct.pack('>IHB', 1, 1, len(indexes)) + indexes)
+        iprp = _test_box(b'iprp', _test_box(b'ipco', b''.join(properties)) + ipma)
+        meta = _test_full_box(b'meta', 0, _test_full_box(b'pitm', 0, struct.pack('>H', 1)) + iprp)
+        return _test_box(b'ftyp', b'heic' + b'\x00' * 4 + b'mif1heic') + meta
+
+    def mp4(self, version, width, height, rotated=False):
+        if version == 1:
+            times = struct.pack('>QQIIQ', 0, 0, 1, 0, 1000)
+        else:
+            times = struct.pack('>IIIII', 0, 0, 1, 0, 1000)
+        if rotated:
+            matrix = (0, 0x10000, 0, -0x10000, 0, 0, 0, 0, 0x40000000)
+        else:
+            matrix = (0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+        tkhd = _test_full_box(
+            b'tkhd', version,
+            times + b'\x00' * 8 + struct.pack('>hhhH', 0, 0, 0x0100, 0) + struct.pack('>9i', *matrix)
+            + struct.pack('>II', width << 16, height << 16)
+        )
+        hdlr = _test_full_box(b'hdlr', 0, b'\x00' * 4 + b'vide' + b'\x00' * 12 + b'video\x00')
+        trak = _test_box(b'trak', tkhd + _test_box(b'mdia', hdlr))
+        return _test_box(b'ftyp', b'isom' + b'\x00' * 4 + b'isommp41') + _test_box(b'moov', trak)
+
+    def test_png(self):
+        self.assertEqual(self.oriented_size(self.png(640, 480)), (640, 480))
+
+    def test_png_exif_rotated(self):
+        self.assertEqual(self.oriented_size(self.png(640, 480, orientation=6)), (480, 640))
+        self.assertEqual(self.oriented_size(self.png(640, 480, orientation=3)), (640, 480))
+
+    def test_webp_lossy(self):
+        frame = b'\x00' * 3 + b'\x9d\x01\x2a' + struct.pack('<HH', 800, 600)
+        self.assertEqual(self.oriented_size(self.webp([_test_riff_chunk(b'VP8 ', frame)])), (800, 600))
+
+    def test_webp_lossless(self):
+        bits = (800 - 1) | ((600 - 1) << 14)
+        frame = b'\x2f' + struct.pack('<I', bits)
+        self.assertEqual(self.oriented_size(self.webp([_test_riff_chunk(b'VP8L', frame)])), (800, 600))
+
+    def test_webp_extended_exif(self):
+        vp8x = bytes([0x08, 0, 0, 0]) + (800 - 1).to_bytes(3, 'little') + (600 - 1).to_bytes(3, 'little')
+        chunks = [
+            _test_riff_chunk(b'VP8X', vp8x),
+            _test_riff_chunk(b'VP8L', b'\x2f' + b'\x00' * 8),
+            _test_riff_chunk(b'EXIF', _test_exif(8)),
+        ]
+        self.assertEqual(self.oriented_size(self.webp(chunks)), (600, 800))
+
+    def test_heif(self):
+        self.assertEqual(self.oriented_size(self.heif(4032, 3024)), (4032, 3024))
+
+    def test_heif_irot(self):
+        self.assertEqual(self.oriented_size(self.heif(4032, 3024, rotation=1)), (3024, 4032))
+        self.assertEqual(self.oriented_size(self.heif(4032, 3024, rotation=2)), (4032, 3024))
+
+    def test_mp4_tkhd_v0(self):
+        self.assertEqual(self.video_size(self.mp4(0, 1920, 1080)), (1920, 1080))
+
+    def test_mp4_tkhd_v1(self):
+        self.assertEqual(self.video_size(self.mp4(1, 1920, 1080)), (1920, 1080))
+
+    def test_mp4_rotated(self):
+        self.assertEqual(self.video_size(self.mp4(0, 1920, 1080, rotated=True)), (1080, 1920))
+        self.assertEqual(self.video_size(self.mp4(1, 1920, 1080, rotated=True)), (1080, 1920))
+
+
 def main(argv=None):
     """
     Print image metadata fields for the given file path.
@@ -0,0 +1,123 @@
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+
+class JobStatusWorker:
+    """
+    Keeps a job row in the UI sqlite database in sync from one background thread with one long lived
+    connection. Updates are only queued in memory and written together every flush_interval, so many
+    step updates between writes become a single UPDATE. The stop and return_to_queue columns are polled
+    every poll_interval and kept as flags, so the training loop never waits on the database.
+
+    Processes that should not write (non main accelerate processes) still poll the stop flags.
+    """
+
+    def __init__(
+            self,
+            db_path: str,
+            job_id: str,
+            write: bool = True,
+            flush_interval: float = 1.0,
+            poll_interval: float = 1.0,
+    ):
+        self.db_path = db_path
+        self.job_id = job_id
+        self.write = write
+        self.flush_interval = flush_interval
+        self.poll_interval = poll_interval
+        self.stop_requested = False
+        self.return_to_queue_requested = False
+        self._pending: OrderedDict = OrderedDict()
+        self._pending_lock = threading.Lock()
+        self._conn_lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._worker, name='job_status_worker', daemon=True)
+        self._thread.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10.0, check_same_thread=False)
+            conn.isolation_level = None  # autocommit, transactions are explicit
+            try:
+                # readers (the UI) no longer block our writes and we do not block theirs
+                conn.execute("PRAGMA journal_mode=WAL")
+            except sqlite3.Error as e:
+                print(f"Could not enable WAL mode on {self.db_path}: {e}")
+            self._conn = conn
+        return self._conn
+
+    def _worker(self):
+        last_poll = 0.0
+        while not self._closed.is_set():
+            try:
+                self.flush()
+                if time.monotonic() - last_poll >= self.poll_interval:
+                    self.poll()
+                    last_poll = time.monotonic()
+            except Exception as e:
+                print(f"Error updating job status: {e}")
+            self._closed.wait(min(self.flush_interval, self.poll_interval))
+
+    def update(self, key: str, value):
+        if not self.write:
+            return
+        with self._pending_lock:
+            # a newer value for the same column replaces the queued one
+            self._pending.pop(key, None)
+            self._pending[key] = value if isinstance(value, str) else str(value)
+
+    def update_status(self, status: str, info: Optional[str] = None):
+        self.update("status", status)
+        if info is not None:
+            self.update("info", info)
+
+    def flush(self):
+        """Write everything queued now, on the calling thread."""
+        with self._pending_lock:
+            if len(self._pending) == 0:
+                return
+            pending = self._pending
+            self._pending = OrderedDict()
+        keys = list(pending.keys())
+        update_query = f"UPDATE Job SET {', '.join(f'{key} = ?' for key in keys)} WHERE id = ?"
+        try:
+            with self._conn_lock:
+                conn = self._connect()
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    conn.execute(update_query, (*pending.values(), self.job_id))
+                finally:
+                    conn.execute("COMMIT")
+        except Exception:
+            # put them back unless something newer was queued while we tried
+            with self._pending_lock:
+                for key, value in pending.items():
+                    self._pending.setdefault(key, value)
+            raise
+
+    def poll(self):
+        with self._conn_lock:
+            row = self._connect().execute(
+                "SELECT stop, return_to_queue FROM Job WHERE id = ?", (self.job_id,)
+            ).fetchone()
+        if row is not None:
+            self.stop_requested = row[0] == 1
+            self.return_to_queue_requested = row[1] == 1
+
+    def close(self):
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self._thread.join(timeout=30)
+        try:
+            self.flush()
+        except Exception as e:
+            print(f"Error updating job status: {e}")
+        with self._conn_lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
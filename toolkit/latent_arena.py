@@ -0,0 +1,82 @@
+import threading
+from typing import List, Tuple
+
+import torch
+
+# offsets are rounded up to this so every latent view is aligned for any dtype
+ARENA_ALIGNMENT = 64
+
+# (chunk index, byte offset, number of bytes, dtype, shape)
+LatentRef = Tuple[int, int, int, torch.dtype, Tuple[int, ...]]
+
+
+class LatentMemoryArena:
+    """
+    Holds the in memory latent cache in a few large shared memory buffers instead of one tensor per
+    file item. File items only keep a small LatentRef and get a zero copy view back, so deep copying
+    an item does not copy its latent and forked dataloader workers read the same pages as the main
+    process instead of each touching (and duplicating) thousands of small tensors.
+
+    Buffers are allocated in chunks of chunk_size_mb as latents are added. When expected_items is
+    given, chunks are sized for the latents that are still expected so small datasets do not
+    reserve a full chunk.
+    """
+
+    def __init__(self, chunk_size_mb: int = 256, expected_items: int = 0):
+        self.chunk_size_bytes = int(chunk_size_mb * 1024 * 1024)
+        self.expected_items = expected_items
+        self.chunks: List[torch.Tensor] = []
+        self.num_items = 0
+        self.num_bytes = 0
+        self._offset = 0
+        self._lock = threading.Lock()
+
+    def _new_chunk(self, nbytes: int):
+        remaining_items = max(1, self.expected_items - self.num_items)
+        size = min(self.chunk_size_bytes, (nbytes + ARENA_ALIGNMENT) * remaining_items)
+        size = max(size, nbytes)
+        # shared memory is passed to dataloader workers by handle, never copied
+        chunk = torch.empty(size, dtype=torch.uint8).share_memory_()
+        self.chunks.append(chunk)
+        self._offset = 0
+
+    def put(self, tensor: torch.Tensor) -> LatentRef:
+        tensor = tensor.detach().to('cpu').contiguous()
+        nbytes = tensor.numel() * tensor.element_size()
+        with self._lock:
+            if len(self.chunks) == 0 or self._offset + nbytes > self.chunks[-1].numel():
+                self._new_chunk(nbytes)
+            chunk_idx = len(self.chunks) - 1
+            offset = self._offset
+            if nbytes > 0:
+                self.chunks[chunk_idx][offset:offset + nbytes].copy_(tensor.reshape(-1).view(torch.uint8))
+            self._offset = (offset + nbytes + ARENA_ALIGNMENT - 1) // ARENA_ALIGNMENT * ARENA_ALIGNMENT
+            self.num_items += 1
+            self.num_bytes += nbytes
+        return chunk_idx, offset, nbytes, tensor.dtype, tuple(tensor.shape)
+
+    def get(self, ref: LatentRef) -> torch.Tensor:
+        # a view into the arena. Callers must not modify it in place
+        chunk_idx, offset, nbytes, dtype, shape = ref
+        if nbytes == 0:
+            return torch.empty(shape, dtype=dtype)
+        return self.chunks[chunk_idx][offset:offset + nbytes].view(dtype).view(shape)
+
+    @property
+    def reserved_bytes(self) -> int:
+        return sum(chunk.numel() for chunk in self.chunks)
+
+    # a deep copied file item, like a flipped one, should point into the same arena instead of a copy of it
+    def __deepcopy__(self, memo):
+        return self
+
+    # locks cannot be sent to dataloader workers, they are recreated there
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
@@ -0,0 +1,157 @@
+import json
+import mmap
+import os
+import threading
+from typing import Dict, Union
+
+import numpy as np
+import torch
+
+# stored in the index so we can rebuild tensors without pickling
+DTYPE_TO_STR = {
+    torch.float32: 'float32',
+    torch.float16: 'float16',
+    torch.bfloat16: 'bfloat16',
+    torch.float64: 'float64',
+}
+STR_TO_DTYPE = {v: k for k, v in DTYPE_TO_STR.items()}
+
+SHARD_DIR_NAME = 'shards'
+INDEX_FILE_NAME = 'index.jsonl'
+
+
+class LatentShardStore:
+    """
+    Packs cached latents for one folder into a few large append only shard files instead of one
+    safetensors file per image. Every latent is appended as raw bytes to the current shard and a
+    json line with its location is appended to index.jsonl. Data is always written before the index
+    line, so a crash can only leave unreferenced bytes at the end of a shard, never a bad entry.
+
+    Keys are the same {filename}_{hash} names used by the per file cache, so the latent info dict
+    hash still decides when a latent is stale. Reads use a memory map of the shard.
+    """
+
+    def __init__(self, cache_dir: str, shard_size_mb: int = 1024):
+        self.cache_dir = cache_dir
+        self.shard_dir = os.path.join(cache_dir, SHARD_DIR_NAME)
+        self.index_path = os.path.join(self.shard_dir, INDEX_FILE_NAME)
+        self.shard_size_bytes = int(shard_size_mb * 1024 * 1024)
+        self.index: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        self._maps: Dict[int, mmap.mmap] = {}
+        self._current_shard = 0
+        self._load_index()
+
+    def _load_index(self):
+        self.index = {}
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # partial last line from an interrupted write
+                    continue
+                self.index[entry['key']] = entry
+                self._current_shard = max(self._current_shard, entry['shard'])
+
+    def get_shard_path(self, shard_idx: int):
+        return os.path.join(self.shard_dir, f'shard_{shard_idx:05d}.bin')
+
+    def __contains__(self, key: str):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def write(self, key: str, tensor: torch.Tensor, metadata: Union[dict, None] = None):
+        tensor = tensor.detach().to('cpu').contiguous()
+        if tensor.dtype not in DTYPE_TO_STR:
+            raise ValueError(f"Unsupported dtype for latent shards: {tensor.dtype}")
+        data = tensor.view(torch.uint8).numpy().tobytes() if tensor.numel() > 0 else b''
+        with self._lock:
+            os.makedirs(self.shard_dir, exist_ok=True)
+            shard_path = self.get_shard_path(self._current_shard)
+            if os.path.exists(shard_path) and os.path.getsize(shard_path) + len(data) > self.shard_size_bytes:
+                self._current_shard += 1
+                shard_path = self.get_shard_path(self._current_shard)
+            with open(shard_path, 'ab') as f:
+                offset = f.tell()
+                f.write(data)
+            entry = {
+                'key': key,
+                'shard': self._current_shard,
+                'offset': offset,
+                'nbytes': len(data),
+                'dtype': DTYPE_TO_STR[tensor.dtype],
+                'shape': list(tensor.shape),
+            }
+            if metadata is not None:
+                entry['metadata'] = metadata
+            with open(self.index_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry) + '\n')
+            self.index[key] = entry
+
+    def _get_map(self, shard_idx: int, min_size: int) -> mmap.mmap:
+        mm = self._maps.get(shard_idx)
+        if mm is None or len(mm) < min_size:
+            # the shard grew since we mapped it, map it again
+            if mm is not None:
+                mm.close()
+            with open(self.get_shard_path(shard_idx), 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[shard_idx] = mm
+        return mm
+
+    def load(self, key: str) -> torch.Tensor:
+        entry = self.index.get(key)
+        if entry is None:
+            raise KeyError(f"Latent {key} not found in shard cache {self.shard_dir}")
+        dtype = STR_TO_DTYPE[entry['dtype']]
+        nbytes = entry['nbytes']
+        if nbytes == 0:
+            return torch.empty(entry['shape'], dtype=dtype)
+        with self._lock:
+            mm = self._get_map(entry['shard'], entry['offset'] + nbytes)
+            buffer = np.frombuffer(mm, dtype=np.uint8, count=nbytes, offset=entry['offset'])
+            # copy out of the map so the tensor does not keep the file mapped
+            tensor = torch.from_numpy(buffer.copy())
+        return tensor.view(dtype).reshape(entry['shape'])
+
+    def close(self):
+        with self._lock:
+            for mm in self._maps.values():
+                mm.close()
+            self._maps = {}
+
+    # a deep copied file item, like a flipped one, should read the same shards instead of mapping them again
+    def __deepcopy__(self, memo):
+        return self
+
+    # maps and locks cannot be sent to dataloader workers, they are recreated there
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_maps'] = {}
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+_stores: Dict[str, LatentShardStore] = {}
+_stores_lock = threading.Lock()
+
+
+def get_latent_shard_store(cache_dir: str, shard_size_mb: int = 1024) -> LatentShardStore:
+    # one store per cache folder per process
+    cache_dir = os.path.abspath(cache_dir)
+    with _stores_lock:
+        if cache_dir not in _stores:
+            _stores[cache_dir] = LatentShardStore(cache_dir, shard_size_mb=shard_size_mb)
+        return _stores[cache_dir]
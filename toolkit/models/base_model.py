@@ -24,6 +24,8 @@ from toolkit.models.decorator import Decorator
 from toolkit.paths import KEYMAPS_ROOT
 from toolkit.prompt_utils import inject_trigger_into_prompt, PromptEmbeds, concat_prompt_embeds
 from toolkit.reference_adapter import ReferenceAdapter
+from toolkit.sample_batching import get_sample_batches, get_embeds_signature
+from toolkit.sample_writer import SampleWriter
 from toolkit.sd_device_states_presets import empty_preset
 from toolkit.train_tools import get_torch_dtype, apply_noise_offset
 import torch
@@ -102,6 +104,8 @@ UNET_IN_CHANNELS = 4  # Stable Diffusion の in_channels は 4 で固定。XLも
 class BaseModel:
     # override these in child classes
     arch = None
+    # generate_single_image can generate several prompts with the same settings in one call
+    supports_batched_generation = False
 
     def __init__(
             self,
@@ -167,6 +171,7 @@ class BaseModel:
         # merge in and preview active with -1 weight
         self.invert_assistant_lora = False
         self._after_sample_img_hooks = []
+        self.sample_writer = SampleWriter()
         self._status_update_hooks = []
         self.is_transformer = False
 
@@ -279,10 +284,12 @@ class BaseModel:
         gen_config: GenerateImageConfig,
         conditional_embeds: PromptEmbeds,
         unconditional_embeds: PromptEmbeds,
-        generator: torch.Generator,
+        generator: Union[torch.Generator, List[torch.Generator]],
         extra: dict,
     ):
-        # override this in child classes
+        # override this in child classes. With supports_batched_generation, the embeds can hold several
+        # prompts that share gen_config's settings. generator is then a list with one generator per prompt,
+        # and a list of images is returned
         raise NotImplementedError(
             "generate_single_image must be implemented in child classes")
 
@@ -359,10 +366,22 @@ class BaseModel:
             sampler=None,
             pipeline: Union[None, StableDiffusionPipeline,
                             StableDiffusionXLPipeline] = None,
+            batch_size: int = 1,
+            wait_for_writes: bool = True,
     ):
         network = self.network
         merge_multiplier = 1.0
         flush()
+        if batch_size > 1:
+            reason = None
+            if not self.supports_batched_generation:
+                reason = f"{type(self).__name__} does not support batched generation"
+            elif self.adapter is not None or self.refiner_unet is not None or \
+                    any(gen_config.latents is not None for gen_config in image_configs):
+                reason = "adapters, the refiner and fixed latents hold state for a single image"
+            if reason is not None:
+                print_acc(f"Warning: sample batch_size {batch_size} ignored, {reason}. Generating one image at a time")
+                batch_size = 1
         # if using assistant, unfuse it
         if self.model_config.assistant_lora_path is not None:
             print_acc("Unloading assistant lora")
@@ -419,242 +438,271 @@ class BaseModel:
                 if network is not None:
                     assert network.is_active
 
-                for i in tqdm(range(len(image_configs)), desc=f"Generating Images", leave=False):
-                    gen_config = image_configs[i]
-
-                    extra = {}
-                    validation_image = None
-                    if self.adapter is not None and gen_config.adapter_image_path is not None:
-                        validation_image = Image.open(gen_config.adapter_image_path)
-                        if ".inpaint." not in gen_config.adapter_image_path:
-                            validation_image = validation_image.convert("RGB")
+                num_done = 0
+                last_size = None
+                for batch in tqdm(get_sample_batches(image_configs, batch_size), desc=f"Generating Images", leave=False):
+                    # memory is only freed when the size changes, batches of the same size reuse it
+                    size = (image_configs[batch[0]].width, image_configs[batch[0]].height, image_configs[batch[0]].num_frames)
+                    if last_size is not None and size != last_size:
+                        flush()
+                    last_size = size
+                    prepared = []
+                    for i in batch:
+                        gen_config = image_configs[i]
+
+                        extra = {}
+                        validation_image = None
+                        if self.adapter is not None and gen_config.adapter_image_path is not None:
+                            validation_image = Image.open(gen_config.adapter_image_path)
+                            if ".inpaint." not in gen_config.adapter_image_path:
+                                validation_image = validation_image.convert("RGB")
+                            else:
+                                # make sure it has an alpha
+                                if validation_image.mode != "RGBA":
+                                    raise ValueError("Inpainting images must have an alpha channel")
+                            if isinstance(self.adapter, T2IAdapter):
+                                # not sure why this is double??
+                                validation_image = validation_image.resize(
+                                    (gen_config.width * 2, gen_config.height * 2))
+                                extra['image'] = validation_image
+                                extra['adapter_conditioning_scale'] = gen_config.adapter_conditioning_scale
+                            if isinstance(self.adapter, ControlNetModel):
+                                validation_image = validation_image.resize(
+                                    (gen_config.width, gen_config.height))
+                                extra['image'] = validation_image
+                                extra['controlnet_conditioning_scale'] = gen_config.adapter_conditioning_scale
+                            if isinstance(self.adapter, CustomAdapter) and self.adapter.control_lora is not None:
+                                validation_image = validation_image.resize((gen_config.width, gen_config.height))
+                                extra['control_image'] = validation_image
+                                extra['control_image_idx'] = gen_config.ctrl_idx
+                            if isinstance(self.adapter, IPAdapter) or isinstance(self.adapter, ClipVisionAdapter):
+                                transform = transforms.Compose([
+                                    transforms.ToTensor(),
+                                ])
+                                validation_image = transform(validation_image)
+                            if isinstance(self.adapter, CustomAdapter):
+                                # todo allow loading multiple
+                                transform = transforms.Compose([
+                                    transforms.ToTensor(),
+                                ])
+                                validation_image = transform(validation_image)
+                                self.adapter.num_images = 1
+                            if isinstance(self.adapter, ReferenceAdapter):
+                                # need -1 to 1
+                                validation_image = transforms.ToTensor()(validation_image)
+                                validation_image = validation_image * 2.0 - 1.0
+                                validation_image = validation_image.unsqueeze(0)
+                                self.adapter.set_reference_images(validation_image)
+
+                        if network is not None:
+                            network.multiplier = gen_config.network_multiplier
+                        torch.manual_seed(gen_config.seed)
+                        torch.cuda.manual_seed(gen_config.seed)
+
+                        if self.adapter is not None and isinstance(self.adapter, ClipVisionAdapter) \
+                                and gen_config.adapter_image_path is not None:
+                            # run through the adapter to saturate the embeds
+                            conditional_clip_embeds = self.adapter.get_clip_image_embeds_from_tensors(
+                                validation_image)
+                            self.adapter(conditional_clip_embeds)
+
+                        if self.adapter is not None and isinstance(self.adapter, CustomAdapter):
+                            # handle condition the prompts
+                            gen_config.prompt = self.adapter.condition_prompt(
+                                gen_config.prompt,
+                                is_unconditional=False,
+                            )
+                            gen_config.prompt_2 = gen_config.prompt
+                            gen_config.negative_prompt = self.adapter.condition_prompt(
+                                gen_config.negative_prompt,
+                                is_unconditional=True,
+                            )
+                            gen_config.negative_prompt_2 = gen_config.negative_prompt
+
+                        if self.adapter is not None and isinstance(self.adapter, CustomAdapter) and validation_image is not None:
+                            self.adapter.trigger_pre_te(
+                                tensors_0_1=validation_image,
+                                is_training=False,
+                                has_been_preprocessed=False,
+                                quad_count=4
+                            )
+
+                        if self.sample_prompts_cache is not None:
+                            conditional_embeds = self.sample_prompts_cache[i]['conditional'].to(self.device_torch, dtype=self.torch_dtype)
+                            unconditional_embeds = self.sample_prompts_cache[i]['unconditional'].to(self.device_torch, dtype=self.torch_dtype)
                         else:
-                            # make sure it has an alpha
-                            if validation_image.mode != "RGBA":
-                                raise ValueError("Inpainting images must have an alpha channel")
-                        if isinstance(self.adapter, T2IAdapter):
-                            # not sure why this is double??
-                            validation_image = validation_image.resize(
-                                (gen_config.width * 2, gen_config.height * 2))
-                            extra['image'] = validation_image
-                            extra['adapter_conditioning_scale'] = gen_config.adapter_conditioning_scale
-                        if isinstance(self.adapter, ControlNetModel):
-                            validation_image = validation_image.resize(
-                                (gen_config.width, gen_config.height))
-                            extra['image'] = validation_image
-                            extra['controlnet_conditioning_scale'] = gen_config.adapter_conditioning_scale
-                        if isinstance(self.adapter, CustomAdapter) and self.adapter.control_lora is not None:
-                            validation_image = validation_image.resize((gen_config.width, gen_config.height))
-                            extra['control_image'] = validation_image
-                            extra['control_image_idx'] = gen_config.ctrl_idx
-                        if isinstance(self.adapter, IPAdapter) or isinstance(self.adapter, ClipVisionAdapter):
-                            transform = transforms.Compose([
-                                transforms.ToTensor(),
-                            ])
-                            validation_image = transform(validation_image)
-                        if isinstance(self.adapter, CustomAdapter):
-                            # todo allow loading multiple
-                            transform = transforms.Compose([
-                                transforms.ToTensor(),
-                            ])
-                            validation_image = transform(validation_image)
-                            self.adapter.num_images = 1
-                        if isinstance(self.adapter, ReferenceAdapter):
-                            # need -1 to 1
-                            validation_image = transforms.ToTensor()(validation_image)
-                            validation_image = validation_image * 2.0 - 1.0
-                            validation_image = validation_image.unsqueeze(0)
-                            self.adapter.set_reference_images(validation_image)
-
-                    if network is not None:
-                        network.multiplier = gen_config.network_multiplier
-                    torch.manual_seed(gen_config.seed)
-                    torch.cuda.manual_seed(gen_config.seed)
-
-                    generator = torch.manual_seed(gen_config.seed)
-
-                    if self.adapter is not None and isinstance(self.adapter, ClipVisionAdapter) \
-                            and gen_config.adapter_image_path is not None:
-                        # run through the adapter to saturate the embeds
-                        conditional_clip_embeds = self.adapter.get_clip_image_embeds_from_tensors(
-                            validation_image)
-                        self.adapter(conditional_clip_embeds)
-
-                    if self.adapter is not None and isinstance(self.adapter, CustomAdapter):
-                        # handle condition the prompts
-                        gen_config.prompt = self.adapter.condition_prompt(
-                            gen_config.prompt,
-                            is_unconditional=False,
-                        )
-                        gen_config.prompt_2 = gen_config.prompt
-                        gen_config.negative_prompt = self.adapter.condition_prompt(
-                            gen_config.negative_prompt,
-                            is_unconditional=True,
-                        )
-                        gen_config.negative_prompt_2 = gen_config.negative_prompt
-
-                    if self.adapter is not None and isinstance(self.adapter, CustomAdapter) and validation_image is not None:
-                        self.adapter.trigger_pre_te(
-                            tensors_0_1=validation_image,
-                            is_training=False,
-                            has_been_preprocessed=False,
-                            quad_count=4
-                        )
-
-                    if self.sample_prompts_cache is not None:
-                        conditional_embeds = self.sample_prompts_cache[i]['conditional'].to(self.device_torch, dtype=self.torch_dtype)
-                        unconditional_embeds = self.sample_prompts_cache[i]['unconditional'].to(self.device_torch, dtype=self.torch_dtype)
-                    else:
-                        ctrl_img = None
-                        has_control_images = False
-                        if gen_config.ctrl_img is not None or gen_config.ctrl_img_1 is not None or gen_config.ctrl_img_2 is not None or gen_config.ctrl_img_3 is not None:
-                            has_control_images = True
-                        # load the control image if out model uses it in text encoding
-                        if has_control_images and self.encode_control_in_text_embeddings:
-                            ctrl_img_list = []
+                            ctrl_img = None
+                            has_control_images = False
+                            if gen_config.ctrl_img is not None or gen_config.ctrl_img_1 is not None or gen_config.ctrl_img_2 is not None or gen_config.ctrl_img_3 is not None:
+                                has_control_images = True
+                            # load the control image if out model uses it in text encoding
+                            if has_control_images and self.encode_control_in_text_embeddings:
+                                ctrl_img_list = []
                     
-                            if gen_config.ctrl_img is not None:
-                                ctrl_img = Image.open(gen_config.ctrl_img).convert("RGB")
-                                # convert to 0 to 1 tensor
-                                ctrl_img = (
-                                    TF.to_tensor(ctrl_img)
-                                    .unsqueeze(0)
-                                    .to(self.device_torch, dtype=self.torch_dtype)
-                                )
-                                ctrl_img_list.append(ctrl_img)
+                                if gen_config.ctrl_img is not None:
+                                    ctrl_img = Image.open(gen_config.ctrl_img).convert("RGB")
+                                    # convert to 0 to 1 tensor
+                                    ctrl_img = (
+                                        TF.to_tensor(ctrl_img)
+                                        .unsqueeze(0)
+                                        .to(self.device_torch, dtype=self.torch_dtype)
+                                    )
+                                    ctrl_img_list.append(ctrl_img)
                             
-                            if gen_config.ctrl_img_1 is not None:
-                                ctrl_img_1 = Image.open(gen_config.ctrl_img_1).convert("RGB")
-                                # convert to 0 to 1 tensor
-                                ctrl_img_1 = (
-                                    TF.to_tensor(ctrl_img_1)
-                                    .unsqueeze(0)
-                                    .to(self.device_torch, dtype=self.torch_dtype)
-                                )
-                                ctrl_img_list.append(ctrl_img_1)
-                            if gen_config.ctrl_img_2 is not None:
-                                ctrl_img_2 = Image.open(gen_config.ctrl_img_2).convert("RGB")
-                                # convert to 0 to 1 tensor
-                                ctrl_img_2 = (
-                                    TF.to_tensor(ctrl_img_2)
-                                    .unsqueeze(0)
-                                    .to(self.device_torch, dtype=self.torch_dtype)
-                                )
-                                ctrl_img_list.append(ctrl_img_2)
-                            if gen_config.ctrl_img_3 is not None:
-                                ctrl_img_3 = Image.open(gen_config.ctrl_img_3).convert("RGB")
-                                # convert to 0 to 1 tensor
-                                ctrl_img_3 = (
-                                    TF.to_tensor(ctrl_img_3)
-                                    .unsqueeze(0)
-                                    .to(self.device_torch, dtype=self.torch_dtype)
-                                )
-                                ctrl_img_list.append(ctrl_img_3)
+                                if gen_config.ctrl_img_1 is not None:
+                                    ctrl_img_1 = Image.open(gen_config.ctrl_img_1).convert("RGB")
+                                    # convert to 0 to 1 tensor
+                                    ctrl_img_1 = (
+                                        TF.to_tensor(ctrl_img_1)
+                                        .unsqueeze(0)
+                                        .to(self.device_torch, dtype=self.torch_dtype)
+                                    )
+                                    ctrl_img_list.append(ctrl_img_1)
+                                if gen_config.ctrl_img_2 is not None:
+                                    ctrl_img_2 = Image.open(gen_config.ctrl_img_2).convert("RGB")
+                                    # convert to 0 to 1 tensor
+                                    ctrl_img_2 = (
+                                        TF.to_tensor(ctrl_img_2)
+                                        .unsqueeze(0)
+                                        .to(self.device_torch, dtype=self.torch_dtype)
+                                    )
+                                    ctrl_img_list.append(ctrl_img_2)
+                                if gen_config.ctrl_img_3 is not None:
+                                    ctrl_img_3 = Image.open(gen_config.ctrl_img_3).convert("RGB")
+                                    # convert to 0 to 1 tensor
+                                    ctrl_img_3 = (
+                                        TF.to_tensor(ctrl_img_3)
+                                        .unsqueeze(0)
+                                        .to(self.device_torch, dtype=self.torch_dtype)
+                                    )
+                                    ctrl_img_list.append(ctrl_img_3)
                             
-                            if self.has_multiple_control_images:
-                                ctrl_img = ctrl_img_list
-                            else:
-                                ctrl_img = ctrl_img_list[0] if len(ctrl_img_list) > 0 else None
-                        # encode the prompt ourselves so we can do fun stuff with embeddings
-                        if isinstance(self.adapter, CustomAdapter):
-                            self.adapter.is_unconditional_run = False
-                        conditional_embeds = self.encode_prompt(
-                            gen_config.prompt, 
-                            gen_config.prompt_2, 
-                            force_all=True,
-                            control_images=ctrl_img
-                        )
-
-                        if isinstance(self.adapter, CustomAdapter):
-                            self.adapter.is_unconditional_run = True
-                        unconditional_embeds = self.encode_prompt(
-                            gen_config.negative_prompt, 
-                            gen_config.negative_prompt_2, 
-                            force_all=True,
-                            control_images=ctrl_img
-                        )
-                        if isinstance(self.adapter, CustomAdapter):
-                            self.adapter.is_unconditional_run = False
-
-                    # allow any manipulations to take place to embeddings
-                    gen_config.post_process_embeddings(
-                        conditional_embeds,
-                        unconditional_embeds,
-                    )
-
-                    if self.decorator is not None:
-                        # apply the decorator to the embeddings
-                        conditional_embeds.text_embeds = self.decorator(
-                            conditional_embeds.text_embeds)
-                        unconditional_embeds.text_embeds = self.decorator(
-                            unconditional_embeds.text_embeds, is_unconditional=True)
-
-                    if self.adapter is not None and isinstance(self.adapter, IPAdapter) \
-                            and gen_config.adapter_image_path is not None:
-                        # apply the image projection
-                        conditional_clip_embeds = self.adapter.get_clip_image_embeds_from_tensors(
-                            validation_image)
-                        unconditional_clip_embeds = self.adapter.get_clip_image_embeds_from_tensors(validation_image,
-                                                                                                    True)
-                        conditional_embeds = self.adapter(
-                            conditional_embeds, conditional_clip_embeds, is_unconditional=False)
-                        unconditional_embeds = self.adapter(
-                            unconditional_embeds, unconditional_clip_embeds, is_unconditional=True)
-
-                    if self.adapter is not None and isinstance(self.adapter, CustomAdapter):
-                        conditional_embeds = self.adapter.condition_encoded_embeds(
-                            tensors_0_1=validation_image,
-                            prompt_embeds=conditional_embeds,
-                            is_training=False,
-                            has_been_preprocessed=False,
-                            is_generating_samples=True,
+                                if self.has_multiple_control_images:
+                                    ctrl_img = ctrl_img_list
+                                else:
+                                    ctrl_img = ctrl_img_list[0] if len(ctrl_img_list) > 0 else None
+                            # encode the prompt ourselves so we can do fun stuff with embeddings
+                            if isinstance(self.adapter, CustomAdapter):
+                                self.adapter.is_unconditional_run = False
+                            conditional_embeds = self.encode_prompt(
+                                gen_config.prompt, 
+                                gen_config.prompt_2, 
+                                force_all=True,
+                                control_images=ctrl_img
+                            )
+
+                            if isinstance(self.adapter, CustomAdapter):
+                                self.adapter.is_unconditional_run = True
+                            unconditional_embeds = self.encode_prompt(
+                                gen_config.negative_prompt, 
+                                gen_config.negative_prompt_2, 
+                                force_all=True,
+                                control_images=ctrl_img
+                            )
+                            if isinstance(self.adapter, CustomAdapter):
+                                self.adapter.is_unconditional_run = False
+
+                        # allow any manipulations to take place to embeddings
+                        gen_config.post_process_embeddings(
+                            conditional_embeds,
+                            unconditional_embeds,
                         )
-                        unconditional_embeds = self.adapter.condition_encoded_embeds(
-                            tensors_0_1=validation_image,
-                            prompt_embeds=unconditional_embeds,
-                            is_training=False,
-                            has_been_preprocessed=False,
-                            is_unconditional=True,
-                            is_generating_samples=True,
-                        )
-
-                    if self.adapter is not None and isinstance(self.adapter, CustomAdapter) and len(
-                            gen_config.extra_values) > 0:
-                        extra_values = torch.tensor([gen_config.extra_values], device=self.device_torch,
-                                                    dtype=self.torch_dtype)
-                        # apply extra values to the embeddings
-                        self.adapter.add_extra_values(
-                            extra_values, is_unconditional=False)
-                        self.adapter.add_extra_values(torch.zeros_like(
-                            extra_values), is_unconditional=True)
-                        pass  # todo remove, for debugging
-
-                    if self.refiner_unet is not None and gen_config.refiner_start_at < 1.0:
-                        # if we have a refiner loaded, set the denoising end at the refiner start
-                        extra['denoising_end'] = gen_config.refiner_start_at
-                        extra['output_type'] = 'latent'
-                        if not self.is_xl:
-                            raise ValueError(
-                                "Refiner is only supported for XL models")
-
-                    conditional_embeds = conditional_embeds.to(
-                        self.device_torch, dtype=self.unet.dtype)
-                    unconditional_embeds = unconditional_embeds.to(
-                        self.device_torch, dtype=self.unet.dtype)
-
-                    img = self.generate_single_image(
-                        pipeline,
-                        gen_config,
-                        conditional_embeds,
-                        unconditional_embeds,
-                        generator,
-                        extra,
-                    )
 
-                    gen_config.save_image(img, i)
-                    gen_config.log_image(img, i)
-                    self._after_sample_image(i, len(image_configs))
-                    flush()
+                        if self.decorator is not None:
+                            # apply the decorator to the embeddings
+                            conditional_embeds.text_embeds = self.decorator(
+                                conditional_embeds.text_embeds)
+                            unconditional_embeds.text_embeds = self.decorator(
+                                unconditional_embeds.text_embeds, is_unconditional=True)
+
+                        if self.adapter is not None and isinstance(self.adapter, IPAdapter) \
+                                and gen_config.adapter_image_path is not None:
+                            # apply the image projection
+                            conditional_clip_embeds = self.adapter.get_clip_image_embeds_from_tensors(
+                                validation_image)
+                            unconditional_clip_embeds = self.adapter.get_clip_image_embeds_from_tensors(validation_image,
+                                                                                                        True)
+                            conditional_embeds = self.adapter(
+                                conditional_embeds, conditional_clip_embeds, is_unconditional=False)
+                            unconditional_embeds = self.adapter(
+                                unconditional_embeds, unconditional_clip_embeds, is_unconditional=True)
+
+                        if self.adapter is not None and isinstance(self.adapter, CustomAdapter):
+                            conditional_embeds = self.adapter.condition_encoded_embeds(
+                                tensors_0_1=validation_image,
+                                prompt_embeds=conditional_embeds,
+                                is_training=False,
+                                has_been_preprocessed=False,
+                                is_generating_samples=True,
+                            )
+                            unconditional_embeds = self.adapter.condition_encoded_embeds(
+                                tensors_0_1=validation_image,
+                                prompt_embeds=unconditional_embeds,
+                                is_training=False,
+                                has_been_preprocessed=False,
+                                is_unconditional=True,
+                                is_generating_samples=True,
+                            )
+
+                        if self.adapter is not None and isinstance(self.adapter, CustomAdapter) and len(
+                                gen_config.extra_values) > 0:
+                            extra_values = torch.tensor([gen_config.extra_values], device=self.device_torch,
+                                                        dtype=self.torch_dtype)
+                            # apply extra values to the embeddings
+                            self.adapter.add_extra_values(
+                                extra_values, is_unconditional=False)
+                            self.adapter.add_extra_values(torch.zeros_like(
+                                extra_values), is_unconditional=True)
+                            pass  # todo remove, for debugging
+
+                        if self.refiner_unet is not None and gen_config.refiner_start_at < 1.0:
+                            # if we have a refiner loaded, set the denoising end at the refiner start
+                            extra['denoising_end'] = gen_config.refiner_start_at
+                            extra['output_type'] = 'latent'
+                            if not self.is_xl:
+                                raise ValueError(
+                                    "Refiner is only supported for XL models")
+
+                        conditional_embeds = conditional_embeds.to(
+                            self.device_torch, dtype=self.unet.dtype)
+                        unconditional_embeds = unconditional_embeds.to(
+                            self.device_torch, dtype=self.unet.dtype)
+
+                        prepared.append((i, gen_config, conditional_embeds, unconditional_embeds, extra))
+
+                    # items whose embeds have the same shapes are generated in one call
+                    sub_batches = OrderedDict()
+                    for item in prepared:
+                        sub_batches.setdefault(get_embeds_signature(item[2], item[3]), []).append(item)
+
+                    for items in sub_batches.values():
+                        gen_config = items[0][1]
+                        extra = items[0][4]
+                        if len(items) == 1:
+                            imgs = [self.generate_single_image(
+                                pipeline,
+                                gen_config,
+                                items[0][2],
+                                items[0][3],
+                                torch.manual_seed(gen_config.seed),
+                                extra,
+                            )]
+                        else:
+                            # one generator per item, so every image matches the one it would be generated alone
+                            imgs = self.generate_single_image(
+                                pipeline,
+                                gen_config,
+                                concat_prompt_embeds([item[2] for item in items]),
+                                concat_prompt_embeds([item[3] for item in items]),
+                                [torch.Generator().manual_seed(item[1].seed) for item in items],
+                                extra,
+                            )
+
+                        for (i, item_config, _, _, _), img in zip(items, imgs):
+                            # encoding and writing happen on the sample writer while the next image generates
+                            self.sample_writer.write(item_config, img, i)
+                            self._after_sample_image(num_done, len(image_configs))
+                            num_done += 1
 
                 if self.adapter is not None and isinstance(self.adapter, ReferenceAdapter):
                     self.adapter.clear_memory()
@@ -695,6 +743,9 @@ class BaseModel:
             self.assistant_lora.force_to('cpu', self.torch_dtype)
         flush()
 
+        if wait_for_writes:
+            self.sample_writer.drain()
+
     def get_latent_noise(
             self,
             height=None,
@@ -61,6 +61,7 @@ scheduler_config = {
 
 class CogView4(BaseModel):
     arch = 'cogview4'
+    supports_batched_generation = True
     def __init__(
             self,
             device,
@@ -245,8 +246,9 @@ class CogView4(BaseModel):
             latents=gen_config.latents,
             generator=generator,
             **extra
-        ).images[0]
-        return img
+        ).images
+        # a list of generators means a batch of prompts
+        return img if isinstance(generator, list) else img[0]
 
     def get_noise_prediction(
         self,
@@ -347,6 +347,8 @@ class Wan21I2V(Wan21):
             image_configs,
             sampler=None,
             pipeline=None,
+            batch_size: int = 1,
+            wait_for_writes: bool = True,
     ):
         # will oom on 24gb vram if we dont unload vision encoder first
         if self.model_config.low_vram:
@@ -359,6 +361,8 @@ class Wan21I2V(Wan21):
             image_configs,
             sampler=sampler,
             pipeline=pipeline,
+            batch_size=batch_size,
+            wait_for_writes=wait_for_writes,
         )
     
     def set_device_state_preset(self, *args, **kwargs):
@@ -14,7 +14,7 @@ from toolkit.config_modules import NetworkConfig
 from toolkit.lorm import extract_conv, extract_linear, count_parameters
 from toolkit.metadata import add_model_hash_to_meta
 from toolkit.paths import KEYMAPS_ROOT
-from toolkit.saving import get_lora_keymap_from_model_keymap
+from toolkit.saving import get_lora_keymap_from_model_keymap, snapshot_to_cpu
 from optimum.quanto import QBytesTensor
 
 if TYPE_CHECKING:
@@ -517,22 +517,17 @@ class ToolkitNetworkMixin:
                 #  invert them
                 save_keymap[diffusers_key] = ldm_key
 
-        state_dict = self.state_dict()
+        state_dict = snapshot_to_cpu(self.state_dict(), dtype=dtype)
         save_dict = OrderedDict()
 
         for key in list(state_dict.keys()):
-            v = state_dict[key]
-            v = v.detach().clone().to("cpu").to(dtype)
             save_key = save_keymap[key] if key in save_keymap else key
-            save_dict[save_key] = v
+            save_dict[save_key] = state_dict[key]
             del state_dict[key]
 
         if extra_state_dict is not None:
             # add extra items to state dict
-            for key in list(extra_state_dict.keys()):
-                v = extra_state_dict[key]
-                v = v.detach().clone().to("cpu").to(dtype)
-                save_dict[key] = v
+            save_dict.update(snapshot_to_cpu(extra_state_dict, dtype=dtype))
 
         if self.peft_format:
             # lora_down = lora_A
@@ -574,7 +569,10 @@ class ToolkitNetworkMixin:
             extra_state_dict: Optional[OrderedDict] = None
     ):
         save_dict = self.get_state_dict(extra_state_dict=extra_state_dict, dtype=dtype)
-        
+        self.save_state_dict(save_dict, file, metadata=metadata)
+
+    def save_state_dict(self: Network, save_dict, file, metadata=None):
+        # writes a cpu state dict from get_state_dict. Does not touch the network, so it can run on another thread
         if metadata is not None and len(metadata) == 0:
             metadata = None
 
@@ -0,0 +1,152 @@
+import hashlib
+import os
+from collections import OrderedDict
+from typing import Dict, List, Tuple, Union
+
+import torch
+from safetensors import safe_open
+
+from toolkit.cache_pipeline import save_cache_file
+
+OPTIMIZER_SHARD_DIR_NAME = 'optimizer-state'
+INDEX_FILE_NAME = 'index.pt'
+INDEX_VERSION = 1
+
+# placeholder left in the optimizer state structure where a tensor was moved to a shard
+TENSOR_REF_KEY = '__aitk_optimizer_tensor__'
+
+
+def _split_tensors(state_dict: dict) -> Tuple[dict, Dict[str, torch.Tensor]]:
+    # pulls every tensor out of the state dict, leaving a small structure with references to them
+    tensors: Dict[str, torch.Tensor] = OrderedDict()
+
+    def _strip(value, path):
+        if isinstance(value, torch.Tensor):
+            key = path
+            if key in tensors:
+                key = f"{path}#{len(tensors)}"
+            tensors[key] = value
+            return {TENSOR_REF_KEY: key}
+        if isinstance(value, dict):
+            return value.__class__((k, _strip(v, f"{path}.{k}")) for k, v in value.items())
+        if isinstance(value, list):
+            return [_strip(v, f"{path}.{i}") for i, v in enumerate(value)]
+        if isinstance(value, tuple):
+            return tuple(_strip(v, f"{path}.{i}") for i, v in enumerate(value))
+        return value
+
+    skeleton = _strip(state_dict, 'optimizer')
+    return skeleton, tensors
+
+
+def _join_tensors(skeleton, tensors: Dict[str, torch.Tensor]):
+    if isinstance(skeleton, dict):
+        if len(skeleton) == 1 and TENSOR_REF_KEY in skeleton:
+            return tensors[skeleton[TENSOR_REF_KEY]]
+        return skeleton.__class__((k, _join_tensors(v, tensors)) for k, v in skeleton.items())
+    if isinstance(skeleton, list):
+        return [_join_tensors(v, tensors) for v in skeleton]
+    if isinstance(skeleton, tuple):
+        return tuple(_join_tensors(v, tensors) for v in skeleton)
+    return skeleton
+
+
+def _plan_shards(state_dict: dict, tensors: Dict[str, torch.Tensor], shard_size_bytes: int) -> List[Tuple[str, List[str]]]:
+    # tensors are grouped by the param group their parameter belongs to, then split every shard_size_bytes
+    group_of_param = {}
+    for group_idx, group in enumerate(state_dict.get('param_groups', [])):
+        for param_id in group.get('params', []):
+            group_of_param[str(param_id)] = f"group{group_idx}"
+    groups: Dict[str, List[str]] = OrderedDict()
+    for key in tensors:
+        parts = key.split('.')
+        name = 'extra'
+        if len(parts) > 2 and parts[1] == 'state':
+            name = group_of_param.get(parts[2], 'extra')
+        groups.setdefault(name, []).append(key)
+
+    shards = []
+    for name, keys in groups.items():
+        current: List[str] = []
+        current_size = 0
+        for key in keys:
+            tensor = tensors[key]
+            size = tensor.numel() * tensor.element_size()
+            if len(current) > 0 and current_size + size > shard_size_bytes:
+                shards.append((name, current))
+                current = []
+                current_size = 0
+            current.append(key)
+            current_size += size
+        if len(current) > 0:
+            shards.append((name, current))
+    return shards
+
+
+def _hash_shard(shard_tensors: Dict[str, torch.Tensor]) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    for key, tensor in shard_tensors.items():
+        h.update(f"{key}|{tensor.dtype}|{tuple(tensor.shape)}|".encode('utf-8'))
+        if tensor.numel() > 0:
+            h.update(tensor.reshape(-1).view(torch.uint8).numpy().data)
+    return h.hexdigest()
+
+
+def has_optimizer_shards(shard_dir: str) -> bool:
+    return os.path.exists(os.path.join(shard_dir, INDEX_FILE_NAME))
+
+
+def save_optimizer_shards(state_dict: dict, shard_dir: str, shard_size_mb: int = 1024) -> Tuple[int, int]:
+    """
+    Saves an optimizer state dict as safetensors shards, one set per param group split every
+    shard_size_mb, plus an index with everything that is not a tensor. Shard files are named by a hash
+    of their contents, so a shard that did not change since the last save is not written again.
+    Tensors are moved to cpu one shard at a time.
+
+    The index is replaced last and old shards are removed after it, so an interrupted save leaves the
+    previous state loadable. Returns (shards written, total shards).
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    skeleton, tensors = _split_tensors(state_dict)
+    shard_plan = _plan_shards(state_dict, tensors, int(shard_size_mb * 1024 * 1024))
+
+    shards = []
+    num_written = 0
+    for name, keys in shard_plan:
+        shard_tensors = OrderedDict((key, tensors[key].detach().to('cpu').contiguous()) for key in keys)
+        filename = f"{name}-{_hash_shard(shard_tensors)}.safetensors"
+        path = os.path.join(shard_dir, filename)
+        if not os.path.exists(path):
+            save_cache_file(shard_tensors, path)
+            num_written += 1
+        shards.append({'file': filename, 'keys': keys})
+        del shard_tensors
+
+    index = {'version': INDEX_VERSION, 'state': skeleton, 'shards': shards}
+    index_path = os.path.join(shard_dir, INDEX_FILE_NAME)
+    tmp_index_path = f"{index_path}.{os.getpid()}.tmp"
+    torch.save(index, tmp_index_path)
+    os.replace(tmp_index_path, index_path)
+
+    # remove shards the new index does not use
+    used_files = set(shard['file'] for shard in shards)
+    for filename in os.listdir(shard_dir):
+        if filename.endswith('.safetensors') and filename not in used_files:
+            os.remove(os.path.join(shard_dir, filename))
+    return num_written, len(shards)
+
+
+def load_optimizer_shards(shard_dir: str, device: Union[str, torch.device] = 'cpu') -> dict:
+    """
+    Loads an optimizer state dict saved with save_optimizer_shards. Tensors are read one at a time from
+    the memory mapped shards straight onto device, so the whole state is never held in host memory.
+    """
+    index = torch.load(os.path.join(shard_dir, INDEX_FILE_NAME), weights_only=True)
+    if index.get('version', None) != INDEX_VERSION:
+        raise ValueError(f"Unknown optimizer shard index version {index.get('version', None)} in {shard_dir}")
+    tensors: Dict[str, torch.Tensor] = {}
+    for shard in index['shards']:
+        with safe_open(os.path.join(shard_dir, shard['file']), framework='pt', device=str(device)) as f:
+            for key in f.keys():
+                tensors[key] = f.get_tensor(key)
+    return _join_tensors(index['state'], tensors)
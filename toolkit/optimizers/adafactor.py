@@ -1,8 +1,8 @@
 import math
 from typing import List
 import torch
-from toolkit.optimizers.optimizer_utils import copy_stochastic, stochastic_grad_accummulation
-from optimum.quanto import QBytesTensor
+from toolkit.optimizers.optimizer_utils import stochastic_grad_accummulation, bucket_params, stack_params_fp32, \
+    write_stacked_params, per_param_view_shape, stacked_rms
 import random
 
 
@@ -258,106 +258,128 @@ class Adafactor(torch.optim.Optimizer):
             loss = closure()
 
         for group in self.param_groups:
+            params = []
             for p in group["params"]:
                 if p.grad is None or not p.requires_grad:
                     continue
-
-                grad = p.grad
-                if grad.dtype != torch.float32:
-                    grad = grad.to(torch.float32)
-                if grad.is_sparse:
+                if p.grad.is_sparse:
                     raise RuntimeError(
                         "Adafactor does not support sparse gradients.")
-                
-                # if p has atts _scale then it is quantized. We need to divide the grad by the scale
-                # if hasattr(p, "_scale"):
-                #     grad = grad / p._scale
-
-                state = self.state[p]
-                grad_shape = grad.shape
-
-                factored, use_first_moment = self._get_options(
-                    group, grad_shape)
-                # State Initialization
-                if len(state) == 0:
-                    state["step"] = 0
-
-                    if use_first_moment:
-                        # Exponential moving average of gradient values
-                        state["exp_avg"] = torch.zeros_like(grad)
-                    if factored:
-                        state["exp_avg_sq_row"] = torch.zeros(
-                            grad_shape[:-1]).to(grad)
-                        state["exp_avg_sq_col"] = torch.zeros(
-                            grad_shape[:-2] + grad_shape[-1:]).to(grad)
-                    else:
-                        state["exp_avg_sq"] = torch.zeros_like(grad)
-
-                    state["RMS"] = 0
-                else:
-                    if use_first_moment:
-                        state["exp_avg"] = state["exp_avg"].to(grad)
-                    if factored:
-                        state["exp_avg_sq_row"] = state["exp_avg_sq_row"].to(
-                            grad)
-                        state["exp_avg_sq_col"] = state["exp_avg_sq_col"].to(
-                            grad)
-                    else:
-                        state["exp_avg_sq"] = state["exp_avg_sq"].to(grad)
-
-                p_data_fp32 = p
-                
-                if isinstance(p_data_fp32, QBytesTensor):
-                    p_data_fp32 = p_data_fp32.dequantize()
-                if p.dtype != torch.float32:
-                    p_data_fp32 = p_data_fp32.clone().float()
-
-                state["step"] += 1
-                state["RMS"] = self._rms(p_data_fp32)
-                lr = self._get_lr(group, state)
-
-                beta2t = 1.0 - math.pow(state["step"], group["decay_rate"])
-                eps = group["eps"]
-                if isinstance(eps, tuple) or isinstance(eps, list):
-                    eps = eps[0]
-                update = (grad**2) + eps
-                if factored:
-                    exp_avg_sq_row = state["exp_avg_sq_row"]
-                    exp_avg_sq_col = state["exp_avg_sq_col"]
-
-                    exp_avg_sq_row.mul_(beta2t).add_(
-                        update.mean(dim=-1), alpha=(1.0 - beta2t))
-                    exp_avg_sq_col.mul_(beta2t).add_(
-                        update.mean(dim=-2), alpha=(1.0 - beta2t))
-
-                    # Approximation of exponential moving average of square of gradient
-                    update = self._approx_sq_grad(
-                        exp_avg_sq_row, exp_avg_sq_col)
-                    update.mul_(grad)
-                else:
-                    exp_avg_sq = state["exp_avg_sq"]
-
-                    exp_avg_sq.mul_(beta2t).add_(update, alpha=(1.0 - beta2t))
-                    update = exp_avg_sq.rsqrt().mul_(grad)
-
-                update.div_(
-                    (self._rms(update) / group["clip_threshold"]).clamp_(min=1.0))
-                update.mul_(lr)
-
-                if use_first_moment:
-                    exp_avg = state["exp_avg"]
-                    exp_avg.mul_(group["beta1"]).add_(
-                        update, alpha=(1 - group["beta1"]))
-                    update = exp_avg
-
-                if group["weight_decay"] != 0:
-                    p_data_fp32.add_(
-                        p_data_fp32, alpha=(-group["weight_decay"] * lr))
-
-                p_data_fp32.add_(-update)
-
-                if p.dtype != torch.float32 and self.stochastic_rounding:
-                    # apply stochastic rounding
-                    copy_stochastic(p, p_data_fp32)
+                self._prepare_state(group, p)
+                params.append(p)
+
+            # params with the same shape and step are updated together with batched ops
+            buckets = bucket_params(
+                params,
+                lambda p: (p.device, p.dtype, p.grad.dtype, tuple(p.shape), self.state[p]["step"])
+            )
+            for bucket in buckets:
+                self._step_bucket(group, bucket)
 
         return loss
+
+    def _prepare_state(self, group, p):
+        # if p has atts _scale then it is quantized. We need to divide the grad by the scale
+        # if hasattr(p, "_scale"):
+        #     grad = grad / p._scale
+
+        state = self.state[p]
+        grad_shape = p.grad.shape
+
+        factored, use_first_moment = self._get_options(
+            group, grad_shape)
+        # State Initialization
+        if len(state) == 0:
+            state["step"] = 0
+
+            if use_first_moment:
+                # Exponential moving average of gradient values
+                state["exp_avg"] = torch.zeros_like(p.grad, dtype=torch.float32)
+            if factored:
+                state["exp_avg_sq_row"] = torch.zeros(
+                    grad_shape[:-1]).to(p.grad.device)
+                state["exp_avg_sq_col"] = torch.zeros(
+                    grad_shape[:-2] + grad_shape[-1:]).to(p.grad.device)
+            else:
+                state["exp_avg_sq"] = torch.zeros_like(p.grad, dtype=torch.float32)
+
+            state["RMS"] = 0
+        else:
+            if use_first_moment:
+                state["exp_avg"] = state["exp_avg"].to(p.grad.device, torch.float32)
+            if factored:
+                state["exp_avg_sq_row"] = state["exp_avg_sq_row"].to(
+                    p.grad.device, torch.float32)
+                state["exp_avg_sq_col"] = state["exp_avg_sq_col"].to(
+                    p.grad.device, torch.float32)
+            else:
+                state["exp_avg_sq"] = state["exp_avg_sq"].to(p.grad.device, torch.float32)
+
+    def _step_bucket(self, group, params):
+        # every param in the bucket has the same shape and step, they are stacked on a new first dim
+        states = [self.state[p] for p in params]
+        factored, use_first_moment = self._get_options(group, params[0].shape)
+
+        grad = torch.stack([p.grad for p in params]).to(torch.float32)
+        p_data_fp32 = stack_params_fp32(params)
+        per_param = per_param_view_shape(grad)
+
+        rms = stacked_rms(p_data_fp32)
+        for i, state in enumerate(states):
+            state["step"] += 1
+            state["RMS"] = rms[i].clone()
+        step = states[0]["step"]
+
+        # same as _get_lr, with one param scale per param
+        lr = group["lr"]
+        if group["relative_step"]:
+            min_step = 1e-6 * step if group["warmup_init"] else 1e-2
+            lr = min(min_step, 1.0 / math.sqrt(step))
+        if group["scale_parameter"]:
+            lr = rms.clamp(min=group["eps"][1]).mul_(lr).view(per_param)
+
+        beta2t = 1.0 - math.pow(step, group["decay_rate"])
+        eps = group["eps"]
+        if isinstance(eps, tuple) or isinstance(eps, list):
+            eps = eps[0]
+        update = (grad**2) + eps
+        if factored:
+            exp_avg_sq_row = torch.stack([state["exp_avg_sq_row"] for state in states])
+            exp_avg_sq_col = torch.stack([state["exp_avg_sq_col"] for state in states])
+
+            exp_avg_sq_row.mul_(beta2t).add_(
+                update.mean(dim=-1), alpha=(1.0 - beta2t))
+            exp_avg_sq_col.mul_(beta2t).add_(
+                update.mean(dim=-2), alpha=(1.0 - beta2t))
+            torch._foreach_copy_([state["exp_avg_sq_row"] for state in states], list(exp_avg_sq_row.unbind(0)))
+            torch._foreach_copy_([state["exp_avg_sq_col"] for state in states], list(exp_avg_sq_col.unbind(0)))
+
+            # Approximation of exponential moving average of square of gradient
+            update = self._approx_sq_grad(
+                exp_avg_sq_row, exp_avg_sq_col)
+            update.mul_(grad)
+        else:
+            exp_avg_sq = torch.stack([state["exp_avg_sq"] for state in states])
+
+            exp_avg_sq.mul_(beta2t).add_(update, alpha=(1.0 - beta2t))
+            torch._foreach_copy_([state["exp_avg_sq"] for state in states], list(exp_avg_sq.unbind(0)))
+            update = exp_avg_sq.rsqrt().mul_(grad)
+
+        update.div_(
+            (stacked_rms(update) / group["clip_threshold"]).clamp_(min=1.0).view(per_param))
+        update.mul_(lr)
+
+        if use_first_moment:
+            exp_avg = torch.stack([state["exp_avg"] for state in states])
+            exp_avg.mul_(group["beta1"]).add_(
+                update, alpha=(1 - group["beta1"]))
+            torch._foreach_copy_([state["exp_avg"] for state in states], list(exp_avg.unbind(0)))
+            update = exp_avg
+
+        if group["weight_decay"] != 0:
+            p_data_fp32.add_(p_data_fp32 * (-group["weight_decay"] * lr))
+
+        p_data_fp32.add_(-update)
+
+        # apply stochastic rounding
+        write_stacked_params(params, p_data_fp32, stochastic_rounding=self.stochastic_rounding)
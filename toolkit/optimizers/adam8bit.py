@@ -1,12 +1,54 @@
 import math
+from typing import Dict, List, Tuple
+
 import torch
 from torch.optim import Optimizer
-from toolkit.optimizers.optimizer_utils import copy_stochastic, Auto8bitTensor, stochastic_grad_accummulation
+from optimum.quanto import QBytesTensor
+from toolkit.optimizers.optimizer_utils import copy_stochastic, copy_stochastic_bf16, stochastic_grad_accummulation, \
+    write_stacked_params
+
+# params are updated together in flat buffers of up to this many elements, this bounds the fp32 temporaries.
+# On cpu smaller chunks are faster since their temporaries stay in cache
+FLAT_CHUNK_NUMEL = 2 ** 24
+FLAT_CHUNK_NUMEL_CPU = 2 ** 20
+
+
+def dequantize_blockwise(quantized: torch.Tensor, scale: torch.Tensor, block_size: int) -> torch.Tensor:
+    return quantized.view(-1, block_size).to(torch.float32).mul_(scale.view(-1, 1))
+
+
+def quantize_blockwise(x: torch.Tensor, min_level: int, max_level: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Quantizes x (num_blocks, block_size) with one absmax scale per block. Values are rounded stochastically
+    so the moving averages are not biased by re-quantizing them every step. Returns (levels, scale), with
+    the levels still in fp32. Blocks that are all zero get a scale of zero.
+    """
+    # separate amax and amin are much faster than aminmax or abs().amax() on cpu
+    scale = x.amax(dim=1, keepdim=True)
+    if min_level < 0:
+        scale = torch.maximum(scale, x.amin(dim=1, keepdim=True).neg_())
+    scale.div_(max_level)
+    inv_scale = torch.where(scale > 0, scale.reciprocal(), torch.zeros_like(scale))
+    # independent noise for every value, shared noise would correlate the rounding errors across blocks
+    noise = torch.rand_like(x)
+    levels = torch.addcmul(noise, x, inv_scale).floor_().clamp_(min_level, max_level)
+    return levels, scale.view(-1)
+
+
+def _split_flat(flat: torch.Tensor, split_sizes: List[int]) -> List[torch.Tensor]:
+    # split_sizes alternates numel and padding for every param, only the param parts are returned
+    return list(torch.split(flat, split_sizes)[::2])
+
 
 class Adam8bit(Optimizer):
     """
     Implements Adam optimizer with 8-bit state storage and stochastic rounding.
-    
+
+    Both moments are stored blockwise quantized, every block_size values of a param share one scale.
+    The first moment is stored as int8, the second as the uint8 quantized sqrt, which keeps its range
+    close to the gradient's. Params of the same device and dtype are updated together in flat buffers
+    with foreach ops instead of one param at a time, and fp32 params are updated in place.
+
     Arguments:
         params (iterable): Iterable of parameters to optimize or dicts defining parameter groups
         lr (float): Learning rate (default: 1e-3)
@@ -14,9 +56,10 @@ class Adam8bit(Optimizer):
         eps (float): Term added to denominator to improve numerical stability (default: 1e-8)
         weight_decay (float): Weight decay coefficient (default: 0)
         decouple (bool): Use AdamW style decoupled weight decay (default: True)
+        block_size (int): Number of values that share a quantization scale (default: 256)
     """
-    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, 
-                 weight_decay=0, decouple=True):
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8,
+                 weight_decay=0, decouple=True, block_size=256):
         if not 0.0 <= lr:
             raise ValueError(f"Invalid learning rate: {lr}")
         if not 0.0 <= eps:
@@ -25,13 +68,16 @@ class Adam8bit(Optimizer):
             raise ValueError(f"Invalid beta parameter at index 0: {betas[0]}")
         if not 0.0 <= betas[1] < 1.0:
             raise ValueError(f"Invalid beta parameter at index 1: {betas[1]}")
-        
+        if not block_size > 0:
+            raise ValueError(f"Invalid block size: {block_size}")
+
         defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay,
                        decouple=decouple)
         super(Adam8bit, self).__init__(params, defaults)
-        
+        self.block_size = block_size
+
         self.is_stochastic_rounding_accumulation = False
-        
+
         # Setup stochastic grad accumulation hooks
         for group in self.param_groups:
             for param in group['params']:
@@ -59,104 +105,223 @@ class Adam8bit(Optimizer):
                     param.grad = param._accum_grad
                     del param._accum_grad
 
+    def _init_state(self, p: torch.Tensor) -> dict:
+        num_blocks = (p.numel() + self.block_size - 1) // self.block_size
+        state = self.state[p]
+        state['step'] = 0
+        # Exponential moving average of gradient values
+        state['exp_avg'] = torch.zeros(num_blocks * self.block_size, dtype=torch.int8, device=p.device)
+        state['exp_avg_scale'] = torch.ones(num_blocks, dtype=torch.float32, device=p.device)
+        # sqrt of the exponential moving average of squared gradient values
+        state['exp_avg_sq'] = torch.zeros(num_blocks * self.block_size, dtype=torch.uint8, device=p.device)
+        state['exp_avg_sq_scale'] = torch.ones(num_blocks, dtype=torch.float32, device=p.device)
+        return state
+
+    def _get_chunks(self, params: List[torch.Tensor]) -> List[List[torch.Tensor]]:
+        # params that can share flat buffers, same device and dtype and at most FLAT_CHUNK_NUMEL together.
+        # Quantized params are never flattened together, each gets its own chunk
+        buckets: Dict[tuple, List[List[torch.Tensor]]] = {}
+        bucket_numel: Dict[tuple, int] = {}
+        for p in params:
+            key = ('quantized', id(p)) if isinstance(p, QBytesTensor) else (p.device, p.dtype)
+            chunks = buckets.setdefault(key, [[]])
+            max_numel = FLAT_CHUNK_NUMEL_CPU if p.device.type == 'cpu' else FLAT_CHUNK_NUMEL
+            if len(chunks[-1]) > 0 and bucket_numel[key] + p.numel() > max_numel:
+                chunks.append([])
+                bucket_numel[key] = 0
+            chunks[-1].append(p)
+            bucket_numel[key] = bucket_numel.get(key, 0) + p.numel()
+        return [chunk for chunks in buckets.values() for chunk in chunks]
+
     @torch.no_grad()
     def step(self, closure=None):
         """Performs a single optimization step.
-        
+
         Arguments:
             closure (callable, optional): A closure that reevaluates the model and returns the loss.
         """
         # Call pre step
         self.step_hook()
-        
+
         loss = None
         if closure is not None:
             loss = closure()
 
         for group in self.param_groups:
-            beta1, beta2 = group['betas']
-            eps = group['eps']
-            lr = group['lr']
-            decay = group['weight_decay']
-            decouple = group['decouple']
-
-            for p in group['params']:
-                if p.grad is None:
-                    continue
-
-                grad = p.grad.data.to(torch.float32)
-                p_fp32 = p.clone().to(torch.float32)
-
-                # Apply weight decay (coupled variant)
-                if decay != 0 and not decouple:
-                    grad.add_(p_fp32.data, alpha=decay)
-
-                state = self.state[p]
-
-                # State initialization
-                if len(state) == 0:
-                    state['step'] = 0
-                    # Exponential moving average of gradient values
-                    state['exp_avg'] = Auto8bitTensor(
-                        torch.zeros_like(p_fp32.data).detach())
-                    # Exponential moving average of squared gradient values
-                    state['exp_avg_sq'] = Auto8bitTensor(
-                        torch.zeros_like(p_fp32.data).detach())
-
-                exp_avg = state['exp_avg'].to(torch.float32)
-                exp_avg_sq = state['exp_avg_sq'].to(torch.float32)
-
-                state['step'] += 1
-                bias_correction1 = 1 - beta1 ** state['step']
-                bias_correction2 = 1 - beta2 ** state['step']
-
-                # Adam EMA updates
-                exp_avg.mul_(beta1).add_(grad, alpha=1-beta1)
-                exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1-beta2)
-
-                # Apply weight decay (decoupled variant)
-                if decay != 0 and decouple:
-                    p_fp32.data.mul_(1 - lr * decay)
-
-                # Bias correction
-                step_size = lr / bias_correction1
-                denom = (exp_avg_sq.sqrt() / math.sqrt(bias_correction2)).add_(eps)
-
-                # Take step
-                p_fp32.data.addcdiv_(exp_avg, denom, value=-step_size)
-                
-                # Update state with stochastic rounding
-                state['exp_avg'] = Auto8bitTensor(exp_avg)
-                state['exp_avg_sq'] = Auto8bitTensor(exp_avg_sq)
-                
-                # Apply stochastic rounding to parameters
-                copy_stochastic(p.data, p_fp32.data)
+            params = [p for p in group['params'] if p.grad is not None]
+            for chunk in self._get_chunks(params):
+                self._step_chunk(group, chunk)
 
         return loss
-    
-    def state_dict(self):
-        """Returns the state of the optimizer as a dict."""
-        state_dict = super().state_dict()
-        
-        # Convert Auto8bitTensor objects to regular state dicts
-        for param_id, param_state in state_dict['state'].items():
-            for key, value in param_state.items():
-                if isinstance(value, Auto8bitTensor):
-                    param_state[key] = {
-                        '_type': 'Auto8bitTensor',
-                        'state': value.state_dict()
-                    }
-        
-        return state_dict
+
+    def _step_chunk(self, group, params: List[torch.Tensor]):
+        beta1, beta2 = group['betas']
+        eps = group['eps']
+        lr = group['lr']
+        decay = group['weight_decay']
+        decouple = group['decouple']
+        block_size = self.block_size
+
+        states = [self.state[p] if len(self.state[p]) > 0 else self._init_state(p) for p in params]
+        split_sizes = []
+        block_counts = []
+        for p, state in zip(params, states):
+            padded = state['exp_avg'].numel()
+            split_sizes.extend([p.numel(), padded - p.numel()])
+            block_counts.append(padded // block_size)
+        num_blocks = sum(block_counts)
+        device = params[0].device
+        is_quantized = isinstance(params[0], QBytesTensor)
+        is_fp32 = params[0].dtype == torch.float32 and not is_quantized
+        if is_quantized:
+            params_flat = [params[0].dequantize().reshape(-1)]
+        else:
+            # reshape copies non contiguous params, like transposed lora weights. _write_back copies those back
+            params_flat = [p.reshape(-1) for p in params]
+
+        # all grads in one zero padded flat buffer, blocks never cross params
+        grad = self._to_flat_fp32([p.grad.reshape(-1) for p in params], split_sizes, device)
+        grad = grad.view(num_blocks, block_size)
+
+        param_fp32 = None
+        if not is_fp32 or (decay != 0 and not decouple):
+            param_fp32 = self._to_flat_fp32(params_flat, split_sizes, device)
+
+        # Apply weight decay (coupled variant)
+        if decay != 0 and not decouple:
+            grad.add_(param_fp32.view(num_blocks, block_size), alpha=decay)
+
+        exp_avg = dequantize_blockwise(
+            torch.cat([s['exp_avg'] for s in states]), torch.cat([s['exp_avg_scale'] for s in states]), block_size
+        )
+        exp_avg_sq = dequantize_blockwise(
+            torch.cat([s['exp_avg_sq'] for s in states]), torch.cat([s['exp_avg_sq_scale'] for s in states]), block_size
+        ).square_()
+
+        for state in states:
+            state['step'] += 1
+        steps = [state['step'] for state in states]
+        if all(step == steps[0] for step in steps):
+            bias_correction1 = 1 - beta1 ** steps[0]
+            bias_correction2_sqrt = math.sqrt(1 - beta2 ** steps[0])
+        else:
+            # params that missed steps keep their own bias correction, one value per block
+            step_per_block = torch.repeat_interleave(
+                torch.tensor(steps, dtype=torch.float32, device=device),
+                torch.tensor(block_counts, device=device)
+            ).view(-1, 1)
+            bias_correction1 = 1 - torch.pow(beta1, step_per_block)
+            bias_correction2_sqrt = (1 - torch.pow(beta2, step_per_block)).sqrt_()
+
+        # Adam EMA updates
+        exp_avg.lerp_(grad, 1 - beta1)
+        exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+        del grad
+        exp_avg_sq_sqrt = exp_avg_sq.sqrt_()
+
+        # Bias correction, lr / bc1 * m / (sqrt(v) / sqrt(bc2) + eps) with the sqrt(bc2) moved to the step size
+        denom = torch.add(exp_avg_sq_sqrt, eps * bias_correction2_sqrt)
+        step_size = lr * bias_correction2_sqrt / bias_correction1
+        if isinstance(step_size, torch.Tensor):
+            # steps differ per block, fold the step size into the numerator
+            denom.div_(step_size)
+            step_size = 1.0
+
+        # Update state, written into the existing state tensors
+        state_split_sizes = [c * block_size for c in block_counts]
+        levels, scale = quantize_blockwise(exp_avg, -127, 127)
+        torch._foreach_copy_([s['exp_avg'] for s in states], list(torch.split(levels.view(-1), state_split_sizes)))
+        torch._foreach_copy_([s['exp_avg_scale'] for s in states], list(torch.split(scale, block_counts)))
+        # never round a second moment to zero, it would divide the update by eps. Exact zeros in a block
+        # become the smallest level, the first moment there is zero as well so it does not matter
+        levels, scale = quantize_blockwise(exp_avg_sq_sqrt, 1, 255)
+        torch._foreach_copy_([s['exp_avg_sq'] for s in states], list(torch.split(levels.view(-1), state_split_sizes)))
+        torch._foreach_copy_([s['exp_avg_sq_scale'] for s in states], list(torch.split(scale, block_counts)))
+        del levels, exp_avg_sq_sqrt
+
+        if is_fp32:
+            # Apply weight decay (decoupled variant)
+            if decay != 0 and decouple:
+                torch._foreach_mul_(params_flat, 1 - lr * decay)
+            # Take step
+            torch._foreach_addcdiv_(
+                params_flat,
+                _split_flat(exp_avg.view(-1), split_sizes),
+                _split_flat(denom.view(-1), split_sizes),
+                value=-step_size
+            )
+            self._write_back(params, params_flat)
+            return
+
+        param_fp32 = param_fp32.view(num_blocks, block_size)
+        if decay != 0 and decouple:
+            param_fp32.mul_(1 - lr * decay)
+        # Take step
+        param_fp32.addcdiv_(exp_avg, denom, value=-step_size)
+        del exp_avg, denom
+
+        if is_quantized:
+            p_fp32 = _split_flat(param_fp32.view(-1), split_sizes)[0]
+            write_stacked_params(params, p_fp32.view(1, *params[0].shape))
+            return
+
+        # Apply stochastic rounding to parameters
+        if params[0].dtype == torch.bfloat16:
+            rounded = torch.empty(param_fp32.numel(), dtype=torch.bfloat16, device=device)
+            copy_stochastic_bf16(rounded, param_fp32.view(-1))
+            torch._foreach_copy_(params_flat, _split_flat(rounded, split_sizes))
+        else:
+            for p, p_fp32 in zip(params_flat, _split_flat(param_fp32.view(-1), split_sizes)):
+                copy_stochastic(p, p_fp32)
+        self._write_back(params, params_flat)
+
+    def _write_back(self, params: List[torch.Tensor], params_flat: List[torch.Tensor]):
+        # params_flat of a non contiguous param is a copy, the update has to be copied into the param
+        for p, p_flat in zip(params, params_flat):
+            if not p.is_contiguous():
+                p.copy_(p_flat.view(p.shape))
+
+    def _to_flat_fp32(self, tensors: List[torch.Tensor], split_sizes: List[int], device) -> torch.Tensor:
+        flat = torch.empty(sum(split_sizes), dtype=torch.float32, device=device)
+        pieces = torch.split(flat, split_sizes)
+        torch._foreach_copy_(list(pieces[::2]), tensors)
+        padding = [piece for piece in pieces[1::2] if piece.numel() > 0]
+        if len(padding) > 0:
+            torch._foreach_zero_(padding)
+        return flat
+
+    def _requantize_legacy_state(self, p: torch.Tensor, state: dict):
+        # older saves kept both moments as one per tensor scaled Auto8bitTensor state dict
+        if not isinstance(state.get('exp_avg'), dict) or state['exp_avg'].get('_type') != 'Auto8bitTensor':
+            return
+        step = state['step']
+        exp_avg = state['exp_avg']['state']
+        exp_avg_sq = state['exp_avg_sq']['state']
+        self._init_state(p)
+        state['step'] = step
+        for key, value, min_level, max_level in [
+            ('exp_avg', exp_avg['quantized'].to(p.device, torch.float32) * exp_avg['scale'], -127, 127),
+            ('exp_avg_sq', (exp_avg_sq['quantized'].to(p.device, torch.float32) * exp_avg_sq['scale']).clamp_(min=0).sqrt_(), 1, 255),
+        ]:
+            padded = torch.zeros(state[key].numel(), dtype=torch.float32, device=p.device)
+            padded[:value.numel()] = value.view(-1)
+            levels, scale = quantize_blockwise(padded.view(-1, self.block_size), min_level, max_level)
+            state[key].copy_(levels.view(-1))
+            state[f'{key}_scale'].copy_(scale)
 
     def load_state_dict(self, state_dict):
         """Loads the optimizer state."""
-        # First, load the basic state
         super().load_state_dict(state_dict)
-        
-        # Then convert any Auto8bitTensor states back to objects
-        for param_id, param_state in self.state.items():
-            for key, value in param_state.items():
-                if isinstance(value, dict) and value.get('_type') == 'Auto8bitTensor':
-                    param_state[key] = Auto8bitTensor(value['state'])
 
+        # the base class casts float state to the param dtype, the scales need to stay fp32
+        saved_ids = [param_id for group in state_dict['param_groups'] for param_id in group['params']]
+        params = [p for group in self.param_groups for p in group['params']]
+        for param_id, p in zip(saved_ids, params):
+            saved_state = state_dict['state'].get(param_id, None)
+            if saved_state is None or p not in self.state:
+                continue
+            state = self.state[p]
+            for key in ['exp_avg_scale', 'exp_avg_sq_scale']:
+                if isinstance(saved_state.get(key), torch.Tensor):
+                    state[key] = saved_state[key].to(p.device, dtype=torch.float32)
+            self._requantize_legacy_state(p, state)
@@ -1,7 +1,7 @@
 from typing import List
 import torch
-from toolkit.optimizers.optimizer_utils import Auto8bitTensor, copy_stochastic, stochastic_grad_accummulation
-from optimum.quanto import QBytesTensor
+from toolkit.optimizers.optimizer_utils import Auto8bitTensor, stochastic_grad_accummulation, bucket_params, \
+    stack_params_fp32, write_stacked_params, per_param_view_shape, stacked_rms
 import random
 
 
@@ -163,128 +163,157 @@ class Automagic(torch.optim.Optimizer):
             loss = closure()
 
         for group in self.param_groups:
+            params = []
             for p in group["params"]:
                 if p.grad is None or not p.requires_grad:
                     continue
-
-                grad = p.grad
-                if grad.dtype != torch.float32:
-                    grad = grad.to(torch.float32)
-                if grad.is_sparse:
+                if p.grad.is_sparse:
                     raise RuntimeError(
                         "Automagic does not support sparse gradients.")
+                self._prepare_state(p)
+                params.append(p)
 
-                state = self.state[p]
-                grad_shape = grad.shape
-
-                factored = len(grad_shape) >= 2
-                # State Initialization
-                if len(state) == 0:
-                    self.initialize_state(p)
-                else:
-                    # Check if exp_avg_sq_row and exp_avg_sq_col exist for factored case
-                    if factored:
-                        if "exp_avg_sq_row" not in state or "exp_avg_sq_col" not in state:
-                            state["exp_avg_sq_row"] = torch.zeros(p.shape[:-1]).to(grad)
-                            state["exp_avg_sq_col"] = torch.zeros(p.shape[:-2] + p.shape[-1:]).to(grad)
-                        else:
-                            state["exp_avg_sq_row"] = state["exp_avg_sq_row"].to(grad)
-                            state["exp_avg_sq_col"] = state["exp_avg_sq_col"].to(grad)
-                    # Check if exp_avg_sq exists for non-factored case
-                    else:
-                        if "exp_avg_sq" not in state:
-                            state["exp_avg_sq"] = torch.zeros_like(grad)
-                        else:
-                            state["exp_avg_sq"] = state["exp_avg_sq"].to(grad)
-
-                p_data_fp32 = p
-
-                if isinstance(p_data_fp32, QBytesTensor):
-                    p_data_fp32 = p_data_fp32.dequantize()
-                if p.dtype != torch.float32:
-                    p_data_fp32 = p_data_fp32.clone().float()
-
-                # Initialize step if it doesn't exist
-                if "step" not in state:
-                    state["step"] = 0
-                state["step"] += 1
-                state["RMS"] = self._rms(p_data_fp32)
-
-                # Use fixed beta2 from group instead of decay_rate calculation
-                beta2 = group["beta2"]
-                eps = group["eps"]
-                if isinstance(eps, tuple) or isinstance(eps, list):
-                    eps = eps[0]
-                update = (grad**2) + eps
-                if factored:
-                    exp_avg_sq_row = state["exp_avg_sq_row"]
-                    exp_avg_sq_col = state["exp_avg_sq_col"]
-
-                    exp_avg_sq_row.mul_(beta2).add_(
-                        update.mean(dim=-1), alpha=(1.0 - beta2))
-                    exp_avg_sq_col.mul_(beta2).add_(
-                        update.mean(dim=-2), alpha=(1.0 - beta2))
-
-                    # Approximation of exponential moving average of square of gradient
-                    update = self._approx_sq_grad(
-                        exp_avg_sq_row, exp_avg_sq_col)
-                    update.mul_(grad)
-                else:
-                    exp_avg_sq = state["exp_avg_sq"]
-
-                    exp_avg_sq.mul_(beta2).add_(update, alpha=(1.0 - beta2))
-                    update = exp_avg_sq.rsqrt().mul_(grad)
-
-                update.div_(
-                    (self._rms(update) / group["clip_threshold"]).clamp_(min=1.0))
-
-                # Ensure state is properly initialized
-                if 'last_polarity' not in state or 'lr_mask' not in state:
-                    self.initialize_state(p)
-                
-                # Get signs of current last update and updates
-                last_polarity = state['last_polarity']
-                current_polarity = (update > 0).to(torch.bool)
-                sign_agreement = torch.where(
-                    last_polarity == current_polarity, 1, -1)
-                state['last_polarity'] = current_polarity
-
-                lr_mask = state['lr_mask'].to(torch.float32)
-
-                # Update learning rate mask based on sign agreement
-                new_lr = torch.where(
-                    sign_agreement > 0,
-                    lr_mask + self.lr_bump,  # Increase lr
-                    lr_mask - self.lr_bump  # Decrease lr
-                )
-
-                # Clip learning rates to bounds
-                new_lr = torch.clamp(
-                    new_lr,
-                    min=self.min_lr,
-                    max=self.max_lr
-                )
-
-                # Apply the learning rate mask to the update
-                update.mul_(new_lr)
-
-                state['lr_mask'] = Auto8bitTensor(new_lr)
-                state['avg_lr'] = torch.mean(new_lr)
-
-                if group["weight_decay"] != 0:
-                    # Apply weight decay with per-parameter learning rates
-                    # Instead of using add_ with a tensor alpha (which isn't supported),
-                    # we'll use element-wise multiplication to apply the weight decay
-                    weight_decay_update = p_data_fp32 * (-group["weight_decay"]) * new_lr
-                    p_data_fp32.add_(weight_decay_update)
+            # params with the same shape are updated together with batched ops
+            buckets = bucket_params(
+                params,
+                lambda p: (p.device, p.dtype, p.grad.dtype, tuple(p.shape))
+            )
+            for bucket in buckets:
+                self._step_bucket(group, bucket)
 
-                p_data_fp32.add_(-update)
+        return loss
 
-                if p.dtype != torch.float32:
-                    # apply stochastic rounding
-                    copy_stochastic(p, p_data_fp32)
+    def _prepare_state(self, p):
+        state = self.state[p]
+        factored = len(p.grad.shape) >= 2
+        # State Initialization
+        if len(state) == 0:
+            self.initialize_state(p)
+        # Ensure state is properly initialized
+        if 'last_polarity' not in state or 'lr_mask' not in state:
+            self.initialize_state(p)
+        # Initialize step if it doesn't exist
+        if "step" not in state:
+            state["step"] = 0
+
+        # second moments are kept in fp32 on the grad device, so a bucket can be stacked
+        if factored:
+            # Check if exp_avg_sq_row and exp_avg_sq_col exist for factored case
+            if "exp_avg_sq_row" not in state or "exp_avg_sq_col" not in state:
+                state["exp_avg_sq_row"] = torch.zeros(p.shape[:-1])
+                state["exp_avg_sq_col"] = torch.zeros(p.shape[:-2] + p.shape[-1:])
+            state["exp_avg_sq_row"] = state["exp_avg_sq_row"].to(p.grad.device, torch.float32)
+            state["exp_avg_sq_col"] = state["exp_avg_sq_col"].to(p.grad.device, torch.float32)
+        else:
+            # Check if exp_avg_sq exists for non-factored case
+            if "exp_avg_sq" not in state:
+                state["exp_avg_sq"] = torch.zeros(p.shape)
+            state["exp_avg_sq"] = state["exp_avg_sq"].to(p.grad.device, torch.float32)
+
+    def _step_bucket(self, group, params):
+        # every param in the bucket has the same shape, they are stacked on a new first dim
+        states = [self.state[p] for p in params]
+        factored = len(params[0].shape) >= 2
+
+        grad = torch.stack([p.grad for p in params]).to(torch.float32)
+        p_data_fp32 = stack_params_fp32(params)
+        per_param = per_param_view_shape(grad)
+
+        rms = stacked_rms(p_data_fp32)
+        for i, state in enumerate(states):
+            state["step"] += 1
+            state["RMS"] = rms[i].clone()
+
+        # Use fixed beta2 from group instead of decay_rate calculation
+        beta2 = group["beta2"]
+        eps = group["eps"]
+        if isinstance(eps, tuple) or isinstance(eps, list):
+            eps = eps[0]
+        update = (grad**2) + eps
+        if factored:
+            exp_avg_sq_row = torch.stack([state["exp_avg_sq_row"] for state in states])
+            exp_avg_sq_col = torch.stack([state["exp_avg_sq_col"] for state in states])
+
+            exp_avg_sq_row.mul_(beta2).add_(
+                update.mean(dim=-1), alpha=(1.0 - beta2))
+            exp_avg_sq_col.mul_(beta2).add_(
+                update.mean(dim=-2), alpha=(1.0 - beta2))
+            torch._foreach_copy_([state["exp_avg_sq_row"] for state in states], list(exp_avg_sq_row.unbind(0)))
+            torch._foreach_copy_([state["exp_avg_sq_col"] for state in states], list(exp_avg_sq_col.unbind(0)))
+
+            # Approximation of exponential moving average of square of gradient
+            update = self._approx_sq_grad(
+                exp_avg_sq_row, exp_avg_sq_col)
+            update.mul_(grad)
+        else:
+            exp_avg_sq = torch.stack([state["exp_avg_sq"] for state in states])
+
+            exp_avg_sq.mul_(beta2).add_(update, alpha=(1.0 - beta2))
+            torch._foreach_copy_([state["exp_avg_sq"] for state in states], list(exp_avg_sq.unbind(0)))
+            update = exp_avg_sq.rsqrt().mul_(grad)
+
+        update.div_(
+            (stacked_rms(update) / group["clip_threshold"]).clamp_(min=1.0).view(per_param))
+
+        # Get signs of current last update and updates
+        last_polarity = torch.stack([state['last_polarity'].to(grad.device) for state in states])
+        current_polarity = (update > 0).to(torch.bool)
+        sign_agreement = torch.where(
+            last_polarity == current_polarity, 1, -1)
+        for i, state in enumerate(states):
+            state['last_polarity'] = current_polarity[i].clone()
+
+        # the lr masks keep their own per tensor scale, so saved states stay the same
+        lr_mask = torch.stack([state['lr_mask'].quantized.to(grad.device) for state in states]).to(torch.float32)
+        lr_mask.mul_(torch.tensor([state['lr_mask'].scale for state in states], dtype=torch.float32, device=grad.device).view(per_param))
+
+        # Update learning rate mask based on sign agreement
+        new_lr = torch.where(
+            sign_agreement > 0,
+            lr_mask + self.lr_bump,  # Increase lr
+            lr_mask - self.lr_bump  # Decrease lr
+        )
+
+        # Clip learning rates to bounds
+        new_lr = torch.clamp(
+            new_lr,
+            min=self.min_lr,
+            max=self.max_lr
+        )
+
+        # Apply the learning rate mask to the update
+        update.mul_(new_lr)
+
+        self._store_lr_masks(states, new_lr)
+
+        if group["weight_decay"] != 0:
+            # Apply weight decay with per-parameter learning rates
+            # Instead of using add_ with a tensor alpha (which isn't supported),
+            # we'll use element-wise multiplication to apply the weight decay
+            weight_decay_update = p_data_fp32 * (-group["weight_decay"]) * new_lr
+            p_data_fp32.add_(weight_decay_update)
+
+        p_data_fp32.add_(-update)
+
+        # apply stochastic rounding
+        write_stacked_params(params, p_data_fp32)
 
-        return loss
+    @staticmethod
+    def _store_lr_masks(states, new_lr):
+        # same as Auto8bitTensor(new_lr[i]) for every param, with one sync for all the scales
+        flat_lr = new_lr.reshape(new_lr.shape[0], -1)
+        abs_max = flat_lr.abs().amax(dim=1).tolist()
+        scales = [value / 127.0 if value > 0 else 1.0 for value in abs_max]
+        scale = torch.tensor(scales, dtype=torch.float32, device=new_lr.device).view(per_param_view_shape(new_lr))
+        quantized = (new_lr / scale).round_().clamp_(-127, 127).to(torch.int8)
+        avg_lr = flat_lr.mean(dim=1)
+        for i, state in enumerate(states):
+            state['lr_mask'] = Auto8bitTensor({
+                'quantized': quantized[i].clone(),
+                'scale': scales[i],
+                'orig_dtype': torch.float32,
+            })
+            state['avg_lr'] = avg_lr[i].clone()
     
     def initialize_state(self, p):
         state = self.state[p]
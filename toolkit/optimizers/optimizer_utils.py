@@ -1,6 +1,6 @@
 import torch
 from torch import Tensor
-from typing import Optional
+from typing import Callable, Dict, Hashable, List, Optional
 from optimum.quanto import QBytesTensor
 
 
@@ -225,3 +225,63 @@ def stochastic_grad_accummulation(param):
     else:
         param._accum_grad = param.grad.clone()
         del param.grad
+
+
+# params that are stepped together are stacked into one tensor, this bounds the size of the stacked temporaries
+PARAM_BUCKET_MAX_NUMEL = 2 ** 24
+
+
+def bucket_params(params: List[Tensor], key_fn: Callable[[Tensor], Hashable], max_numel: int = PARAM_BUCKET_MAX_NUMEL) -> List[List[Tensor]]:
+    """
+    Groups params with the same key_fn(param) into buckets of at most max_numel elements, in order.
+    key_fn should include everything the stacked update depends on, like shape, dtype and device.
+    Quantized params are never stacked, each gets its own bucket.
+    """
+    buckets: Dict[Hashable, List[List[Tensor]]] = {}
+    bucket_numel: Dict[Hashable, int] = {}
+    for p in params:
+        key = ('quantized', id(p)) if isinstance(p, QBytesTensor) else key_fn(p)
+        chunks = buckets.setdefault(key, [[]])
+        if len(chunks[-1]) > 0 and bucket_numel[key] + p.numel() > max_numel:
+            chunks.append([])
+            bucket_numel[key] = 0
+        chunks[-1].append(p)
+        bucket_numel[key] = bucket_numel.get(key, 0) + p.numel()
+    return [chunk for chunks in buckets.values() for chunk in chunks]
+
+
+def stack_params_fp32(params: List[Tensor]) -> Tensor:
+    # one fp32 copy of a bucket of same shape params, stacked on a new first dim
+    if len(params) == 1 and isinstance(params[0], QBytesTensor):
+        return params[0].dequantize().to(torch.float32).unsqueeze(0)
+    return torch.stack(params).to(torch.float32)
+
+
+def write_stacked_params(params: List[Tensor], stacked_fp32: Tensor, stochastic_rounding: bool = True):
+    # writes an updated stack from stack_params_fp32 back into its params
+    if len(params) == 1 and isinstance(params[0], QBytesTensor):
+        if params[0].dtype != torch.float32 and stochastic_rounding:
+            copy_stochastic(params[0], stacked_fp32[0])
+        else:
+            update_parameter(params[0], stacked_fp32[0])
+        return
+    if params[0].dtype == torch.float32:
+        torch._foreach_copy_(params, list(stacked_fp32.unbind(0)))
+        return
+    if stochastic_rounding:
+        rounded = torch.empty(stacked_fp32.shape, dtype=params[0].dtype, device=stacked_fp32.device)
+        copy_stochastic(rounded, stacked_fp32)
+    else:
+        rounded = stacked_fp32.to(params[0].dtype)
+    torch._foreach_copy_(params, list(rounded.unbind(0)))
+
+
+def per_param_view_shape(stacked: Tensor) -> tuple:
+    # shape that broadcasts one value per param against a stacked tensor
+    return (stacked.shape[0],) + (1,) * (stacked.dim() - 1)
+
+
+def stacked_rms(stacked: Tensor) -> Tensor:
+    # root mean square of every param in a stack, shape (num_params,)
+    flat = stacked.reshape(stacked.shape[0], -1)
+    return flat.norm(2, dim=1) / (flat.shape[1] ** 0.5)
@@ -6,6 +6,7 @@ from safetensors.torch import load_file, save_file
 from tqdm import tqdm
 import random
 
+from toolkit.cache_pipeline import save_cache_file
 from toolkit.train_tools import get_torch_dtype
 import itertools
 
@@ -125,8 +126,8 @@ class PromptEmbeds:
                     state_dict[f"attention_mask_{i}"] = attn.cpu()
             else:
                 state_dict["attention_mask"] = pe.attention_mask.cpu()
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        save_file(state_dict, path)
+        # written like the latent caches, a crash mid write never leaves a truncated file behind
+        save_cache_file(state_dict, path)
     
     @classmethod
     def load(cls, path: str) -> 'PromptEmbeds':
@@ -349,14 +350,40 @@ def split_prompt_embeds(concatenated: PromptEmbeds, num_parts=None) -> List[Prom
     else:
         pooled_embeds_splits = [None] * num_parts
 
-    prompt_embeds_list = [
-        PromptEmbeds([text, pooled])
-        for text, pooled in zip(text_embeds_splits, pooled_embeds_splits)
-    ]
+    if isinstance(concatenated.attention_mask, list) or isinstance(concatenated.attention_mask, tuple):
+        attention_mask_splits = list(zip(*[torch.chunk(m, num_parts, dim=0) for m in concatenated.attention_mask]))
+    elif concatenated.attention_mask is not None:
+        attention_mask_splits = torch.chunk(concatenated.attention_mask, num_parts, dim=0)
+    else:
+        attention_mask_splits = [None] * num_parts
+
+    prompt_embeds_list = []
+    for text, pooled, attention_mask in zip(text_embeds_splits, pooled_embeds_splits, attention_mask_splits):
+        pe = PromptEmbeds([text, pooled])
+        pe.attention_mask = list(attention_mask) if isinstance(attention_mask, tuple) else attention_mask
+        prompt_embeds_list.append(pe)
 
     return prompt_embeds_list
 
 
+def get_prompt_embeds_valid_length(prompt_embeds: PromptEmbeds) -> Union[int, None]:
+    # length up to the last unmasked token, None if it cannot be told from the mask
+    mask = prompt_embeds.attention_mask
+    if not isinstance(mask, torch.Tensor) or mask.dim() != 2 or isinstance(prompt_embeds.text_embeds, (list, tuple)):
+        return None
+    if mask.shape[1] != prompt_embeds.text_embeds.shape[1]:
+        return None
+    valid = torch.nonzero(mask.sum(dim=0)).flatten()
+    return int(valid[-1].item()) + 1 if len(valid) > 0 else mask.shape[1]
+
+
+def trim_prompt_embeds_padding(prompt_embeds: PromptEmbeds, length: int) -> PromptEmbeds:
+    # drop trailing padding so an embed from a padded batch matches encoding the prompt by itself
+    prompt_embeds.text_embeds = prompt_embeds.text_embeds[:, :length].clone()
+    prompt_embeds.attention_mask = prompt_embeds.attention_mask[:, :length].clone()
+    return prompt_embeds
+
+
 def split_prompt_pairs(concatenated: EncodedPromptPair, num_embeds=None) -> List[EncodedPromptPair]:
     target_class_splits = split_prompt_embeds(concatenated.target_class, num_embeds)
     target_class_with_neutral_splits = split_prompt_embeds(concatenated.target_class_with_neutral, num_embeds)
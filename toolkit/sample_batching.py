@@ -0,0 +1,58 @@
+from collections import OrderedDict
+from typing import TYPE_CHECKING, List
+
+import torch
+
+if TYPE_CHECKING:
+    from toolkit.config_modules import GenerateImageConfig
+    from toolkit.prompt_utils import PromptEmbeds
+
+
+def get_sample_batch_key(gen_config: 'GenerateImageConfig') -> tuple:
+    # everything the pipeline takes once per call, configs can only share a call if these match
+    return (
+        gen_config.width,
+        gen_config.height,
+        gen_config.num_inference_steps,
+        gen_config.guidance_scale,
+        gen_config.guidance_rescale,
+        gen_config.network_multiplier,
+        gen_config.num_frames,
+        gen_config.refiner_start_at,
+        repr(sorted(gen_config.extra_kwargs.items())),
+    )
+
+
+def get_sample_batches(image_configs: List['GenerateImageConfig'], batch_size: int = 1) -> List[List[int]]:
+    """
+    Groups the indexes of image_configs that can be generated in one pipeline call, in batches of up to
+    batch_size. Groups keep the order the first config of each group appears in, and configs keep their
+    order within a group.
+    """
+    groups: 'OrderedDict[tuple, List[int]]' = OrderedDict()
+    for i, gen_config in enumerate(image_configs):
+        groups.setdefault(get_sample_batch_key(gen_config), []).append(i)
+    batch_size = max(1, batch_size)
+    batches = []
+    for indexes in groups.values():
+        for start in range(0, len(indexes), batch_size):
+            batches.append(indexes[start:start + batch_size])
+    return batches
+
+
+def _shapes(value) -> tuple:
+    if value is None:
+        return ()
+    if isinstance(value, (list, tuple)):
+        return tuple(_shapes(v) for v in value)
+    if isinstance(value, torch.Tensor):
+        return tuple(value.shape)
+    return ()
+
+
+def get_embeds_signature(conditional_embeds: 'PromptEmbeds', unconditional_embeds: 'PromptEmbeds') -> tuple:
+    # embeds can only be concatenated without padding when all their shapes match
+    return tuple(
+        (_shapes(embeds.text_embeds), _shapes(embeds.pooled_embeds), _shapes(embeds.attention_mask))
+        for embeds in (conditional_embeds, unconditional_embeds)
+    )
@@ -0,0 +1,69 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING, List
+
+if TYPE_CHECKING:
+    from toolkit.config_modules import GenerateImageConfig
+
+# encoding an animated webp can take longer than generating it, a couple of writers keep up with the model
+SAMPLE_WRITER_MAX_WORKERS = 2
+# samples waiting to be written are held in memory, generation blocks once this many are pending
+SAMPLE_WRITER_MAX_PENDING = 8
+
+
+class SampleWriteError(Exception):
+    """Raised by SampleWriter.drain when a sample could not be saved or logged."""
+
+
+class SampleWriter:
+    """
+    Saves and logs generated samples on background threads so the model can start the next
+    sample right away. Writes are bounded by max_pending, drain waits for all of them and
+    raises if any failed.
+    """
+
+    def __init__(self, max_workers: int = SAMPLE_WRITER_MAX_WORKERS, max_pending: int = SAMPLE_WRITER_MAX_PENDING):
+        self.max_workers = max(1, max_workers)
+        self._slots = threading.BoundedSemaphore(max(1, max_pending))
+        self._executor = None
+        self._lock = threading.Lock()
+        self._futures: List[Future] = []
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        # started on first use, models that never sample do not hold threads
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="sample_writer")
+        return self._executor
+
+    def _write(self, gen_config: 'GenerateImageConfig', image, count: int, max_count: int):
+        try:
+            gen_config.save_image(image, count, max_count)
+            gen_config.log_image(image, count, max_count)
+        finally:
+            self._slots.release()
+
+    def write(self, gen_config: 'GenerateImageConfig', image, count: int = 0, max_count=0):
+        """Queues saving and logging a sample, blocks while max_pending samples are waiting."""
+        self._slots.acquire()
+        try:
+            future = self._get_executor().submit(self._write, gen_config, image, count, max_count)
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._futures.append(future)
+
+    def drain(self):
+        """Waits for every queued sample to be written, raises SampleWriteError if any failed."""
+        with self._lock:
+            futures = self._futures
+            self._futures = []
+        errors = []
+        for future in futures:
+            exc = future.exception()
+            if exc is not None:
+                errors.append(exc)
+        if len(errors) > 0:
+            messages = "\n".join(f"  {type(e).__name__}: {e}" for e in errors)
+            raise SampleWriteError(f"Failed to write {len(errors)} of {len(futures)} samples:\n{messages}") from errors[0]
+
@@ -13,6 +13,33 @@ if TYPE_CHECKING:
     from toolkit.stable_diffusion_model import StableDiffusion
 
 
+def snapshot_to_cpu(value, dtype: Optional[torch.dtype] = None):
+    """
+    Copies every tensor in a state dict (nested dicts, lists and tuples are followed) to new cpu tensors,
+    optionally cast to dtype. Device copies are queued without blocking and waited on once at the end,
+    so the result is a consistent snapshot that can be written on another thread while training goes on.
+    """
+    has_cuda = [False]
+
+    def _copy(v):
+        if isinstance(v, torch.Tensor):
+            if v.is_cuda:
+                has_cuda[0] = True
+            return v.detach().to('cpu', dtype=dtype, non_blocking=True, copy=True)
+        if isinstance(v, dict):
+            return v.__class__((k, _copy(item)) for k, item in v.items())
+        if isinstance(v, list):
+            return [_copy(item) for item in v]
+        if isinstance(v, tuple):
+            return tuple(_copy(item) for item in v)
+        return v
+
+    snapshot = _copy(value)
+    if has_cuda[0]:
+        torch.cuda.synchronize()
+    return snapshot
+
+
 def get_slices_from_string(s: str) -> tuple:
     slice_strings = s.split(',')
     slices = [eval(f"slice({component.strip()})") for component in slice_strings]
@@ -0,0 +1,97 @@
+import json
+import os
+import sqlite3
+from typing import Dict, Tuple
+
+from toolkit.print import print_acc
+
+SizeEntry = Tuple[int, int, str]
+
+
+class SizeDatabase:
+    """
+    Stores (width, height, file signature) for every file in a dataset folder in .aitk_size.db.
+    Only entries that changed since load are written back, so startup on a large dataset that did
+    not change does not rewrite anything. An old .aitk_size.json is imported the first time.
+    """
+
+    def __init__(self, dataset_folder: str, version: str):
+        self.dataset_folder = dataset_folder
+        self.version = version
+        self.db_path = os.path.join(dataset_folder, '.aitk_size.db')
+        self.legacy_json_path = os.path.join(dataset_folder, '.aitk_size.json')
+        self._loaded: Dict[str, SizeEntry] = {}
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=60)
+        conn.execute("CREATE TABLE IF NOT EXISTS sizes (key TEXT PRIMARY KEY, width INTEGER, height INTEGER, signature TEXT)")
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        return conn
+
+    def _load_legacy_json(self) -> Dict[str, SizeEntry]:
+        if not os.path.exists(self.legacy_json_path):
+            return {}
+        try:
+            with open(self.legacy_json_path, 'r') as f:
+                data = json.load(f)
+        except Exception as e:
+            print_acc(f"Error loading size database: {self.legacy_json_path}")
+            print_acc(e)
+            return {}
+        if data.get("__version__", None) != self.version:
+            return {}
+        return {k: tuple(v) for k, v in data.items() if k != "__version__" and v is not None and len(v) >= 3}
+
+    def load(self) -> Dict[str, SizeEntry]:
+        entries: Dict[str, SizeEntry] = {}
+        imported_legacy = False
+        try:
+            conn = self._connect()
+            try:
+                row = conn.execute("SELECT value FROM meta WHERE key = '__version__'").fetchone()
+                if row is None:
+                    # new database, bring over the old json file if there is one
+                    entries = self._load_legacy_json()
+                    imported_legacy = True
+                elif row[0] != self.version:
+                    print_acc("Upgrading size database to new version")
+                    conn.execute("DELETE FROM sizes")
+                    conn.commit()
+                else:
+                    for key, width, height, signature in conn.execute("SELECT key, width, height, signature FROM sizes"):
+                        entries[key] = (width, height, signature)
+            finally:
+                conn.close()
+        except Exception as e:
+            print_acc(f"Error loading size database: {self.db_path}")
+            print_acc(e)
+            entries = {}
+        # anything that was not in the db file needs to be written on save
+        self._loaded = {} if imported_legacy else dict(entries)
+        return entries
+
+    def save(self, entries: Dict[str, SizeEntry]) -> int:
+        changed = [
+            (key, int(value[0]), int(value[1]), str(value[2]))
+            for key, value in entries.items()
+            if key != "__version__" and value is not None and self._loaded.get(key) != tuple(value)
+        ]
+        try:
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('__version__', ?)", (self.version,))
+                    if len(changed) > 0:
+                        conn.executemany(
+                            "INSERT OR REPLACE INTO sizes (key, width, height, signature) VALUES (?, ?, ?, ?)",
+                            changed
+                        )
+            finally:
+                conn.close()
+        except Exception as e:
+            print_acc(f"Error saving size database: {self.db_path}")
+            print_acc(e)
+            return 0
+        for key, width, height, signature in changed:
+            self._loaded[key] = (width, height, signature)
+        return len(changed)
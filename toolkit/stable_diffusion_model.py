@@ -34,6 +34,8 @@ from toolkit.models.decorator import Decorator
 from toolkit.paths import KEYMAPS_ROOT
 from toolkit.prompt_utils import inject_trigger_into_prompt, PromptEmbeds, concat_prompt_embeds
 from toolkit.reference_adapter import ReferenceAdapter
+from toolkit.sample_batching import get_sample_batches, get_embeds_signature
+from toolkit.sample_writer import SampleWriter
 from toolkit.sampler import get_sampler
 from toolkit.samplers.custom_flowmatch_sampler import CustomFlowMatchEulerDiscreteScheduler
 from toolkit.saving import save_ldm_model_from_diffusers, get_ldm_state_dict_from_diffusers
@@ -205,6 +207,7 @@ class StableDiffusion:
         # merge in and preview active with -1 weight
         self.invert_assistant_lora = False
         self._after_sample_img_hooks = []
+        self.sample_writer = SampleWriter()
         self._status_update_hooks = []
         # todo update this based on the model
         self.is_transformer = False
@@ -1123,10 +1126,16 @@ class StableDiffusion:
             image_configs: List[GenerateImageConfig],
             sampler=None,
             pipeline: Union[None, StableDiffusionPipeline, StableDiffusionXLPipeline] = None,
+            batch_size: int = 1,
+            wait_for_writes: bool = True,
     ):
         network = unwrap_model(self.network)
         merge_multiplier = 1.0
         flush()
+        # adapters, the refiner and fixed latents hold state for a single image, those are generated one at a time
+        if self.adapter is not None or self.refiner_unet is not None or \
+                any(gen_config.latents is not None for gen_config in image_configs):
+            batch_size = 1
         # if using assistant, unfuse it
         if self.model_config.assistant_lora_path is not None:
             print_acc("Unloading assistant lora")
@@ -1363,347 +1372,377 @@ class StableDiffusion:
                 if network is not None:
                     assert network.is_active
 
-                for i in tqdm(range(len(image_configs)), desc=f"Generating Images", leave=False):
-                    gen_config = image_configs[i]
-
-                    extra = {}
-                    validation_image = None
-                    if self.adapter is not None and gen_config.adapter_image_path is not None:
-                        validation_image = Image.open(gen_config.adapter_image_path)
-                        # if the name doesnt have .inpainting. in it, make sure it is rgb
-                        if ".inpaint." not in gen_config.adapter_image_path:
-                            validation_image = validation_image.convert("RGB")
-                        else:
-                            # make sure it has an alpha
-                            if validation_image.mode != "RGBA":
-                                raise ValueError("Inpainting images must have an alpha channel")
-                        if isinstance(self.adapter, T2IAdapter):
-                            # not sure why this is double??
-                            validation_image = validation_image.resize((gen_config.width * 2, gen_config.height * 2))
-                            extra['image'] = validation_image
-                            extra['adapter_conditioning_scale'] = gen_config.adapter_conditioning_scale
-                        if isinstance(self.adapter, ControlNetModel):
-                            validation_image = validation_image.resize((gen_config.width, gen_config.height))
-                            extra['image'] = validation_image
-                            extra['controlnet_conditioning_scale'] = gen_config.adapter_conditioning_scale
-                        if isinstance(self.adapter, CustomAdapter) and self.adapter.control_lora is not None:
-                            validation_image = validation_image.resize((gen_config.width, gen_config.height))
-                            extra['control_image'] = validation_image
-                            extra['control_image_idx'] = gen_config.ctrl_idx
-                        if isinstance(self.adapter, IPAdapter) or isinstance(self.adapter, ClipVisionAdapter):
-                            transform = transforms.Compose([
-                                transforms.ToTensor(),
-                            ])
-                            validation_image = transform(validation_image)
-                        if isinstance(self.adapter, CustomAdapter):
-                            # todo allow loading multiple
-                            transform = transforms.Compose([
-                                transforms.ToTensor(),
-                            ])
-                            validation_image = transform(validation_image)
-                            self.adapter.num_images = 1
-                        if isinstance(self.adapter, ReferenceAdapter):
-                            # need -1 to 1
-                            validation_image = transforms.ToTensor()(validation_image)
-                            validation_image = validation_image * 2.0 - 1.0
-                            validation_image = validation_image.unsqueeze(0)
-                            self.adapter.set_reference_images(validation_image)
-
-                    if network is not None:
-                        network.multiplier = gen_config.network_multiplier
-                    torch.manual_seed(gen_config.seed)
-                    torch.cuda.manual_seed(gen_config.seed)
+                sample_batches = get_sample_batches(image_configs, batch_size)
+                num_done = 0
+                last_size = None
+                for batch in tqdm(sample_batches, desc=f"Generating Images", leave=False):
+                    # memory is only freed when the size changes, batches of the same size reuse it
+                    size = (image_configs[batch[0]].width, image_configs[batch[0]].height, image_configs[batch[0]].num_frames)
+                    if last_size is not None and size != last_size:
+                        flush()
+                    last_size = size
+                    prepared = []
+                    for i in batch:
+                        gen_config = image_configs[i]
+
+                        extra = {}
+                        validation_image = None
+                        if self.adapter is not None and gen_config.adapter_image_path is not None:
+                            validation_image = Image.open(gen_config.adapter_image_path)
+                            # if the name doesnt have .inpainting. in it, make sure it is rgb
+                            if ".inpaint." not in gen_config.adapter_image_path:
+                                validation_image = validation_image.convert("RGB")
+                            else:
+                                # make sure it has an alpha
+                                if validation_image.mode != "RGBA":
+                                    raise ValueError("Inpainting images must have an alpha channel")
+                            if isinstance(self.adapter, T2IAdapter):
+                                # not sure why this is double??
+                                validation_image = validation_image.resize((gen_config.width * 2, gen_config.height * 2))
+                                extra['image'] = validation_image
+                                extra['adapter_conditioning_scale'] = gen_config.adapter_conditioning_scale
+                            if isinstance(self.adapter, ControlNetModel):
+                                validation_image = validation_image.resize((gen_config.width, gen_config.height))
+                                extra['image'] = validation_image
+                                extra['controlnet_conditioning_scale'] = gen_config.adapter_conditioning_scale
+                            if isinstance(self.adapter, CustomAdapter) and self.adapter.control_lora is not None:
+                                validation_image = validation_image.resize((gen_config.width, gen_config.height))
+                                extra['control_image'] = validation_image
+                                extra['control_image_idx'] = gen_config.ctrl_idx
+                            if isinstance(self.adapter, IPAdapter) or isinstance(self.adapter, ClipVisionAdapter):
+                                transform = transforms.Compose([
+                                    transforms.ToTensor(),
+                                ])
+                                validation_image = transform(validation_image)
+                            if isinstance(self.adapter, CustomAdapter):
+                                # todo allow loading multiple
+                                transform = transforms.Compose([
+                                    transforms.ToTensor(),
+                                ])
+                                validation_image = transform(validation_image)
+                                self.adapter.num_images = 1
+                            if isinstance(self.adapter, ReferenceAdapter):
+                                # need -1 to 1
+                                validation_image = transforms.ToTensor()(validation_image)
+                                validation_image = validation_image * 2.0 - 1.0
+                                validation_image = validation_image.unsqueeze(0)
+                                self.adapter.set_reference_images(validation_image)
+
+                        if network is not None:
+                            network.multiplier = gen_config.network_multiplier
+                        torch.manual_seed(gen_config.seed)
+                        torch.cuda.manual_seed(gen_config.seed)
                     
-                    generator = torch.manual_seed(gen_config.seed)
-
-                    if self.adapter is not None and isinstance(self.adapter, ClipVisionAdapter) \
-                            and gen_config.adapter_image_path is not None:
-                        # run through the adapter to saturate the embeds
-                        conditional_clip_embeds = self.adapter.get_clip_image_embeds_from_tensors(validation_image)
-                        self.adapter(conditional_clip_embeds)
-
-                    if self.adapter is not None and isinstance(self.adapter, CustomAdapter):
-                        # handle condition the prompts
-                        gen_config.prompt = self.adapter.condition_prompt(
-                            gen_config.prompt,
-                            is_unconditional=False,
-                        )
-                        gen_config.prompt_2 = gen_config.prompt
-                        gen_config.negative_prompt = self.adapter.condition_prompt(
-                            gen_config.negative_prompt,
-                            is_unconditional=True,
-                        )
-                        gen_config.negative_prompt_2 = gen_config.negative_prompt
-
-                    if self.adapter is not None and isinstance(self.adapter, CustomAdapter) and validation_image is not None:
-                        self.adapter.trigger_pre_te(
-                            tensors_0_1=validation_image,
-                            is_training=False,
-                            has_been_preprocessed=False,
-                            quad_count=4
-                        )
 
-                    if self.sample_prompts_cache is not None:
-                        conditional_embeds = self.sample_prompts_cache[i]['conditional'].to(self.device_torch, dtype=self.torch_dtype)
-                        unconditional_embeds = self.sample_prompts_cache[i]['unconditional'].to(self.device_torch, dtype=self.torch_dtype)
-                    else: 
-                        # encode the prompt ourselves so we can do fun stuff with embeddings
-                        if isinstance(self.adapter, CustomAdapter):
-                            self.adapter.is_unconditional_run = False
-                        conditional_embeds = self.encode_prompt(gen_config.prompt, gen_config.prompt_2, force_all=True)
-
-                        if isinstance(self.adapter, CustomAdapter):
-                            self.adapter.is_unconditional_run = True
-                        unconditional_embeds = self.encode_prompt(
-                            gen_config.negative_prompt, gen_config.negative_prompt_2, force_all=True
+                        if self.adapter is not None and isinstance(self.adapter, ClipVisionAdapter) \
+                                and gen_config.adapter_image_path is not None:
+                            # run through the adapter to saturate the embeds
+                            conditional_clip_embeds = self.adapter.get_clip_image_embeds_from_tensors(validation_image)
+                            self.adapter(conditional_clip_embeds)
+
+                        if self.adapter is not None and isinstance(self.adapter, CustomAdapter):
+                            # handle condition the prompts
+                            gen_config.prompt = self.adapter.condition_prompt(
+                                gen_config.prompt,
+                                is_unconditional=False,
+                            )
+                            gen_config.prompt_2 = gen_config.prompt
+                            gen_config.negative_prompt = self.adapter.condition_prompt(
+                                gen_config.negative_prompt,
+                                is_unconditional=True,
+                            )
+                            gen_config.negative_prompt_2 = gen_config.negative_prompt
+
+                        if self.adapter is not None and isinstance(self.adapter, CustomAdapter) and validation_image is not None:
+                            self.adapter.trigger_pre_te(
+                                tensors_0_1=validation_image,
+                                is_training=False,
+                                has_been_preprocessed=False,
+                                quad_count=4
+                            )
+
+                        if self.sample_prompts_cache is not None:
+                            conditional_embeds = self.sample_prompts_cache[i]['conditional'].to(self.device_torch, dtype=self.torch_dtype)
+                            unconditional_embeds = self.sample_prompts_cache[i]['unconditional'].to(self.device_torch, dtype=self.torch_dtype)
+                        else: 
+                            # encode the prompt ourselves so we can do fun stuff with embeddings
+                            if isinstance(self.adapter, CustomAdapter):
+                                self.adapter.is_unconditional_run = False
+                            conditional_embeds = self.encode_prompt(gen_config.prompt, gen_config.prompt_2, force_all=True)
+
+                            if isinstance(self.adapter, CustomAdapter):
+                                self.adapter.is_unconditional_run = True
+                            unconditional_embeds = self.encode_prompt(
+                                gen_config.negative_prompt, gen_config.negative_prompt_2, force_all=True
+                            )
+                            if isinstance(self.adapter, CustomAdapter):
+                                self.adapter.is_unconditional_run = False
+
+                        # allow any manipulations to take place to embeddings
+                        gen_config.post_process_embeddings(
+                            conditional_embeds,
+                            unconditional_embeds,
                         )
-                        if isinstance(self.adapter, CustomAdapter):
-                            self.adapter.is_unconditional_run = False
-
-                    # allow any manipulations to take place to embeddings
-                    gen_config.post_process_embeddings(
-                        conditional_embeds,
-                        unconditional_embeds,
-                    )
                     
-                    if self.decorator is not None:
-                        # apply the decorator to the embeddings
-                        conditional_embeds.text_embeds = self.decorator(conditional_embeds.text_embeds)
-                        unconditional_embeds.text_embeds = self.decorator(unconditional_embeds.text_embeds, is_unconditional=True)
-
-                    if self.adapter is not None and isinstance(self.adapter, IPAdapter) \
-                            and gen_config.adapter_image_path is not None:
-                        # apply the image projection
-                        conditional_clip_embeds = self.adapter.get_clip_image_embeds_from_tensors(validation_image)
-                        unconditional_clip_embeds = self.adapter.get_clip_image_embeds_from_tensors(validation_image,
-                                                                                                    True)
-                        conditional_embeds = self.adapter(conditional_embeds, conditional_clip_embeds, is_unconditional=False)
-                        unconditional_embeds = self.adapter(unconditional_embeds, unconditional_clip_embeds, is_unconditional=True)
-
-                    if self.adapter is not None and isinstance(self.adapter, CustomAdapter):
-                        conditional_embeds = self.adapter.condition_encoded_embeds(
-                            tensors_0_1=validation_image,
-                            prompt_embeds=conditional_embeds,
-                            is_training=False,
-                            has_been_preprocessed=False,
-                            is_generating_samples=True,
-                        )
-                        unconditional_embeds = self.adapter.condition_encoded_embeds(
-                            tensors_0_1=validation_image,
-                            prompt_embeds=unconditional_embeds,
-                            is_training=False,
-                            has_been_preprocessed=False,
-                            is_unconditional=True,
-                            is_generating_samples=True,
-                        )
-
-                    if self.adapter is not None and isinstance(self.adapter, CustomAdapter) and len(
-                            gen_config.extra_values) > 0:
-                        extra_values = torch.tensor([gen_config.extra_values], device=self.device_torch,
-                                                    dtype=self.torch_dtype)
-                        # apply extra values to the embeddings
-                        self.adapter.add_extra_values(extra_values, is_unconditional=False)
-                        self.adapter.add_extra_values(torch.zeros_like(extra_values), is_unconditional=True)
-                        pass  # todo remove, for debugging
-
-                    if self.refiner_unet is not None and gen_config.refiner_start_at < 1.0:
-                        # if we have a refiner loaded, set the denoising end at the refiner start
-                        extra['denoising_end'] = gen_config.refiner_start_at
-                        extra['output_type'] = 'latent'
-                        if not self.is_xl:
-                            raise ValueError("Refiner is only supported for XL models")
-
-                    conditional_embeds = conditional_embeds.to(self.device_torch, dtype=self.unet.dtype)
-                    unconditional_embeds = unconditional_embeds.to(self.device_torch, dtype=self.unet.dtype)
-
-                    if self.is_xl:
-                        # fix guidance rescale for sdxl
-                        # was trained on 0.7 (I believe)
-
-                        grs = gen_config.guidance_rescale
-                        # if grs is None or grs < 0.00001:
-                        #     grs = 0.7
-                        # grs = 0.0
-
-                        if sampler.startswith("sample_"):
-                            extra['use_karras_sigmas'] = True
-                            extra = {
-                                **extra,
-                                **gen_config.extra_kwargs,
-                            }
-
-                        img = pipeline(
-                            # prompt=gen_config.prompt,
-                            # prompt_2=gen_config.prompt_2,
-                            prompt_embeds=conditional_embeds.text_embeds,
-                            pooled_prompt_embeds=conditional_embeds.pooled_embeds,
-                            negative_prompt_embeds=unconditional_embeds.text_embeds,
-                            negative_pooled_prompt_embeds=unconditional_embeds.pooled_embeds,
-                            # negative_prompt=gen_config.negative_prompt,
-                            # negative_prompt_2=gen_config.negative_prompt_2,
-                            height=gen_config.height,
-                            width=gen_config.width,
-                            num_inference_steps=gen_config.num_inference_steps,
-                            guidance_scale=gen_config.guidance_scale,
-                            guidance_rescale=grs,
-                            latents=gen_config.latents,
-                            generator=generator,
-                            **extra
-                        ).images[0]
-                    elif self.is_v3:
-                        img = pipeline(
-                            prompt_embeds=conditional_embeds.text_embeds,
-                            pooled_prompt_embeds=conditional_embeds.pooled_embeds,
-                            negative_prompt_embeds=unconditional_embeds.text_embeds,
-                            negative_pooled_prompt_embeds=unconditional_embeds.pooled_embeds,
-                            height=gen_config.height,
-                            width=gen_config.width,
-                            num_inference_steps=gen_config.num_inference_steps,
-                            guidance_scale=gen_config.guidance_scale,
-                            latents=gen_config.latents,
-                            generator=generator,
-                            **extra
-                        ).images[0]
-                    elif self.is_flux:
-                        if self.model_config.use_flux_cfg:
-                            img = pipeline(
+                        if self.decorator is not None:
+                            # apply the decorator to the embeddings
+                            conditional_embeds.text_embeds = self.decorator(conditional_embeds.text_embeds)
+                            unconditional_embeds.text_embeds = self.decorator(unconditional_embeds.text_embeds, is_unconditional=True)
+
+                        if self.adapter is not None and isinstance(self.adapter, IPAdapter) \
+                                and gen_config.adapter_image_path is not None:
+                            # apply the image projection
+                            conditional_clip_embeds = self.adapter.get_clip_image_embeds_from_tensors(validation_image)
+                            unconditional_clip_embeds = self.adapter.get_clip_image_embeds_from_tensors(validation_image,
+                                                                                                        True)
+                            conditional_embeds = self.adapter(conditional_embeds, conditional_clip_embeds, is_unconditional=False)
+                            unconditional_embeds = self.adapter(unconditional_embeds, unconditional_clip_embeds, is_unconditional=True)
+
+                        if self.adapter is not None and isinstance(self.adapter, CustomAdapter):
+                            conditional_embeds = self.adapter.condition_encoded_embeds(
+                                tensors_0_1=validation_image,
+                                prompt_embeds=conditional_embeds,
+                                is_training=False,
+                                has_been_preprocessed=False,
+                                is_generating_samples=True,
+                            )
+                            unconditional_embeds = self.adapter.condition_encoded_embeds(
+                                tensors_0_1=validation_image,
+                                prompt_embeds=unconditional_embeds,
+                                is_training=False,
+                                has_been_preprocessed=False,
+                                is_unconditional=True,
+                                is_generating_samples=True,
+                            )
+
+                        if self.adapter is not None and isinstance(self.adapter, CustomAdapter) and len(
+                                gen_config.extra_values) > 0:
+                            extra_values = torch.tensor([gen_config.extra_values], device=self.device_torch,
+                                                        dtype=self.torch_dtype)
+                            # apply extra values to the embeddings
+                            self.adapter.add_extra_values(extra_values, is_unconditional=False)
+                            self.adapter.add_extra_values(torch.zeros_like(extra_values), is_unconditional=True)
+                            pass  # todo remove, for debugging
+
+                        if self.refiner_unet is not None and gen_config.refiner_start_at < 1.0:
+                            # if we have a refiner loaded, set the denoising end at the refiner start
+                            extra['denoising_end'] = gen_config.refiner_start_at
+                            extra['output_type'] = 'latent'
+                            if not self.is_xl:
+                                raise ValueError("Refiner is only supported for XL models")
+
+                        conditional_embeds = conditional_embeds.to(self.device_torch, dtype=self.unet.dtype)
+                        unconditional_embeds = unconditional_embeds.to(self.device_torch, dtype=self.unet.dtype)
+                        prepared.append((i, gen_config, conditional_embeds, unconditional_embeds, extra))
+
+                    # items whose embeds have the same shapes are generated in one pipeline call
+                    sub_batches = OrderedDict()
+                    for item in prepared:
+                        sub_batches.setdefault(get_embeds_signature(item[2], item[3]), []).append(item)
+
+                    for items in sub_batches.values():
+                        gen_config = items[0][1]
+                        extra = items[0][4]
+                        if len(items) == 1:
+                            conditional_embeds = items[0][2]
+                            unconditional_embeds = items[0][3]
+                            generator = torch.manual_seed(gen_config.seed)
+                        else:
+                            conditional_embeds = concat_prompt_embeds([item[2] for item in items])
+                            unconditional_embeds = concat_prompt_embeds([item[3] for item in items])
+                            # one generator per item, so every image matches the one it would be generated alone
+                            generator = [torch.Generator().manual_seed(item[1].seed) for item in items]
+
+                        if self.is_xl:
+                            # fix guidance rescale for sdxl
+                            # was trained on 0.7 (I believe)
+
+                            grs = gen_config.guidance_rescale
+                            # if grs is None or grs < 0.00001:
+                            #     grs = 0.7
+                            # grs = 0.0
+
+                            if sampler.startswith("sample_"):
+                                extra['use_karras_sigmas'] = True
+                                extra = {
+                                    **extra,
+                                    **gen_config.extra_kwargs,
+                                }
+
+                            imgs = pipeline(
+                                # prompt=gen_config.prompt,
+                                # prompt_2=gen_config.prompt_2,
                                 prompt_embeds=conditional_embeds.text_embeds,
                                 pooled_prompt_embeds=conditional_embeds.pooled_embeds,
                                 negative_prompt_embeds=unconditional_embeds.text_embeds,
                                 negative_pooled_prompt_embeds=unconditional_embeds.pooled_embeds,
+                                # negative_prompt=gen_config.negative_prompt,
+                                # negative_prompt_2=gen_config.negative_prompt_2,
                                 height=gen_config.height,
                                 width=gen_config.width,
                                 num_inference_steps=gen_config.num_inference_steps,
                                 guidance_scale=gen_config.guidance_scale,
+                                guidance_rescale=grs,
                                 latents=gen_config.latents,
                                 generator=generator,
                                 **extra
-                            ).images[0]
-                        else:
-                            # Fix a bug in diffusers/torch
-                            def callback_on_step_end(pipe, i, t, callback_kwargs):
-                                latents = callback_kwargs["latents"]
-                                if latents.dtype != self.unet.dtype:
-                                    latents = latents.to(self.unet.dtype)
-                                return {"latents": latents}
-                            img = pipeline(
+                            ).images
+                        elif self.is_v3:
+                            imgs = pipeline(
                                 prompt_embeds=conditional_embeds.text_embeds,
                                 pooled_prompt_embeds=conditional_embeds.pooled_embeds,
-                                # negative_prompt_embeds=unconditional_embeds.text_embeds,
-                                # negative_pooled_prompt_embeds=unconditional_embeds.pooled_embeds,
+                                negative_prompt_embeds=unconditional_embeds.text_embeds,
+                                negative_pooled_prompt_embeds=unconditional_embeds.pooled_embeds,
                                 height=gen_config.height,
                                 width=gen_config.width,
                                 num_inference_steps=gen_config.num_inference_steps,
                                 guidance_scale=gen_config.guidance_scale,
                                 latents=gen_config.latents,
                                 generator=generator,
-                                callback_on_step_end=callback_on_step_end,
                                 **extra
-                            ).images[0]
-                    elif self.is_lumina2:
-                        pipeline: Lumina2Pipeline = pipeline
-
-                        img = pipeline(
-                            prompt_embeds=conditional_embeds.text_embeds,
-                            prompt_attention_mask=conditional_embeds.attention_mask.to(self.device_torch, dtype=torch.int64),
-                            negative_prompt_embeds=unconditional_embeds.text_embeds,
-                            negative_prompt_attention_mask=unconditional_embeds.attention_mask.to(self.device_torch, dtype=torch.int64),
-                            height=gen_config.height,
-                            width=gen_config.width,
-                            num_inference_steps=gen_config.num_inference_steps,
-                            guidance_scale=gen_config.guidance_scale,
-                            latents=gen_config.latents,
-                            generator=generator,
-                            **extra
-                        ).images[0]
-                    elif self.is_pixart:
-                        # needs attention masks for some reason
-                        img = pipeline(
-                            prompt=None,
-                            prompt_embeds=conditional_embeds.text_embeds.to(self.device_torch, dtype=self.unet.dtype),
-                            prompt_attention_mask=conditional_embeds.attention_mask.to(self.device_torch,
-                                                                                       dtype=self.unet.dtype),
-                            negative_prompt_embeds=unconditional_embeds.text_embeds.to(self.device_torch,
-                                                                                       dtype=self.unet.dtype),
-                            negative_prompt_attention_mask=unconditional_embeds.attention_mask.to(self.device_torch,
-                                                                                                  dtype=self.unet.dtype),
-                            negative_prompt=None,
-                            # negative_prompt=gen_config.negative_prompt,
-                            height=gen_config.height,
-                            width=gen_config.width,
-                            num_inference_steps=gen_config.num_inference_steps,
-                            guidance_scale=gen_config.guidance_scale,
-                            latents=gen_config.latents,
-                            generator=generator,
-                            **extra
-                        ).images[0]
-                    elif self.is_auraflow:
-                        pipeline: AuraFlowPipeline = pipeline
-
-                        img = pipeline(
-                            prompt=None,
-                            prompt_embeds=conditional_embeds.text_embeds.to(self.device_torch, dtype=self.unet.dtype),
-                            prompt_attention_mask=conditional_embeds.attention_mask.to(self.device_torch,
-                                                                                       dtype=self.unet.dtype),
-                            negative_prompt_embeds=unconditional_embeds.text_embeds.to(self.device_torch,
-                                                                                       dtype=self.unet.dtype),
-                            negative_prompt_attention_mask=unconditional_embeds.attention_mask.to(self.device_torch,
-                                                                                                  dtype=self.unet.dtype),
-                            negative_prompt=None,
-                            # negative_prompt=gen_config.negative_prompt,
-                            height=gen_config.height,
-                            width=gen_config.width,
-                            num_inference_steps=gen_config.num_inference_steps,
-                            guidance_scale=gen_config.guidance_scale,
-                            latents=gen_config.latents,
-                            generator=generator,
-                            **extra
-                        ).images[0]
-                    else:
-                        img = pipeline(
-                            # prompt=gen_config.prompt,
-                            prompt_embeds=conditional_embeds.text_embeds,
-                            negative_prompt_embeds=unconditional_embeds.text_embeds,
-                            # negative_prompt=gen_config.negative_prompt,
-                            height=gen_config.height,
-                            width=gen_config.width,
-                            num_inference_steps=gen_config.num_inference_steps,
-                            guidance_scale=gen_config.guidance_scale,
-                            latents=gen_config.latents,
-                            generator=generator,
-                            **extra
-                        ).images[0]
-
-                    if self.refiner_unet is not None and gen_config.refiner_start_at < 1.0:
-                        # slide off just the last 1280 on the last dim as refiner does not use first text encoder
-                        # todo, should we just use the Text encoder for the refiner? Fine tuned versions will differ
-                        refiner_text_embeds = conditional_embeds.text_embeds[:, :, -1280:]
-                        refiner_unconditional_text_embeds = unconditional_embeds.text_embeds[:, :, -1280:]
-                        # run through refiner
-                        img = refiner_pipeline(
-                            # prompt=gen_config.prompt,
-                            # prompt_2=gen_config.prompt_2,
-
-                            # slice these as it does not use both text encoders
-                            # height=gen_config.height,
-                            # width=gen_config.width,
-                            prompt_embeds=refiner_text_embeds,
-                            pooled_prompt_embeds=conditional_embeds.pooled_embeds,
-                            negative_prompt_embeds=refiner_unconditional_text_embeds,
-                            negative_pooled_prompt_embeds=unconditional_embeds.pooled_embeds,
-                            num_inference_steps=gen_config.num_inference_steps,
-                            guidance_scale=gen_config.guidance_scale,
-                            guidance_rescale=grs,
-                            denoising_start=gen_config.refiner_start_at,
-                            denoising_end=gen_config.num_inference_steps,
-                            image=img.unsqueeze(0),
-                            generator=generator,
-                        ).images[0]
-
-                    gen_config.save_image(img, i)
-                    gen_config.log_image(img, i)
-                    self._after_sample_image(i, len(image_configs))
-                    flush()
+                            ).images
+                        elif self.is_flux:
+                            if self.model_config.use_flux_cfg:
+                                imgs = pipeline(
+                                    prompt_embeds=conditional_embeds.text_embeds,
+                                    pooled_prompt_embeds=conditional_embeds.pooled_embeds,
+                                    negative_prompt_embeds=unconditional_embeds.text_embeds,
+                                    negative_pooled_prompt_embeds=unconditional_embeds.pooled_embeds,
+                                    height=gen_config.height,
+                                    width=gen_config.width,
+                                    num_inference_steps=gen_config.num_inference_steps,
+                                    guidance_scale=gen_config.guidance_scale,
+                                    latents=gen_config.latents,
+                                    generator=generator,
+                                    **extra
+                                ).images
+                            else:
+                                # Fix a bug in diffusers/torch
+                                def callback_on_step_end(pipe, i, t, callback_kwargs):
+                                    latents = callback_kwargs["latents"]
+                                    if latents.dtype != self.unet.dtype:
+                                        latents = latents.to(self.unet.dtype)
+                                    return {"latents": latents}
+                                imgs = pipeline(
+                                    prompt_embeds=conditional_embeds.text_embeds,
+                                    pooled_prompt_embeds=conditional_embeds.pooled_embeds,
+                                    # negative_prompt_embeds=unconditional_embeds.text_embeds,
+                                    # negative_pooled_prompt_embeds=unconditional_embeds.pooled_embeds,
+                                    height=gen_config.height,
+                                    width=gen_config.width,
+                                    num_inference_steps=gen_config.num_inference_steps,
+                                    guidance_scale=gen_config.guidance_scale,
+                                    latents=gen_config.latents,
+                                    generator=generator,
+                                    callback_on_step_end=callback_on_step_end,
+                                    **extra
+                                ).images
+                        elif self.is_lumina2:
+                            pipeline: Lumina2Pipeline = pipeline
+
+                            imgs = pipeline(
+                                prompt_embeds=conditional_embeds.text_embeds,
+                                prompt_attention_mask=conditional_embeds.attention_mask.to(self.device_torch, dtype=torch.int64),
+                                negative_prompt_embeds=unconditional_embeds.text_embeds,
+                                negative_prompt_attention_mask=unconditional_embeds.attention_mask.to(self.device_torch, dtype=torch.int64),
+                                height=gen_config.height,
+                                width=gen_config.width,
+                                num_inference_steps=gen_config.num_inference_steps,
+                                guidance_scale=gen_config.guidance_scale,
+                                latents=gen_config.latents,
+                                generator=generator,
+                                **extra
+                            ).images
+                        elif self.is_pixart:
+                            # needs attention masks for some reason
+                            imgs = pipeline(
+                                prompt=None,
+                                prompt_embeds=conditional_embeds.text_embeds.to(self.device_torch, dtype=self.unet.dtype),
+                                prompt_attention_mask=conditional_embeds.attention_mask.to(self.device_torch,
+                                                                                           dtype=self.unet.dtype),
+                                negative_prompt_embeds=unconditional_embeds.text_embeds.to(self.device_torch,
+                                                                                           dtype=self.unet.dtype),
+                                negative_prompt_attention_mask=unconditional_embeds.attention_mask.to(self.device_torch,
+                                                                                                      dtype=self.unet.dtype),
+                                negative_prompt=None,
+                                # negative_prompt=gen_config.negative_prompt,
+                                height=gen_config.height,
+                                width=gen_config.width,
+                                num_inference_steps=gen_config.num_inference_steps,
+                                guidance_scale=gen_config.guidance_scale,
+                                latents=gen_config.latents,
+                                generator=generator,
+                                **extra
+                            ).images
+                        elif self.is_auraflow:
+                            pipeline: AuraFlowPipeline = pipeline
+
+                            imgs = pipeline(
+                                prompt=None,
+                                prompt_embeds=conditional_embeds.text_embeds.to(self.device_torch, dtype=self.unet.dtype),
+                                prompt_attention_mask=conditional_embeds.attention_mask.to(self.device_torch,
+                                                                                           dtype=self.unet.dtype),
+                                negative_prompt_embeds=unconditional_embeds.text_embeds.to(self.device_torch,
+                                                                                           dtype=self.unet.dtype),
+                                negative_prompt_attention_mask=unconditional_embeds.attention_mask.to(self.device_torch,
+                                                                                                      dtype=self.unet.dtype),
+                                negative_prompt=None,
+                                # negative_prompt=gen_config.negative_prompt,
+                                height=gen_config.height,
+                                width=gen_config.width,
+                                num_inference_steps=gen_config.num_inference_steps,
+                                guidance_scale=gen_config.guidance_scale,
+                                latents=gen_config.latents,
+                                generator=generator,
+                                **extra
+                            ).images
+                        else:
+                            imgs = pipeline(
+                                # prompt=gen_config.prompt,
+                                prompt_embeds=conditional_embeds.text_embeds,
+                                negative_prompt_embeds=unconditional_embeds.text_embeds,
+                                # negative_prompt=gen_config.negative_prompt,
+                                height=gen_config.height,
+                                width=gen_config.width,
+                                num_inference_steps=gen_config.num_inference_steps,
+                                guidance_scale=gen_config.guidance_scale,
+                                latents=gen_config.latents,
+                                generator=generator,
+                                **extra
+                            ).images
+
+                        if self.refiner_unet is not None and gen_config.refiner_start_at < 1.0:
+                            # slide off just the last 1280 on the last dim as refiner does not use first text encoder
+                            # todo, should we just use the Text encoder for the refiner? Fine tuned versions will differ
+                            refiner_text_embeds = conditional_embeds.text_embeds[:, :, -1280:]
+                            refiner_unconditional_text_embeds = unconditional_embeds.text_embeds[:, :, -1280:]
+                            # run through refiner
+                            imgs = refiner_pipeline(
+                                # prompt=gen_config.prompt,
+                                # prompt_2=gen_config.prompt_2,
+
+                                # slice these as it does not use both text encoders
+                                # height=gen_config.height,
+                                # width=gen_config.width,
+                                prompt_embeds=refiner_text_embeds,
+                                pooled_prompt_embeds=conditional_embeds.pooled_embeds,
+                                negative_prompt_embeds=refiner_unconditional_text_embeds,
+                                negative_pooled_prompt_embeds=unconditional_embeds.pooled_embeds,
+                                num_inference_steps=gen_config.num_inference_steps,
+                                guidance_scale=gen_config.guidance_scale,
+                                guidance_rescale=grs,
+                                denoising_start=gen_config.refiner_start_at,
+                                denoising_end=gen_config.num_inference_steps,
+                                image=imgs[0].unsqueeze(0),
+                                generator=generator,
+                            ).images
+
+
+                        for (i, item_config, _, _, _), img in zip(items, imgs):
+                            # encoding and writing happen on the sample writer while the next image generates
+                            self.sample_writer.write(item_config, img, i)
+                            self._after_sample_image(num_done, len(image_configs))
+                            num_done += 1
 
                 if self.adapter is not None and isinstance(self.adapter, ReferenceAdapter):
                     self.adapter.clear_memory()
@@ -1747,6 +1786,9 @@ class StableDiffusion:
 
         flush()
 
+        if wait_for_writes:
+            self.sample_writer.drain()
+
     def get_latent_noise(
             self,
             height=None,
@@ -1,81 +1,270 @@
+import json
+import math
 import time
-from collections import OrderedDict, deque
+from collections import OrderedDict
 import sys
 import os
 
 # check if is ui process will have IS_AI_TOOLKIT_UI in env
 is_ui = os.environ.get("IS_AI_TOOLKIT_UI", "0") == "1"
 
+# timings go in log spaced buckets starting at 1us, each 5% wider than the last, so percentiles
+# are within about 2.5% while every span only keeps a small dict of counts
+HISTOGRAM_BASE = 1e-6
+HISTOGRAM_GROWTH = 1.05
+_LOG_GROWTH = math.log(HISTOGRAM_GROWTH)
+
+PERCENTILES = (50, 95, 99)
+
+
+class SpanStats:
+    __slots__ = ('count', 'total', 'min', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+        self.buckets = {}
+
+    def add(self, elapsed: float):
+        self.count += 1
+        self.total += elapsed
+        if elapsed < self.min:
+            self.min = elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+        idx = int(math.log(elapsed / HISTOGRAM_BASE) / _LOG_GROWTH) if elapsed > HISTOGRAM_BASE else 0
+        self.buckets[idx] = self.buckets.get(idx, 0) + 1
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count > 0 else 0.0
+
+    def percentile(self, p: float) -> float:
+        if self.count == 0:
+            return 0.0
+        target = p / 100 * self.count
+        seen = 0
+        for idx in sorted(self.buckets):
+            seen += self.buckets[idx]
+            if seen >= target:
+                # middle of the bucket, kept inside what was actually seen
+                value = HISTOGRAM_BASE * HISTOGRAM_GROWTH ** (idx + 0.5)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def to_dict(self) -> dict:
+        stats = {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.mean,
+            'min': self.min if self.count > 0 else 0.0,
+            'max': self.max,
+        }
+        for p in PERCENTILES:
+            stats[f'p{p}'] = self.percentile(p)
+        return stats
+
+
+class _Span:
+    __slots__ = ('timer', 'name')
+
+    def __init__(self, timer: 'Timer', name: str):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.timer.start(self.name)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            # No exceptions, stop the timer normally
+            self.timer.stop(self.name)
+        else:
+            # There was an exception, cancel the timer
+            self.timer.cancel(self.name)
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
 class Timer:
-    def __init__(self, name='Timer', max_buffer=10):
+    """
+    Times named spans with a monotonic clock and keeps a histogram per span since the last reset.
+    Spans started while another is running are nested under it, so get_batch inside train_loop is
+    recorded as train_loop/get_batch.
+
+    When disabled, every call returns right away. sync_device waits for queued cuda work at the start
+    and end of every span, so spans measure the gpu work they launch instead of just the launch. It
+    slows training down a little, so it is meant for profiling.
+    """
+
+    def __init__(self, name='Timer', enabled=True, sync_device=False):
         self.name = name
-        self.max_buffer = max_buffer
+        self.enabled = enabled
         self.timers = OrderedDict()
+        # timer name -> (span path, start time)
         self.active_timers = {}
-        self.current_timer = None  # Used for the context manager functionality
+        self._stack = []
         self._after_print_hooks = []
+        self._sync = None
+        if sync_device:
+            import torch
+            if torch.cuda.is_available():
+                self._sync = torch.cuda.synchronize
+
+    def _get_stats(self, path) -> SpanStats:
+        stats = self.timers.get(path)
+        if stats is None:
+            stats = SpanStats()
+            self.timers[path] = stats
+        return stats
 
     def start(self, timer_name):
-        if timer_name not in self.timers:
-            self.timers[timer_name] = deque(maxlen=self.max_buffer)
-        self.active_timers[timer_name] = time.time()
+        if not self.enabled:
+            return
+        if self._sync is not None:
+            self._sync()
+        path = f"{self._stack[-1]}/{timer_name}" if len(self._stack) > 0 else timer_name
+        self._stack.append(path)
+        self.active_timers[timer_name] = (path, time.perf_counter())
+
+    def _pop(self, timer_name):
+        path, start_time = self.active_timers.pop(timer_name)
+        # usually the innermost span, but start and stop do not have to be nested
+        for i in range(len(self._stack) - 1, -1, -1):
+            if self._stack[i] == path:
+                del self._stack[i]
+                break
+        return path, start_time
 
     def cancel(self, timer_name):
         """Cancel an active timer."""
         if timer_name in self.active_timers:
-            del self.active_timers[timer_name]
+            self._pop(timer_name)
 
     def stop(self, timer_name):
+        if not self.enabled:
+            return
         if timer_name not in self.active_timers:
             raise ValueError(f"Timer '{timer_name}' was not started!")
+        if self._sync is not None:
+            self._sync()
+        end_time = time.perf_counter()
+        path, start_time = self._pop(timer_name)
+        self._get_stats(path).add(end_time - start_time)
 
-        elapsed_time = time.time() - self.active_timers[timer_name]
-        self.timers[timer_name].append(elapsed_time)
-
-        # Clean up active timers
-        del self.active_timers[timer_name]
-
-        # Check if this timer's buffer exceeds max_buffer and remove the oldest if it does
-        if len(self.timers[timer_name]) > self.max_buffer:
-            self.timers[timer_name].popleft()
+    def record(self, timer_name, elapsed_time):
+        """Add a timing that was measured somewhere else, like a background thread."""
+        if not self.enabled:
+            return
+        path = f"{self._stack[-1]}/{timer_name}" if len(self._stack) > 0 else timer_name
+        self._get_stats(path).add(elapsed_time)
 
     def add_after_print_hook(self, hook):
         self._after_print_hooks.append(hook)
 
+    def get_stats(self) -> OrderedDict:
+        """span path -> count, total, mean, min, max and percentiles in seconds"""
+        return OrderedDict((path, stats.to_dict()) for path, stats in self.timers.items() if stats.count > 0)
+
+    def _sorted_paths(self):
+        # children directly under their parent, longest total first at each level
+        children = {}
+        for path in self.timers:
+            parent = path.rsplit('/', 1)[0] if '/' in path else None
+            children.setdefault(parent, []).append(path)
+        ordered = []
+
+        def add(parent):
+            for path in sorted(children.get(parent, []), key=lambda p: self.timers[p].total, reverse=True):
+                ordered.append(path)
+                add(path)
+
+        add(None)
+        # anything whose parent never finished goes last
+        ordered.extend(path for path in self.timers if path not in ordered)
+        return ordered
+
     def print(self):
+        if not self.enabled:
+            return
         if not is_ui:
             print(f"\nTimer '{self.name}':")
         timing_dict = {}
-        # sort by longest at top
-        for timer_name, timings in sorted(self.timers.items(), key=lambda x: sum(x[1]), reverse=True):
-            avg_time = sum(timings) / len(timings)
-            
+        for path in self._sorted_paths():
+            stats = self.timers[path]
+            if stats.count == 0:
+                continue
             if not is_ui:
-                print(f" - {avg_time:.4f}s avg - {timer_name}, num = {len(timings)}")
-            timing_dict[timer_name] = avg_time
+                depth = path.count('/')
+                span_name = path.rsplit('/', 1)[-1]
+                print(
+                    f" - {stats.mean:.4f}s avg, {stats.percentile(50):.4f}s p50, {stats.percentile(95):.4f}s p95, "
+                    f"{stats.percentile(99):.4f}s p99 - {'  ' * depth}{span_name}, num = {stats.count}"
+                )
+            timing_dict[path] = stats.mean
 
         for hook in self._after_print_hooks:
             hook(timing_dict)
         if not is_ui:
             print('')
 
+    def write_jsonl(self, path, step=None):
+        """Append the current stats as one json line."""
+        if not self.enabled:
+            return
+        line = {'name': self.name, 'time': time.time(), 'step': step, 'timers': self.get_stats()}
+        with open(path, 'a') as f:
+            f.write(json.dumps(line) + '\n')
+
+    def log_to_tensorboard(self, writer, step):
+        if not self.enabled:
+            return
+        for path, stats in self.get_stats().items():
+            for key in ['mean'] + [f'p{p}' for p in PERCENTILES]:
+                writer.add_scalar(f"timing/{path}/{key}", stats[key], step)
+
+    def write_prometheus(self, path):
+        """Write the current stats as a prometheus text format summary, for a textfile collector."""
+        if not self.enabled:
+            return
+        job_name = self.name.replace('\\', '\\\\').replace('"', '\\"')
+        lines = [
+            '# HELP aitk_span_seconds Time spent in each timed span since the last report.',
+            '# TYPE aitk_span_seconds summary',
+        ]
+        for span, stats in self.get_stats().items():
+            labels = f'job="{job_name}",span="{span}"'
+            for p in PERCENTILES:
+                lines.append(f'aitk_span_seconds{{{labels},quantile="{p / 100}"}} {stats[f"p{p}"]:.9f}')
+            lines.append(f'aitk_span_seconds_sum{{{labels}}} {stats["total"]:.9f}')
+            lines.append(f'aitk_span_seconds_count{{{labels}}} {stats["count"]}')
+        # replace the file in one go so a scrape never sees half of it
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, path)
+
     def reset(self):
         self.timers.clear()
         self.active_timers.clear()
+        self._stack.clear()
 
     def __call__(self, timer_name):
         """Enable the use of the Timer class as a context manager."""
-        self.current_timer = timer_name
-        self.start(timer_name)
-        return self
-
-    def __enter__(self):
-        pass
-
-    def __exit__(self, exc_type, exc_value, traceback):
-        if exc_type is None:
-            # No exceptions, stop the timer normally
-            self.stop(self.current_timer)
-        else:
-            # There was an exception, cancel the timer
-            self.cancel(self.current_timer)
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, timer_name)